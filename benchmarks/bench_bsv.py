@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+# pylint: disable=invalid-name
+"""Benchmarks parsing a large, generated BSV concept file serially vs in parallel"""
+
+import argparse
+import os
+import random
+import tempfile
+import time
+
+from ctakesclient import filesystem
+
+VOCABS = ["SNOMEDCT_US", "ICD10CM", "HPO", "CHV", "NCI", "RXNORM", "LNC"]
+
+
+def generate_concepts_bsv(path: str, rows: int, seed: int = 0) -> None:
+    """Writes a synthetic CUI|TUI|CODE|VOCAB|TXT|PREF file with the given number of rows"""
+    rng = random.Random(seed)
+    with open(path, "w", encoding="utf8") as f:
+        f.write("#CUI|TUI|CODE|SAB|STR|PREF\n")
+        for i in range(rows):
+            cui = f"C{rng.randrange(10**7):07d}"
+            tui = f"T{rng.randrange(1, 205):03d}"
+            text = " ".join(f"term{rng.randrange(50000)}" for _ in range(rng.randrange(1, 5)))
+            f.write(f"{cui}|{tui}|{i}|{rng.choice(VOCABS)}|{text}|{text.title()}\n")
+
+
+def timed(label: str, func, *args, **kwargs):
+    tic = time.perf_counter()
+    result = func(*args, **kwargs)
+    toc = time.perf_counter()
+    print(f"{label:<30} {toc - tic:8.2f} seconds")
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=2_000_000, help="rows in the generated BSV file")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="worker processes for parallel parsing")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, "concepts.bsv")
+        timed(f"generate {args.rows:,} rows", generate_concepts_bsv, path, args.rows)
+        print(f"file size: {os.path.getsize(path) / 2**20:.0f} MiB")
+
+        serial = timed("list_bsv", filesystem.list_bsv, path, filesystem.BsvConcept)
+        parallel = timed(
+            f"list_bsv_parallel ({args.workers} workers)",
+            filesystem.list_bsv_parallel,
+            path,
+            filesystem.BsvConcept,
+            max_workers=args.workers,
+        )
+
+        if [x.to_bsv() for x in serial] != [x.to_bsv() for x in parallel]:
+            raise RuntimeError("parallel parsing did not match serial parsing")
+
+
+if __name__ == "__main__":
+    main()
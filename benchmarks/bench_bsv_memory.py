@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+# pylint: disable=invalid-name
+"""Benchmarks the memory used by loaded BSV concept rows"""
+
+import argparse
+import os
+import tempfile
+import tracemalloc
+
+from bench_bsv import generate_concepts_bsv
+
+from ctakesclient import filesystem
+
+
+class DictConcept:
+    """A plain __dict__-based row without interning, as BsvConcept used to be, for comparison"""
+
+    def __init__(self, cui=None, tui=None, code=None, vocab=None, text=None, pref=None):
+        self.cui = cui
+        self.tui = tui
+        self.code = code
+        self.vocab = vocab
+        self.text = text
+        self.pref = pref
+
+    def from_bsv(self, source):
+        self.cui, self.tui, self.code, self.vocab, self.text, self.pref = source.split("|")
+
+
+def measure(label: str, path: str, class_bsv, rows: int) -> None:
+    tracemalloc.start()
+    entries = filesystem.list_bsv(path, class_bsv)
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print(f"{label:<15} {current / 2**20:8.1f} MiB  {current / rows:6.0f} bytes/row")
+    del entries
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=500_000, help="rows in the generated BSV file")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, "concepts.bsv")
+        generate_concepts_bsv(path, args.rows)
+
+        measure("dict rows", path, DictConcept, args.rows)
+        measure("BsvConcept", path, filesystem.BsvConcept, args.rows)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+# pylint: disable=invalid-name
+"""Benchmarks how long importing ctakesclient (and each of its submodules) takes, via `python -X importtime`"""
+
+import argparse
+import statistics
+import subprocess  # nosec
+import sys
+
+TARGETS = [
+    "ctakesclient",
+    "ctakesclient.typesystem",
+    "ctakesclient.filesystem",
+    "ctakesclient.client",
+    "ctakesclient.text2fhir",
+    "ctakesclient.cli",
+]
+
+
+def import_time(module: str) -> int:
+    """Imports the module in a fresh interpreter, returning its cumulative import time in microseconds"""
+    result = subprocess.run(  # nosec
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        check=True,
+        text=True,
+    )
+    total = 0
+    for line in result.stderr.splitlines():
+        # Lines look like "import time:   self [us] | cumulative | imported package", children listed first
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        fields = line.split(":", 1)[1].split("|")
+        if fields[2].strip() in ("ctakesclient", module) and fields[1].strip().isdigit():
+            total = max(total, int(fields[1]))
+    return total
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--repeat", type=int, default=5, help="fresh interpreters per module (median is shown)")
+    args = parser.parse_args()
+
+    print(f"{'import':<30} {'median ms':>10} {'min ms':>10}")
+    for module in TARGETS:
+        times = [import_time(module) / 1000 for _ in range(args.repeat)]
+        print(f"{module:<30} {statistics.median(times):10.1f} {min(times):10.1f}")
+
+
+if __name__ == "__main__":
+    main()
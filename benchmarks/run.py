@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+# pylint: disable=invalid-name
+"""
+Benchmarks the client-side work: parsing cTAKES responses, fixing up offsets, queries, BSV loading,
+FHIR conversion, and end-to-end throughput against the local stub server
+
+Results are written as JSON, so runs on different versions can be compared:
+    python benchmarks/run.py --output before.json
+    (change things)
+    python benchmarks/run.py --output after.json --compare before.json
+"""
+
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+
+import httpx
+from bench_bsv import generate_concepts_bsv
+from synthetic import generate_corpus
+
+import ctakesclient
+from ctakesclient import client, filesystem, text2fhir
+from ctakesclient.stubserver import StubServer
+from ctakesclient.typesystem import CtakesJSON, Polarity
+
+# name -> (characters per note, mentions per note)
+SIZES = {"small": (1_000, 10), "medium": (10_000, 100), "large": (100_000, 1_000)}
+ASTRAL_DENSITIES = [0, 0.001, 0.01]
+
+
+def measure(func, setup=None, min_time: float = 0.2, repeat: int = 5) -> dict:
+    """
+    Times func like timeit does: enough calls per round to take `min_time`, several rounds, best & median kept
+
+    :param func: what to time
+    :param setup: optional function making a fresh argument for each call of func (not timed)
+    :param min_time: seconds each round should take at least
+    :param repeat: rounds
+    :return: seconds per call (median and min), and how many calls that was measured over
+    """
+    loops = 1
+    while True:
+        elapsed = _time_loops(func, setup, loops)
+        if elapsed >= min_time:
+            break
+        loops *= 2 if elapsed < min_time / 10 else 4
+
+    per_call = sorted([elapsed / loops] + [_time_loops(func, setup, loops) / loops for _ in range(repeat - 1)])
+    return {"median": statistics.median(per_call), "min": per_call[0], "loops": loops, "repeat": repeat}
+
+
+def _time_loops(func, setup, loops: int) -> float:
+    if setup is None:
+        tic = time.perf_counter()
+        for _ in range(loops):
+            func()
+        return time.perf_counter() - tic
+
+    args = [setup() for _ in range(loops)]
+    tic = time.perf_counter()
+    for arg in args:
+        func(arg)
+    return time.perf_counter() - tic
+
+
+###############################################################################
+#
+# Benchmarks
+#
+# Each one yields (name, timing, extra info) tuples.
+#
+###############################################################################
+
+
+def bench_parsing(args):
+    for size, (length, mentions) in SIZES.items():
+        _, response = generate_corpus(1, length, mentions, seed=args.seed)[0]
+        ner = CtakesJSON(response)
+        encoded = ner.to_bytes()
+        info = {"mentions": mentions}
+        from_json = measure(lambda response=response: CtakesJSON(response), **args.timing)
+        yield f"parse.from_json[{size}]", from_json, info
+        yield f"parse.as_json[{size}]", measure(ner.as_json, **args.timing), info
+        from_bytes = measure(lambda encoded=encoded: CtakesJSON.from_bytes(encoded), **args.timing)
+        yield f"parse.from_bytes[{size}]", from_bytes, info
+
+
+def bench_offsets(args):
+    length, mentions = SIZES["large"]
+    for density in ASTRAL_DENSITIES:
+        note, response = generate_corpus(1, length, mentions, astral_density=density, seed=args.seed)[0]
+        timing = measure(
+            lambda ner, note=note: client._adjust_character_indexes(note, ner),  # pylint: disable=protected-access
+            setup=lambda response=response: CtakesJSON(response),
+            **args.timing,
+        )
+        yield f"offsets.adjust[astral={density}]", timing, {"chars": length, "mentions": mentions}
+
+
+def bench_queries(args):
+    _, response = generate_corpus(1, *SIZES["large"], seed=args.seed)[0]
+    ner = CtakesJSON(response)
+    queries = {
+        "list_match": ner.list_match,
+        "list_match[pos]": lambda: ner.list_match(polarity=Polarity.pos),
+        "list_sign_symptom[pos]": lambda: ner.list_sign_symptom(Polarity.pos),
+        "list_concept_cui": ner.list_concept_cui,
+    }
+    for name, query in queries.items():
+        yield f"query.{name}", measure(query, **args.timing), {"mentions": SIZES["large"][1]}
+
+
+def bench_bsv(args):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, "concepts.bsv")
+        generate_concepts_bsv(path, args.bsv_rows, seed=args.seed)
+        timing = measure(lambda: filesystem.list_bsv(path, filesystem.BsvConcept), min_time=0, repeat=3)
+        yield "bsv.list_bsv", timing, {"rows": args.bsv_rows, "bytes": os.path.getsize(path)}
+
+
+def bench_fhir(args):
+    corpus = [CtakesJSON(response) for _, response in generate_corpus(10, *SIZES["medium"], seed=args.seed)]
+    info = {"documents": len(corpus), "mentions": SIZES["medium"][1]}
+
+    def each(convert):
+        return lambda: [convert("patient", "visit", f"doc-{i}", ner) for i, ner in enumerate(corpus)]
+
+    def batch():
+        documents = (("patient", "visit", f"doc-{i}", ner) for i, ner in enumerate(corpus))
+        return list(text2fhir.nlp_fhir_batch(documents))
+
+    yield "fhir.nlp_fhir", measure(each(text2fhir.nlp_fhir), **args.timing), info
+    yield "fhir.nlp_fhir_json", measure(each(text2fhir.nlp_fhir_json), **args.timing), info
+    yield "fhir.nlp_fhir_batch", measure(batch, **args.timing), info
+
+
+def bench_end_to_end(args):
+    corpus = generate_corpus(args.e2e_notes, *SIZES["small"], seed=args.seed)
+    # Answer everything with one canned response, to keep the (same process) stub server's own work small
+    fixture = corpus[0][1]
+    corpus = [note for note, _ in corpus]
+
+    async def run(concurrency: int) -> float:
+        async with StubServer(fixture=fixture, latency=args.stub_latency) as server:
+            limits = httpx.Limits(max_connections=concurrency)
+            async with httpx.AsyncClient(limits=limits) as http:
+                semaphore = asyncio.Semaphore(concurrency)
+
+                async def extract(note: str) -> None:
+                    async with semaphore:
+                        await client.extract(note, url=server.ctakes_url, client=http)
+
+                tic = time.perf_counter()
+                await asyncio.gather(*[extract(note) for note in corpus])
+                return time.perf_counter() - tic
+
+    for concurrency in args.e2e_concurrency:
+        rounds = sorted(asyncio.run(run(concurrency)) for _ in range(args.timing["repeat"]))
+        timing = {"median": statistics.median(rounds), "min": rounds[0], "loops": 1, "repeat": len(rounds)}
+        info = {
+            "notes": len(corpus),
+            "notes_per_second": len(corpus) / timing["median"],
+            "stub_latency": args.stub_latency,
+        }
+        yield f"e2e.extract[concurrency={concurrency}]", timing, info
+
+
+BENCHMARKS = {
+    "parse": bench_parsing,
+    "offsets": bench_offsets,
+    "query": bench_queries,
+    "bsv": bench_bsv,
+    "fhir": bench_fhir,
+    "e2e": bench_end_to_end,
+}
+
+###############################################################################
+#
+# Reporting
+#
+###############################################################################
+
+
+def _format_seconds(seconds: float) -> str:
+    for unit, scale in [("s", 1), ("ms", 1e-3), ("us", 1e-6)]:
+        if seconds >= scale:
+            return f"{seconds / scale:8.2f} {unit}"
+    return f"{seconds / 1e-9:8.2f} ns"
+
+
+def compare(results: dict, baseline_path: str, threshold: float) -> int:
+    """
+    Prints how each benchmark changed since a baseline run
+
+    :return: number of benchmarks that got slower than the threshold allows
+    """
+    with open(baseline_path, encoding="utf8") as f:
+        baseline = json.load(f)
+
+    print(f"\nCompared to {baseline_path} ({baseline['ctakesclient']}, {baseline['date']}):")
+    slower = 0
+    for name, result in results.items():
+        before = baseline["results"].get(name)
+        if before is None:
+            continue
+        ratio = result["median"] / before["median"]
+        flag = ""
+        if ratio > 1 + threshold:
+            flag = "  SLOWER"
+            slower += 1
+        elif ratio < 1 - threshold:
+            flag = "  faster"
+        print(
+            f"{name:<40} {_format_seconds(before['median'])} -> {_format_seconds(result['median'])} {ratio:6.2f}x{flag}"
+        )
+    return slower
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--only", choices=list(BENCHMARKS), action="append", help="run just these (can be repeated)")
+    parser.add_argument("--output", "-o", metavar="JSON", help="write results here")
+    parser.add_argument("--compare", metavar="JSON", help="compare against the results of an earlier run")
+    parser.add_argument("--threshold", type=float, default=0.1, help="slowdown to flag when comparing (default: 0.1)")
+    parser.add_argument("--min-time", type=float, default=0.2, help="seconds per timing round (default: 0.2)")
+    parser.add_argument("--repeat", type=int, default=5, help="timing rounds, the median is reported (default: 5)")
+    parser.add_argument("--seed", type=int, default=0, help="seed for the synthetic corpora")
+    parser.add_argument("--bsv-rows", type=int, default=200_000, help="rows in the generated BSV file")
+    parser.add_argument("--e2e-notes", type=int, default=200, help="notes to send to the stub server")
+    parser.add_argument("--e2e-concurrency", type=int, nargs="+", default=[1, 8], help="concurrent requests")
+    parser.add_argument("--stub-latency", type=float, default=0.01, help="stub seconds per request (default: 0.01)")
+    args = parser.parse_args()
+    args.timing = {"min_time": args.min_time, "repeat": args.repeat}
+
+    results = {}
+    for key in args.only or BENCHMARKS:
+        for name, timing, info in BENCHMARKS[key](args):
+            results[name] = {**timing, **info}
+            print(f"{name:<40} {_format_seconds(timing['median'])}  (min {_format_seconds(timing['min']).strip()})")
+
+    if args.output:
+        report = {
+            "ctakesclient": ctakesclient.__version__,
+            "python": sys.version.split()[0],
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "date": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+            "results": results,
+        }
+        with open(args.output, "w", encoding="utf8") as f:
+            json.dump(report, f, indent=2)
+            f.write("\n")
+
+    if args.compare and compare(results, args.compare, args.threshold):
+        return 1  # something got slower
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
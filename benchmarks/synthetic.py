@@ -0,0 +1,88 @@
+"""Synthetic corpora for the benchmarks: notes of any size and astral-character density, with cTAKES-like results"""
+
+import bisect
+import random
+import re
+from typing import List, Tuple
+
+WORDS = (
+    "patient reports denies history of chronic acute pain cough fever chills nausea with and no left right chest "
+    "abdomen headache mild severe daily aspirin mg taken since last visit follow up in two weeks exam normal"
+).split()
+ASTRAL = ["😀", "🩺", "💊", "🏥", "𝑥"]  # outside the Basic Multilingual Plane, so two utf16 code units each
+MENTION_TYPES = [
+    ("SignSymptomMention", "T184"),
+    ("DiseaseDisorderMention", "T047"),
+    ("MedicationMention", "T121"),
+    ("ProcedureMention", "T061"),
+    ("AnatomicalSiteMention", "T023"),
+]
+VOCABS = ["SNOMEDCT_US", "ICD10CM", "RXNORM", "LNC"]
+
+
+def generate_note(rng: random.Random, length: int, astral_density: float = 0) -> str:
+    """
+    :param rng: random source
+    :param length: characters in the note
+    :param astral_density: fraction of characters to replace with astral (non-BMP) characters, like emoji
+    :return: note text
+    """
+    words = []
+    size = 0
+    while size < length:
+        word = rng.choice(WORDS)
+        words.append(word)
+        size += len(word) + 1
+    chars = list(" ".join(words)[:length])
+    for index in rng.sample(range(len(chars)), int(len(chars) * astral_density)):
+        chars[index] = rng.choice(ASTRAL)
+    return "".join(chars)
+
+
+def generate_ctakes_json(rng: random.Random, note: str, mentions: int) -> dict:
+    """
+    :param rng: random source
+    :param note: note text
+    :param mentions: how many mentions to find (at most one per word)
+    :return: cTAKES response JSON for the note, with utf16 offsets like the real thing
+    """
+    astral = [i for i, char in enumerate(note) if ord(char) > 0xFFFF]
+    words = [m.span() for m in re.finditer(r"\w+", note)]
+    response = {}
+    for begin, end in sorted(rng.sample(words, min(mentions, len(words)))):
+        mention_type, tui = rng.choice(MENTION_TYPES)
+        cui = f"C{rng.randrange(10**7):07d}"
+        concepts = [
+            {"code": str(rng.randrange(10**8)), "cui": cui, "codingScheme": rng.choice(VOCABS), "tui": tui}
+            for _ in range(rng.randint(1, 3))
+        ]
+        response.setdefault(mention_type, []).append(
+            {
+                "begin": begin + bisect.bisect_left(astral, begin),
+                "end": end + bisect.bisect_left(astral, end),
+                "text": note[begin:end],
+                "polarity": rng.choice([0, 0, 0, -1]),
+                "conceptAttributes": concepts,
+                "type": mention_type,
+            }
+        )
+    return response
+
+
+def generate_corpus(
+    count: int, length: int, mentions: int, astral_density: float = 0, seed: int = 0
+) -> List[Tuple[str, dict]]:
+    """
+    :param count: notes in the corpus
+    :param length: characters per note
+    :param mentions: mentions per note
+    :param astral_density: fraction of astral characters in each note
+    :param seed: random seed, so every run benchmarks the same corpus
+    :return: (note text, cTAKES response JSON) for each note
+    """
+    rng = random.Random(seed)
+    corpus = []
+    for _ in range(count):
+        note = generate_note(rng, length, astral_density)
+        corpus.append((note, generate_ctakes_json(rng, note, mentions)))
+    return corpus
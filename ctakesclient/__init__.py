@@ -1,9 +1,43 @@
-"""Public API"""
+"""
+Public API
+
+Submodules are imported lazily, the first time they are used (like `ctakesclient.text2fhir`).
+That keeps `import ctakesclient` cheap for code that only needs a little of it,
+since some submodules pull in big dependencies (httpx, fhirclient).
+"""
+
+import importlib
 
 __version__ = "5.1.0"
 
-from . import client
-from . import filesystem
-from . import text2fhir
-from . import transformer
-from . import typesystem
+_SUBMODULES = (
+    "aggregate",
+    "bulkexport",
+    "cassette",
+    "cli",
+    "client",
+    "dictionary",
+    "exceptions",
+    "filesystem",
+    "invertedindex",
+    "metrics",
+    "prefilter",
+    "store",
+    "stubserver",
+    "text2fhir",
+    "transformer",
+    "typesystem",
+)
+
+__all__ = list(_SUBMODULES)
+
+
+def __getattr__(name: str):  # pylint: disable=invalid-name
+    # PEP 562: only called for attributes that don't exist yet (importing a submodule sets it as an attribute)
+    if name in _SUBMODULES:
+        return importlib.import_module(f"{__name__}.{name}")
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__():  # pylint: disable=invalid-name
+    return sorted(set(globals()) | set(_SUBMODULES))
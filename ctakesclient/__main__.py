@@ -0,0 +1,8 @@
+# pylint: disable=invalid-name
+"""Lets the package run as `python -m ctakesclient`"""
+
+import sys
+
+from ctakesclient.cli import main
+
+sys.exit(main())
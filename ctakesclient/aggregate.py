@@ -0,0 +1,201 @@
+"""Corpus-level concept counts and co-occurrence, accumulated one document at a time"""
+
+import collections
+import itertools
+from array import array
+from typing import Collection, Dict, Iterator, List, Optional, Tuple
+
+from ctakesclient import filesystem
+from ctakesclient.store import ResultStore
+from ctakesclient.typesystem import CtakesJSON, MatchText, Polarity
+
+###############################################################################
+#
+# CUIs get small integer ids, in the order they are first seen.
+# Per-CUI totals live in flat arrays indexed by those ids,
+# and each co-occurring pair (low id, high id) is packed into a single int key: low << 32 | high
+#
+###############################################################################
+
+
+class ConceptAggregator:
+    """
+    Counts CUIs, and pairs of CUIs that occur in the same document, over a stream of cTAKES results
+
+    Each call to `add` is one "document" for the document frequency and co-occurrence counts.
+    For per-patient numbers, keep one aggregator per patient (and `merge` them for the corpus).
+
+    To go faster on big corpora, give each worker process its own aggregator and `merge` them at the end.
+    """
+
+    def __init__(self, polarity: Optional[Polarity] = Polarity.pos, semantic_groups: Collection[str] = None):
+        """
+        :param polarity: only count mentions of this polarity (None for all mentions)
+        :param semantic_groups: optional UMLS semantic group ids (like "DISO") to restrict concepts to
+        """
+        self.polarity = None if polarity is None else MatchText.parse_polarity(polarity)
+        self.semantic_groups = None if semantic_groups is None else frozenset(semantic_groups)
+        self.document_count = 0
+
+        self.cuis: List[str] = []  # id -> CUI
+        self._ids: Dict[str, int] = {}  # CUI -> id
+        self._mentions = array("Q")  # id -> mentions in total
+        self._documents = array("Q")  # id -> documents with at least one mention
+        self._pairs = collections.Counter()  # low << 32 | high -> documents with both
+
+        self._tui_groups = filesystem.map_tui_semantic_group() if self.semantic_groups is not None else None
+
+    ###########################################################################
+    #
+    # Adding documents
+    #
+    ###########################################################################
+
+    def add(self, nlp_results: CtakesJSON) -> None:
+        """
+        :param nlp_results: response from cTAKES or other NLP Client, for one document
+        """
+        cuis = []
+        for match in nlp_results.list_match(polarity=self.polarity):
+            # A match often lists one CUI under several vocabularies, so only count each CUI once per match
+            cuis.extend({c.cui for c in match.conceptAttributes if self._wanted(c.cui, c.tui)})
+        self._add_cuis(cuis)
+
+    def add_json(self, ctakes_json: dict) -> None:
+        """
+        Same as `add`, but straight from `CtakesJSON.as_json()` (skipping the cost of building CtakesJSON)
+
+        :param ctakes_json: `CtakesJSON.as_json()` of one document
+        """
+        cuis = []
+        for match_list in ctakes_json.values():
+            for match in match_list:
+                if self.polarity is None or self.polarity == MatchText.parse_polarity(match.get("polarity")):
+                    concepts = match.get("conceptAttributes", [])
+                    cuis.extend({c.get("cui") for c in concepts if self._wanted(c.get("cui"), c.get("tui"))})
+        self._add_cuis(cuis)
+
+    def add_store(self, store: ResultStore) -> None:
+        """
+        :param store: stored results, where each record is one document
+        """
+        for _, ctakes_json in store.iter_json():
+            self.add_json(ctakes_json)
+
+    def _wanted(self, cui: Optional[str], tui: Optional[str]) -> bool:
+        if cui is None:
+            return False
+        if self.semantic_groups is None:
+            return True
+        semantic_type = self._tui_groups.get(tui)
+        return semantic_type is not None and semantic_type.group_id in self.semantic_groups
+
+    def _id(self, cui: str) -> int:
+        cui_id = self._ids.get(cui)
+        if cui_id is None:
+            cui_id = self._ids[cui] = len(self.cuis)
+            self.cuis.append(cui)
+            self._mentions.append(0)
+            self._documents.append(0)
+        return cui_id
+
+    def _add_cuis(self, cuis: List[str]) -> None:
+        self.document_count += 1
+        ids = [self._id(cui) for cui in cuis]
+        for cui_id in ids:
+            self._mentions[cui_id] += 1
+
+        unique = sorted(set(ids))
+        for cui_id in unique:
+            self._documents[cui_id] += 1
+        self._pairs.update((low << 32) | high for low, high in itertools.combinations(unique, 2))
+
+    def merge(self, other: "ConceptAggregator") -> None:
+        """
+        Adds the counts of another aggregator (like one from a parallel worker) into this one
+
+        :param other: aggregator with the same polarity and semantic group filters
+        """
+        if (other.polarity, other.semantic_groups) != (self.polarity, self.semantic_groups):
+            raise ValueError("cannot merge aggregators with different filters")
+
+        remap = [self._id(cui) for cui in other.cuis]
+        for other_id, cui_id in enumerate(remap):
+            self._mentions[cui_id] += other._mentions[other_id]  # pylint: disable=protected-access
+            self._documents[cui_id] += other._documents[other_id]  # pylint: disable=protected-access
+
+        for key, count in other._pairs.items():  # pylint: disable=protected-access
+            first, second = remap[key >> 32], remap[key & 0xFFFFFFFF]
+            low, high = (first, second) if first < second else (second, first)
+            self._pairs[(low << 32) | high] += count
+        self.document_count += other.document_count
+
+    ###########################################################################
+    #
+    # Results
+    #
+    ###########################################################################
+
+    def mention_counts(self) -> Dict[str, int]:
+        """
+        :return: {cui: number of mentions}
+        """
+        return dict(zip(self.cuis, self._mentions))
+
+    def document_frequency(self) -> Dict[str, int]:
+        """
+        :return: {cui: number of documents that mention it}
+        """
+        return dict(zip(self.cuis, self._documents))
+
+    def most_common(self, n: int = None) -> List[Tuple[str, int]]:
+        """
+        :param n: how many to return (default all)
+        :return: (cui, number of documents) pairs, most frequent first
+        """
+        ranked = sorted(range(len(self.cuis)), key=lambda cui_id: (-self._documents[cui_id], self.cuis[cui_id]))
+        return [(self.cuis[cui_id], self._documents[cui_id]) for cui_id in ranked[:n]]
+
+    def cooccurrence(self, cui_a: str, cui_b: str) -> int:
+        """
+        :return: number of documents that mention both CUIs
+        """
+        first, second = self._ids.get(cui_a), self._ids.get(cui_b)
+        if first is None or second is None or first == second:
+            return 0
+        low, high = (first, second) if first < second else (second, first)
+        return self._pairs.get((low << 32) | high, 0)
+
+    def pairs(self) -> Iterator[Tuple[str, str, int]]:
+        """
+        :return: (cui, other cui, number of documents with both) for every co-occurring pair, each pair once
+        """
+        for key, count in self._pairs.items():
+            yield self.cuis[key >> 32], self.cuis[key & 0xFFFFFFFF], count
+
+    def to_coo(self) -> Tuple[array, array, array]:
+        """
+        Sparse co-occurrence matrix in coordinate form, indexed by position in `cuis` (upper triangle only)
+
+        :return: (rows, columns, counts) arrays, ready for `scipy.sparse.coo_matrix((counts, (rows, columns)))`
+        """
+        rows, columns, counts = array("I"), array("I"), array("Q")
+        for key, count in self._pairs.items():
+            rows.append(key >> 32)
+            columns.append(key & 0xFFFFFFFF)
+            counts.append(count)
+        return rows, columns, counts
+
+    def to_scipy(self):
+        """
+        :return: symmetric scipy.sparse CSR co-occurrence matrix, indexed by position in `cuis`
+        """
+        try:
+            from scipy import sparse  # pylint: disable=import-outside-toplevel
+        except ImportError as exc:
+            raise ImportError("to_scipy() needs scipy, install it with: pip install scipy") from exc
+
+        rows, columns, counts = self.to_coo()
+        size = len(self.cuis)
+        upper = sparse.coo_matrix((counts, (rows, columns)), shape=(size, size), dtype="int64")
+        return (upper + upper.T).tocsr()
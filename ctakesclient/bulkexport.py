@@ -0,0 +1,235 @@
+"""Streams FHIR resources into bulk-data-style NDJSON files, one set of files per resource type"""
+
+import gzip
+import json
+import logging
+import os
+import re
+from typing import Container, Dict, Iterable, List, Tuple
+
+from ctakesclient.text2fhir import NlpFhirConverter, resource_hash
+from ctakesclient.typesystem import CtakesJSON, MatchText, Polarity
+
+###############################################################################
+#
+# FHIR Bulk Data style output: Observation.000.ndjson, Condition.000.ndjson, ...
+# https://hl7.org/fhir/uv/bulkdata/export.html#file-format
+#
+###############################################################################
+
+
+class _PartFile:
+    """One NDJSON output file, written under a temporary name until it is complete"""
+
+    def __init__(self, path: str, compress: bool, buffer_size: int):
+        self.path = path
+        self.tmp_path = f"{path}.tmp"
+        self.size = 0  # uncompressed bytes written so far
+
+        self._raw = open(self.tmp_path, "wb", buffering=buffer_size)  # pylint: disable=consider-using-with
+        self._file = gzip.GzipFile(fileobj=self._raw, mode="wb") if compress else self._raw
+
+    def write(self, line: bytes) -> None:
+        self._file.write(line)
+        self.size += len(line)
+
+    def finish(self) -> None:
+        """Flushes everything to disk and atomically moves the file into its final place"""
+        if self._file is not self._raw:
+            self._file.close()
+        self._raw.flush()
+        os.fsync(self._raw.fileno())
+        self._raw.close()
+        os.replace(self.tmp_path, self.path)
+
+    def abandon(self) -> None:
+        """Closes the file, leaving it under its temporary name"""
+        if self._file is not self._raw:
+            self._file.close()
+        self._raw.close()
+
+
+class BulkExportWriter:
+    """
+    Writes FHIR resource JSON to one NDJSON file per resource type, as it arrives
+
+    Resources are streamed straight to (buffered) files, so memory use does not grow with the number of resources.
+
+    Files are named like "Observation.000.ndjson" (or "Observation.000.ndjson.gz" when compressing).
+    With `max_file_size`, a resource type rolls over into "Observation.001.ndjson" and so on.
+
+    Each file is written under a ".tmp" name and only renamed into place once it is complete
+    (when it rolls over, or when the writer is closed). So after a crash, every file with a final name is whole.
+    The same goes for a `with` block that exits on an exception: unfinished files keep their ".tmp" names.
+    Re-opening a directory continues numbering after the files that are already there,
+    and deletes the unfinished ".tmp" files of any resource type it writes again.
+
+    For incremental re-runs, generate resources with deterministic ids and pass the `text2fhir.resource_hash` values
+    of what is already stored as `known_hashes`. Unchanged resources are then skipped instead of written again.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        compress: bool = False,
+        max_file_size: int = None,
+        buffer_size: int = 1024 * 1024,
+        known_hashes: Container[str] = None,
+    ):
+        """
+        :param directory: folder to write into (created if needed)
+        :param compress: whether to gzip each file
+        :param max_file_size: optional limit of (uncompressed) bytes per file, before rolling over into a new file
+        :param buffer_size: I/O buffer size for each open file
+        :param known_hashes: optional `text2fhir.resource_hash` values of resources to skip (already stored)
+        """
+        self.directory = directory
+        self.compress = compress
+        self.max_file_size = max_file_size
+        self.buffer_size = buffer_size
+        self.known_hashes = known_hashes
+        self.skipped = 0  # resources left out because of known_hashes
+
+        self._open: Dict[str, _PartFile] = {}
+        self._next_part: Dict[str, int] = {}
+        self._written: List[str] = []
+        self._converter = None
+
+        os.makedirs(directory, exist_ok=True)
+
+    @property
+    def suffix(self) -> str:
+        return ".ndjson.gz" if self.compress else ".ndjson"
+
+    ###########################################################################
+    #
+    # Writing
+    #
+    ###########################################################################
+
+    def write(self, resource: dict) -> None:
+        """
+        :param resource: FHIR resource JSON, with a resourceType
+        """
+        if self.known_hashes is not None and resource_hash(resource) in self.known_hashes:
+            self.skipped += 1
+            return
+
+        resource_type = resource["resourceType"]
+        line = json.dumps(resource, separators=(",", ":")).encode("utf8") + b"\n"
+
+        part = self._open.get(resource_type)
+        if part and self.max_file_size and part.size and part.size + len(line) > self.max_file_size:
+            self._finish(resource_type)
+            part = None
+        if part is None:
+            part = self._start(resource_type)
+
+        part.write(line)
+
+    def write_all(self, resources: Iterable[dict]) -> None:
+        """
+        :param resources: FHIR resource JSON, like the output of `text2fhir.nlp_fhir_json`
+        """
+        for resource in resources:
+            self.write(resource)
+
+    def write_nlp(
+        self,
+        subject_id: str,
+        encounter_id: str,
+        docref_id: str,
+        nlp_results: CtakesJSON,
+        source=None,
+        polarity: Polarity = Polarity.pos,
+        deterministic_id: bool = False,
+    ) -> None:
+        """
+        Converts one document's NLP results into FHIR (see `text2fhir.NlpFhirConverter`) and writes them
+
+        :param subject_id: ID for Patient (isa REF can be UUID)
+        :param encounter_id: ID for visit (isa REF can be UUID)
+        :param docref_id: ID for DocumentReference (isa REF can be UUID)
+        :param nlp_results: response from cTAKES or other NLP Client
+        :param source: NLP Version information, if none is provided use version of ctakesclient.
+        :param polarity: filter only positive mentions by default
+        :param deterministic_id: use `text2fhir.stable_id` ids instead of random ids
+        """
+        converter = self._converter
+        polarity = None if polarity is None else MatchText.parse_polarity(polarity)  # like the converter stores it
+        settings = (source, polarity, deterministic_id)
+        if converter is None or (converter.source, converter.polarity, converter.deterministic_id) != settings:
+            converter = NlpFhirConverter(source=source, polarity=polarity, deterministic_id=deterministic_id)
+            self._converter = converter
+        self.write_all(converter.convert(subject_id, encounter_id, docref_id, nlp_results))
+
+    def write_documents(self, documents: Iterable[Tuple[str, str, str, CtakesJSON]], **kwargs) -> None:
+        """
+        :param documents: (subject_id, encounter_id, docref_id, nlp_results) for each document
+        :param kwargs: passed along to `write_nlp`
+        """
+        for subject_id, encounter_id, docref_id, nlp_results in documents:
+            self.write_nlp(subject_id, encounter_id, docref_id, nlp_results, **kwargs)
+
+    ###########################################################################
+    #
+    # File handling
+    #
+    ###########################################################################
+
+    def _first_free_part(self, resource_type: str) -> int:
+        """Finds the next part number after any existing files (finished or not), deleting unfinished ones"""
+        pattern = re.compile(rf"^{re.escape(resource_type)}\.(\d+){re.escape(self.suffix)}(\.tmp)?$")
+        taken = []
+        for match in map(pattern.match, os.listdir(self.directory)):
+            if not match:
+                continue
+            taken.append(int(match.group(1)))
+            if match.group(2):
+                logging.warning("removing unfinished file %s", match.group(0))
+                os.remove(os.path.join(self.directory, match.group(0)))
+        return max(taken, default=-1) + 1
+
+    def _start(self, resource_type: str) -> _PartFile:
+        number = self._next_part.get(resource_type)
+        if number is None:
+            number = self._first_free_part(resource_type)
+        self._next_part[resource_type] = number + 1
+
+        path = os.path.join(self.directory, f"{resource_type}.{number:03d}{self.suffix}")
+        logging.debug("starting %s", path)
+        part = _PartFile(path, self.compress, self.buffer_size)
+        self._open[resource_type] = part
+        return part
+
+    def _finish(self, resource_type: str) -> None:
+        part = self._open.pop(resource_type)
+        part.finish()
+        self._written.append(part.path)
+
+    def close(self) -> List[str]:
+        """
+        Finishes all open files
+
+        :return: paths of every file this writer completed
+        """
+        for resource_type in list(self._open):
+            self._finish(resource_type)
+        return list(self._written)
+
+    def abort(self) -> None:
+        """
+        Closes all open files without finishing them, so they keep their temporary names
+        """
+        for part in self._open.values():
+            part.abandon()
+        self._open.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()  # don't make partial output look complete
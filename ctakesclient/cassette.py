@@ -0,0 +1,213 @@
+"""
+Record real cTAKES & cNLP responses once, then replay them, for repeatable client-side performance runs
+
+Recording:
+
+    cassette = Cassette()
+    async with httpx.AsyncClient(transport=RecordingTransport(cassette)) as http:
+        ...  # use the client module as usual, with client=http
+    cassette.save("responses.cassette")
+
+Replaying (no servers needed), at the original speed or any multiple of it (0 for no waiting at all):
+
+    cassette = Cassette.load("responses.cassette")
+    async with httpx.AsyncClient(transport=ReplayTransport(cassette, latency_scale=0.5)) as http:
+        ...
+
+Requests are matched by a hash of their method, path, query, and body (not the host, so cassettes
+can be replayed against any server URL). If the same request was recorded several times (like a retried
+request that failed first), the responses are replayed in the same order, and the last one repeats after that.
+"""
+
+import asyncio
+import dataclasses
+import hashlib
+import json
+import os
+import tempfile
+import time
+import zipfile
+from typing import Dict, List, Optional
+
+import httpx
+
+from ctakesclient.exceptions import ClientError, FileError
+
+_FORMAT = "ctakesclient-cassette"
+_VERSION = 1
+_INDEX_NAME = "cassette.json"
+
+# The recorded body is already decoded, so these no longer describe it
+_DROPPED_HEADERS = {"content-encoding", "content-length", "transfer-encoding", "connection", "keep-alive"}
+
+
+def request_key(request: httpx.Request) -> str:
+    """
+    :param request: an HTTP request (with its body already read)
+    :return: hash identifying the request in a cassette
+    """
+    digest = hashlib.sha256()
+    for part in (request.method.encode("ascii"), request.url.raw_path, request.content):
+        digest.update(len(part).to_bytes(8, "little"))
+        digest.update(part)
+    return digest.hexdigest()
+
+
+@dataclasses.dataclass
+class Interaction:
+    """One recorded response"""
+
+    method: str
+    url: str
+    status: int
+    headers: List[List[str]]
+    content: bytes
+    elapsed: float  # seconds from sending the request to having the whole response
+
+    def to_response(self, request: httpx.Request) -> httpx.Response:
+        return httpx.Response(self.status, headers=self.headers, content=self.content, request=request)
+
+
+class Cassette:
+    """Recorded responses, keyed by `request_key`"""
+
+    def __init__(self):
+        self.interactions: Dict[str, List[Interaction]] = {}
+        self._replayed: Dict[str, int] = {}  # key -> times replayed so far
+
+    def __len__(self) -> int:
+        return sum(len(recorded) for recorded in self.interactions.values())
+
+    def record(self, key: str, interaction: Interaction) -> None:
+        self.interactions.setdefault(key, []).append(interaction)
+
+    def next_interaction(self, key: str) -> Optional[Interaction]:
+        """
+        :param key: `request_key` of a request
+        :return: the response to replay for it (responses to repeated requests are replayed in order)
+        """
+        recorded = self.interactions.get(key)
+        if not recorded:
+            return None
+        count = self._replayed.get(key, 0)
+        self._replayed[key] = count + 1
+        return recorded[min(count, len(recorded) - 1)]
+
+    def rewind(self) -> None:
+        """Starts replaying from the first recorded responses again"""
+        self._replayed.clear()
+
+    ###########################################################################
+    #
+    # Archive files: a zip with an index and one deflated file per distinct response body
+    #
+    ###########################################################################
+
+    def save(self, path: str) -> None:
+        """
+        :param path: where to write the cassette (replaced atomically)
+        """
+        bodies = {}
+        index = {}
+        for key, recorded in self.interactions.items():
+            index[key] = []
+            for interaction in recorded:
+                body = hashlib.sha256(interaction.content).hexdigest()
+                bodies[body] = interaction.content
+                entry = dataclasses.asdict(interaction)
+                entry["content"] = body
+                index[key].append(entry)
+
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f, zipfile.ZipFile(f, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+                header = {"format": _FORMAT, "version": _VERSION, "interactions": index}
+                archive.writestr(_INDEX_NAME, json.dumps(header))
+                for body, content in bodies.items():
+                    archive.writestr(f"bodies/{body}", content)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    @classmethod
+    def load(cls, path: str) -> "Cassette":
+        """
+        :param path: a file written by `save`
+        :return: loaded cassette
+        """
+        try:
+            with zipfile.ZipFile(path) as archive:
+                header = json.loads(archive.read(_INDEX_NAME))
+                if header.get("format") != _FORMAT or header.get("version") != _VERSION:
+                    raise FileError(f"{path} is not a version {_VERSION} cassette")
+                bodies = {}
+                cassette = cls()
+                for key, recorded in header["interactions"].items():
+                    for entry in recorded:
+                        body = entry["content"]
+                        if body not in bodies:
+                            bodies[body] = archive.read(f"bodies/{body}")
+                        cassette.record(key, Interaction(**{**entry, "content": bodies[body]}))
+        except (zipfile.BadZipFile, KeyError) as exc:
+            raise FileError(f"{path} is not a cassette: {exc}") from exc
+        return cassette
+
+
+###############################################################################
+#
+# Transports
+#
+###############################################################################
+
+
+class RecordingTransport(httpx.AsyncBaseTransport):
+    """An httpx transport that passes requests on to a real one, recording every response into a cassette"""
+
+    def __init__(self, cassette: Cassette, transport: httpx.AsyncBaseTransport = None):
+        """
+        :param cassette: where to record responses
+        :param transport: transport that actually sends requests (default: a regular httpx transport)
+        """
+        self.cassette = cassette
+        self.transport = transport or httpx.AsyncHTTPTransport()
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        await request.aread()  # for request_key
+        tic = time.perf_counter()
+        response = await self.transport.handle_async_request(request)
+        try:
+            body = await response.aread()
+        finally:
+            await response.aclose()
+        elapsed = time.perf_counter() - tic
+
+        headers = [[name, value] for name, value in response.headers.multi_items() if name not in _DROPPED_HEADERS]
+        interaction = Interaction(request.method, str(request.url), response.status_code, headers, body, elapsed)
+        self.cassette.record(request_key(request), interaction)
+        return interaction.to_response(request)
+
+    async def aclose(self) -> None:
+        await self.transport.aclose()
+
+
+class ReplayTransport(httpx.AsyncBaseTransport):
+    """An httpx transport that answers from a cassette, never touching the network"""
+
+    def __init__(self, cassette: Cassette, latency_scale: float = 1):
+        """
+        :param cassette: recorded responses
+        :param latency_scale: multiplier for the recorded response times (0 answers right away)
+        """
+        self.cassette = cassette
+        self.latency_scale = latency_scale
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        await request.aread()
+        interaction = self.cassette.next_interaction(request_key(request))
+        if interaction is None:
+            raise ClientError(f"no recorded response for {request.method} {request.url}")
+        delay = interaction.elapsed * self.latency_scale
+        if delay > 0:
+            await asyncio.sleep(delay)
+        return interaction.to_response(request)
@@ -0,0 +1,400 @@
+"""
+Command line interface, like: ctakesclient extract notes.csv results.ndjson
+
+Also: ctakesclient stub-server (a stand-in for cTAKES and cNLP, see `ctakesclient.stubserver`)
+
+Run `ctakesclient --help` (or `python -m ctakesclient --help`) for all the options.
+"""
+
+import argparse
+import asyncio
+import csv
+import hashlib
+import json
+import logging
+import os
+import random
+import sys
+import time
+from typing import Iterator, List, Optional, TextIO
+
+import httpx
+
+from ctakesclient import cassette, client, filesystem, metrics, stubserver, transformer
+from ctakesclient.bulkexport import BulkExportWriter
+from ctakesclient.prefilter import TermMatcher
+from ctakesclient.store import ResultStore
+from ctakesclient.typesystem import CtakesJSON
+
+###############################################################################
+#
+# Reading notes
+#
+###############################################################################
+
+
+def iter_notes(path: str, id_field: str = "id", text_field: str = "text") -> Iterator[dict]:
+    """
+    Reads notes from a folder of text files, a CSV file, or an NDJSON file
+
+    :param path: folder (one note per file, the note id is the file name), CSV file, or NDJSON file
+    :param id_field: CSV column or JSON field holding the note id
+    :param text_field: CSV column or JSON field holding the note text
+    :return: every note as a dict, with the note id in "note_id" and the text in "text" (plus any other fields)
+    """
+    if os.path.isdir(path):
+        for name in sorted(os.listdir(path)):
+            full_path = os.path.join(path, name)
+            if os.path.isfile(full_path):
+                with open(full_path, "r", encoding="utf8") as f:
+                    yield {"note_id": name, "text": f.read()}
+        return
+
+    with open(path, "r", encoding="utf8", newline="") as f:
+        if path.endswith(".csv"):
+            rows = csv.DictReader(f)
+        else:
+            rows = (json.loads(line) for line in f if line.strip())
+        for row in rows:
+            yield {**row, "note_id": str(row[id_field]), "text": row[text_field]}
+
+
+###############################################################################
+#
+# Live progress display
+#
+###############################################################################
+
+
+class Stats:
+    """Running throughput and latency numbers, drawn on stderr"""
+
+    _LATENCY_SAMPLES = 1000
+
+    def __init__(self, stream: TextIO = sys.stderr):
+        self.stream = stream
+        self.done = 0
+        self.skipped = 0  # already in the output from an earlier run
+        self.cached = 0
+        self.failed = 0
+        self.retries = 0
+        self._latencies: List[float] = []
+        self._started = time.monotonic()
+        self._last_drawn = 0.0
+
+    def record(self, seconds: float) -> None:
+        self.done += 1
+        if len(self._latencies) >= self._LATENCY_SAMPLES:
+            self._latencies[random.randrange(self._LATENCY_SAMPLES)] = seconds  # keep a rough sample
+        else:
+            self._latencies.append(seconds)
+
+    def line(self) -> str:
+        elapsed = time.monotonic() - self._started
+        latencies = sorted(self._latencies)
+
+        def percentile(fraction: float) -> str:
+            return f"{latencies[int(fraction * (len(latencies) - 1))]:.2f}s" if latencies else "-"
+
+        return (
+            f"{self.done} done ({self.done / elapsed if elapsed else 0:.1f}/s), {self.cached} cached, "
+            f"{self.skipped} skipped, {self.failed} failed, {self.retries} retries | "
+            f"latency p50 {percentile(0.5)} p95 {percentile(0.95)}"
+        )
+
+    def draw(self, force: bool = False) -> None:
+        now = time.monotonic()
+        interactive = self.stream.isatty()
+        if not force and now - self._last_drawn < (0.5 if interactive else 10):
+            return
+        self._last_drawn = now
+        self.stream.write(f"\r\x1b[K{self.line()}" if interactive else f"{self.line()}\n")
+        self.stream.flush()
+
+
+###############################################################################
+#
+# Extraction
+#
+###############################################################################
+
+_POLARITY_MODELS = {
+    "negation": transformer.TransformerModel.NEGATION,
+    "termexists": transformer.TransformerModel.TERM_EXISTS,
+}
+
+
+def _is_retryable(error: Exception) -> bool:
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code == 429 or error.response.status_code >= 500
+    return isinstance(error, httpx.TransportError)
+
+
+class Extractor:
+    """Runs one `extract` command"""
+
+    def __init__(self, args: argparse.Namespace, http: httpx.AsyncClient, stats: Stats):
+        self.args = args
+        self.http = http
+        self.stats = stats
+        self.prefilter = None
+        if args.prefilter:
+            self.prefilter = TermMatcher.from_concepts(filesystem.iter_bsv(args.prefilter, filesystem.BsvConcept))
+
+    async def _with_retries(self, endpoint: str, call):
+        for attempt in range(self.args.retries + 1):
+            try:
+                return await call()
+            except httpx.HTTPError as error:
+                if attempt == self.args.retries or not _is_retryable(error):
+                    raise
+                self.stats.retries += 1
+                metrics.retry(endpoint, error)
+                delay = self.args.backoff * 2**attempt
+                await asyncio.sleep(delay + random.uniform(0, delay))  # jitter keeps retries from bunching up
+
+    async def extract(self, text: str) -> CtakesJSON:
+        ner = await self._with_retries(
+            "ctakes",
+            lambda: client.extract(
+                text,
+                url=self.args.ctakes_url,
+                client=self.http,
+                prefilter=self.prefilter,
+                prefilter_paragraphs=self.args.prefilter_paragraphs,
+            ),
+        )
+
+        if self.args.polarity != "ctakes":
+            matches = ner.list_match()
+            if matches:
+                model = _POLARITY_MODELS[self.args.polarity]
+                polarities = await self._with_retries(
+                    model.value,
+                    lambda: transformer.list_polarity(
+                        text,
+                        ner.list_spans(matches),
+                        url=self.args.cnlp_url,
+                        client=self.http,
+                        model=model,
+                    ),
+                )
+                for match, polarity in zip(matches, polarities):
+                    match.polarity = polarity
+        return ner
+
+    def cache_key(self, text: str) -> str:
+        settings = [self.args.polarity, self.args.prefilter or "", str(self.args.prefilter_paragraphs)]
+        return hashlib.sha256("\0".join([*settings, text]).encode("utf8")).hexdigest()
+
+    async def process(self, note: dict, output: ResultStore, cache: Optional[ResultStore], fhir) -> None:
+        tic = time.monotonic()
+        key = self.cache_key(note["text"]) if cache is not None else None
+        ctakes_json = cache.get_json(key) if cache is not None else None
+        if ctakes_json is not None:
+            self.stats.cached += 1
+            ner = CtakesJSON(ctakes_json)
+        else:
+            ner = await self.extract(note["text"])
+            ctakes_json = ner.as_json()
+            if cache is not None:
+                cache.append_json(key, ctakes_json)
+
+        if fhir is not None:
+            subject_id = note[self.args.subject_field]
+            encounter_id = note[self.args.encounter_field]
+            fhir.write_nlp(subject_id, encounter_id, note["note_id"], ner, deterministic_id=True)
+        output.append_json(note["note_id"], ctakes_json)  # last, since a note in the output counts as done
+        self.stats.record(time.monotonic() - tic)
+
+    async def worker(self, queue: asyncio.Queue, output: ResultStore, cache: Optional[ResultStore], fhir) -> None:
+        while True:
+            note = await queue.get()
+            try:
+                await self.process(note, output, cache, fhir)
+            except Exception as error:  # pylint: disable=broad-except
+                self.stats.failed += 1
+                logging.error("note %s failed: %s", note["note_id"], error)
+            finally:
+                queue.task_done()
+                self.stats.draw()
+
+
+async def run_extract(args: argparse.Namespace) -> int:
+    """
+    :return: exit code (0 if every note was extracted)
+    """
+    if os.path.exists(args.output) and not args.resume:
+        logging.error("%s already exists, use --continue to add to it", args.output)
+        return 2
+
+    stats = Stats()
+    collector = metrics.MetricsCollector() if args.metrics else None
+    if collector is not None:
+        metrics.add_hook(collector)
+    try:
+        return await _run_extract(args, stats)
+    finally:
+        if collector is not None:
+            metrics.remove_hook(collector)
+            collector.write_prometheus(args.metrics)
+
+
+async def _run_extract(args: argparse.Namespace, stats: Stats) -> int:
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    queue = asyncio.Queue(maxsize=args.concurrency * 2)
+
+    transport = httpx.AsyncHTTPTransport(limits=limits)
+    recording = None
+    if args.replay:
+        transport = cassette.ReplayTransport(cassette.Cassette.load(args.replay), args.replay_latency_scale)
+    elif args.record:
+        recording = cassette.Cassette()
+        transport = cassette.RecordingTransport(recording, transport)
+
+    try:
+        return await _extract_all(args, stats, transport, queue)
+    finally:
+        if recording is not None:
+            recording.save(args.record)
+
+
+async def _extract_all(
+    args: argparse.Namespace, stats: Stats, transport: httpx.AsyncBaseTransport, queue: asyncio.Queue
+) -> int:
+    async with httpx.AsyncClient(transport=transport, timeout=args.timeout) as http:
+        extractor = Extractor(args, http, stats)
+        with ResultStore(args.output) as output:
+            cache = ResultStore(args.cache) if args.cache else None
+            fhir = BulkExportWriter(args.fhir) if args.fhir else None
+            workers = [
+                asyncio.create_task(extractor.worker(queue, output, cache, fhir)) for _ in range(args.concurrency)
+            ]
+            try:
+                for note in iter_notes(args.input, id_field=args.id_field, text_field=args.text_field):
+                    if note["note_id"] in output:
+                        stats.skipped += 1  # resumed run
+                        continue
+                    await queue.put(note)
+                await queue.join()
+            finally:
+                for worker in workers:
+                    worker.cancel()
+                if cache is not None:
+                    cache.close()
+                if fhir is not None:
+                    fhir.close()
+
+    stats.draw(force=True)
+    stats.stream.write("\n")
+    return 1 if stats.failed else 0
+
+
+###############################################################################
+#
+# Stub server
+#
+###############################################################################
+
+
+async def run_stub_server(args: argparse.Namespace) -> int:
+    """
+    :return: exit code (only returns if the servers fail)
+    """
+    options = {
+        "fixture": filesystem.read_json(args.fixture) if args.fixture else None,
+        "concepts": filesystem.list_bsv_concept(args.dictionary) if args.dictionary else None,
+        "latency": stubserver.lognormal_latency(args.latency, args.latency_sigma, args.latency_per_1k_chars),
+        "error_rate": args.error_rate,
+        "max_concurrency": args.max_concurrency,
+    }
+    servers = [stubserver.StubServer(args.host, port, **options) for port in args.port or [8080]]
+    for server in servers:
+        await server.start()
+        print(f"Stub server listening on {server.base_url}", file=sys.stderr, flush=True)
+    await asyncio.gather(*(server.serve_forever() for server in servers))
+    return 1
+
+
+###############################################################################
+#
+# Argument parsing
+#
+###############################################################################
+
+
+def make_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="ctakesclient", description="Bulk clinical NLP with cTAKES (and cNLP)")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    extract = subparsers.add_parser("extract", help="extract concepts from many notes")
+    extract.add_argument("input", help="folder of text files, CSV file, or NDJSON file of notes")
+    extract.add_argument("output", help="NDJSON file of results (see ctakesclient.store.ResultStore)")
+
+    group = extract.add_argument_group("input")
+    group.add_argument("--id-field", default="id", help="CSV column or JSON field with the note id (default: id)")
+    group.add_argument("--text-field", default="text", help="CSV column or JSON field with the text (default: text)")
+
+    group = extract.add_argument_group("servers")
+    group.add_argument("--ctakes-url", help="cTAKES REST URL (default: $URL_CTAKES_REST or localhost)")
+    group.add_argument("--cnlp-url", help="cNLP transformer URL (default: $URL_CNLP_NEGATION or similar)")
+    group.add_argument(
+        "--polarity",
+        choices=["ctakes", "negation", "termexists"],
+        default="ctakes",
+        help="where mention polarity comes from: cTAKES itself, or a cNLP transformer model (default: ctakes)",
+    )
+    group.add_argument("--concurrency", type=int, default=4, help="notes to process at once (default: 4)")
+    group.add_argument("--timeout", type=float, default=300, help="seconds to wait for each request (default: 300)")
+    group.add_argument("--retries", type=int, default=3, help="retries for failed requests (default: 3)")
+    group.add_argument("--backoff", type=float, default=1, help="seconds before the first retry, doubling each time")
+    group.add_argument("--record", metavar="PATH", help="record server responses into this cassette file")
+    group.add_argument("--replay", metavar="PATH", help="answer from this recorded cassette instead of the servers")
+    group.add_argument(
+        "--replay-latency-scale",
+        type=float,
+        default=1,
+        help="with --replay, multiplier for the recorded response times (default: 1, 0 to not wait)",
+    )
+
+    group = extract.add_argument_group("output")
+    group.add_argument("-c", "--continue", dest="resume", action="store_true", help="skip notes already in output")
+    group.add_argument("--cache", metavar="PATH", help="result cache keyed by note text, shared between runs")
+    group.add_argument("--fhir", metavar="DIR", help="also write FHIR resources as bulk-export NDJSON files")
+    group.add_argument("--subject-field", default="subject_id", help="field with the patient id (for --fhir)")
+    group.add_argument("--encounter-field", default="encounter_id", help="field with the encounter id (for --fhir)")
+    group.add_argument("--metrics", metavar="PATH", help="write timing metrics here, in the Prometheus text format")
+
+    group = extract.add_argument_group("prefilter")
+    group.add_argument("--prefilter", metavar="BSV", help="only send notes holding a term from this BSV dictionary")
+    group.add_argument("--prefilter-paragraphs", action="store_true", help="only send paragraphs holding a term")
+
+    stub = subparsers.add_parser("stub-server", help="run a stand-in for cTAKES and cNLP, for testing")
+    stub.add_argument("--host", default="127.0.0.1", help="interface to listen on (default: 127.0.0.1)")
+    stub.add_argument("--port", type=int, action="append", help="port to listen on, can be repeated (default: 8080)")
+    stub.add_argument("--fixture", metavar="JSON", help="answer every cTAKES request with this cTAKES response")
+    stub.add_argument("--dictionary", metavar="BSV", help="concepts to find in notes (default: COVID symptoms)")
+    stub.add_argument("--latency", type=float, default=0, help="median seconds per request (default: 0)")
+    stub.add_argument("--latency-sigma", type=float, default=0.5, help="spread of the latency (0 for constant)")
+    stub.add_argument("--latency-per-1k-chars", type=float, default=0, help="extra median seconds per 1000 chars")
+    stub.add_argument("--error-rate", type=float, default=0, help="fraction of requests to fail (default: 0)")
+    stub.add_argument("--max-concurrency", type=int, help="requests to work on at once (default: no limit)")
+    return parser
+
+
+def main(argv: List[str] = None) -> int:
+    """
+    :param argv: command line arguments (default: sys.argv)
+    :return: exit code
+    """
+    args = make_parser().parse_args(argv)
+    logging.basicConfig(format="%(levelname)s: %(message)s")
+    if args.command == "stub-server":
+        try:
+            return asyncio.run(run_stub_server(args))
+        except KeyboardInterrupt:
+            return 0
+    if args.concurrency < 1:
+        logging.error("--concurrency must be at least 1")
+        return 2
+    return asyncio.run(run_extract(args))
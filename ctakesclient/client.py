@@ -1,10 +1,14 @@
 """HTTP client for medical language"""
 
+import bisect
 import os
 import logging
+from typing import List, Tuple
 
 import httpx
 
+from ctakesclient import metrics
+from ctakesclient.prefilter import TermMatcher
 from ctakesclient.typesystem import CtakesJSON
 
 ###############################################################################
@@ -15,6 +19,8 @@ from ctakesclient.typesystem import CtakesJSON
 #
 ###############################################################################
 
+_PARAGRAPH_SEPARATOR = "\n\n"
+
 
 def get_url_ctakes_rest() -> str:
     """
@@ -43,29 +49,86 @@ async def post(sentence: str, url: str = None, client: httpx.AsyncClient = None)
     url = url or get_url_ctakes_rest()
     client = client or httpx.AsyncClient()
     logging.debug(url)
-    response = await client.post(
+    return await metrics.post_json(
+        client,
+        "ctakes",
         url,
+        len(sentence),
         content=sentence.encode("utf8"),
         headers={
             "Content-Type": "text/plain; charset=UTF-8",
         },
     )
-    response.raise_for_status()
-    return response.json()
 
 
-async def extract(sentence: str, url: str = None, client: httpx.AsyncClient = None) -> CtakesJSON:
+async def extract(
+    sentence: str,
+    url: str = None,
+    client: httpx.AsyncClient = None,
+    prefilter: TermMatcher = None,
+    prefilter_paragraphs: bool = False,
+) -> CtakesJSON:
     """
     Send clinical text to cTAKES for analysis and packages the response up for you
 
+    If you only care about a specific dictionary of terms, pass a `prefilter` built from it.
+    Text that holds none of its terms is then never sent to cTAKES, and gets an empty result instead.
+
     :param sentence: clinical text to send to cTAKES
     :param url: cTAKES REST server fully qualified path
     :param client: optional existing HTTPX client session
+    :param prefilter: optional dictionary pre-screen, to skip text that can't hold any interesting terms
+    :param prefilter_paragraphs: with a prefilter, send only the paragraphs holding a term, rather than the whole text
     :return: CtakesJSON wrapper
     """
+    if prefilter is not None:
+        if prefilter_paragraphs:
+            return await _extract_paragraphs(sentence, prefilter.select_paragraphs(sentence), url=url, client=client)
+        if not prefilter.contains_any(sentence):
+            return CtakesJSON()
+
     response = await post(sentence, url=url, client=client)
+    tic = metrics.start()
     ner = CtakesJSON(response)
+    metrics.stage("parse", tic)
+    tic = metrics.start()
     _adjust_character_indexes(sentence, ner)  # Fix Java character indexes into Python ones
+    metrics.stage("adjust_offsets", tic)
+    return ner
+
+
+async def _extract_paragraphs(
+    sentence: str, paragraphs: List[Tuple[int, int]], url: str = None, client: httpx.AsyncClient = None
+) -> CtakesJSON:
+    """
+    Sends only the given paragraphs of the text to cTAKES (in one request), with spans pointing into the full text
+
+    :param sentence: clinical text
+    :param paragraphs: (begin, end) spans of the paragraphs to send
+    :param url: cTAKES REST server fully qualified path
+    :param client: optional existing HTTPX client session
+    :return: CtakesJSON wrapper
+    """
+    if not paragraphs:
+        return CtakesJSON()
+
+    # Join the paragraphs, remembering where each one landed, to map spans back afterwards
+    excerpt_begins = []
+    shifts = []
+    excerpt = []
+    length = 0
+    for begin, end in paragraphs:
+        excerpt_begins.append(length)
+        shifts.append(begin - length)
+        excerpt.append(sentence[begin:end])
+        length += end - begin + len(_PARAGRAPH_SEPARATOR)
+    excerpt = _PARAGRAPH_SEPARATOR.join(excerpt)
+
+    ner = await extract(excerpt, url=url, client=client)
+    for match in ner.list_match():
+        shift = shifts[bisect.bisect_right(excerpt_begins, match.begin) - 1]
+        match.begin += shift
+        match.end += shift
     return ner
 
 
@@ -0,0 +1,218 @@
+"""Persistent, indexed concept dictionary built from BSV files"""
+
+import contextlib
+import hashlib
+import logging
+import os
+import sqlite3
+import tempfile
+from typing import List, Optional
+
+from ctakesclient import filesystem
+from ctakesclient.filesystem import BsvConcept
+
+###############################################################################
+#
+# SQLite store of BsvConcept rows (CUI|TUI|CODE|VOCAB|TXT|PREF)
+#
+# The store is built once from the BSV file and then re-used across runs.
+# It is rebuilt automatically whenever the source BSV changes.
+#
+###############################################################################
+
+_SCHEMA_VERSION = "1"
+_INSERT_BATCH_SIZE = 10000
+
+
+def _hash_file(filename: str) -> str:
+    """
+    :param filename: file to hash
+    :return: sha256 hex digest of the file contents
+    """
+    digest = hashlib.sha256()
+    with open(filename, "rb") as fp:
+        for chunk in iter(lambda: fp.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ConceptDictionary:
+    """
+    Indexed lookups of UMLS concepts from a BSV file, backed by a single-file SQLite database
+
+    Parsing a large BSV dictionary is slow, so the parsed rows are kept in a SQLite file next to the
+    BSV (by default, "concepts.bsv" is stored in "concepts.bsv.sqlite"). Later runs open that file directly.
+
+    The store is rebuilt if the BSV file changes. The size and mtime are checked on every open,
+    and the (slower) content hash is only checked if those differ.
+    """
+
+    def __init__(self, bsv_path: str, db_path: str = None):
+        """
+        :param bsv_path: BSV file of concepts, where rows are CUI|TUI|CODE|VOCAB|TXT|PREF
+        :param db_path: optional path for the SQLite store, default = bsv_path + ".sqlite"
+        """
+        self.bsv_path = bsv_path
+        self.db_path = db_path or f"{bsv_path}.sqlite"
+
+        if not self._is_fresh():
+            self.rebuild()
+
+        self._conn = sqlite3.connect(self.db_path)
+
+    ###########################################################################
+    #
+    # Lookups
+    #
+    ###########################################################################
+
+    def by_cui(self, cui: str) -> List[BsvConcept]:
+        return self._select("cui = ?", (cui,))
+
+    def by_tui(self, tui: str) -> List[BsvConcept]:
+        return self._select("tui = ?", (tui,))
+
+    def by_code(self, code: str, vocab: str = None) -> List[BsvConcept]:
+        """
+        :param code: vocabulary CODE
+        :param vocab: optional vocab to restrict to (like SNOMEDCT_US), since codes are only unique per vocab
+        :return: concepts with that code
+        """
+        if vocab is None:
+            return self._select("code = ?", (code,))
+        return self._select("code = ? AND vocab = ?", (code, vocab))
+
+    def by_vocab(self, vocab: str) -> List[BsvConcept]:
+        return self._select("vocab = ?", (vocab,))
+
+    def by_text(self, text: str) -> List[BsvConcept]:
+        """
+        :param text: string representation to look up (case-insensitive)
+        :return: concepts with that text
+        """
+        return self._select("text = ? COLLATE NOCASE", (text,))
+
+    def pref(self, cui: str) -> Optional[str]:
+        """
+        :param cui: CUI to look up
+        :return: preferred term for the CUI (like `filesystem.map_cui_pref`, the last row wins), or None if not found
+        """
+        query = "SELECT pref FROM concept WHERE cui = ? ORDER BY rowid DESC LIMIT 1"
+        row = self._conn.execute(query, (cui,)).fetchone()
+        return row[0].strip() if row else None
+
+    def __len__(self) -> int:
+        return self._conn.execute("SELECT COUNT(*) FROM concept").fetchone()[0]
+
+    def _select(self, where: str, params: tuple) -> List[BsvConcept]:
+        query = f"SELECT cui, tui, code, vocab, text, pref FROM concept WHERE {where} ORDER BY rowid"  # nosec
+        return [BsvConcept(*row) for row in self._conn.execute(query, params)]
+
+    ###########################################################################
+    #
+    # Building the store
+    #
+    ###########################################################################
+
+    def _read_meta(self) -> dict:
+        if not os.path.exists(self.db_path):
+            return {}
+        try:
+            with contextlib.closing(sqlite3.connect(self.db_path)) as conn:
+                return dict(conn.execute("SELECT key, value FROM meta"))
+        except sqlite3.DatabaseError:
+            return {}  # corrupt or not ours, we'll rebuild it
+
+    def _is_fresh(self) -> bool:
+        """
+        :return: whether the SQLite store exists and matches the current BSV file
+        """
+        meta = self._read_meta()
+        if meta.get("schema") != _SCHEMA_VERSION:
+            return False
+
+        stat = os.stat(self.bsv_path)
+        if meta.get("size") == str(stat.st_size) and meta.get("mtime_ns") == str(stat.st_mtime_ns):
+            return True
+
+        # File was touched -- but did it really change?
+        if meta.get("sha256") != _hash_file(self.bsv_path):
+            return False
+
+        logging.info("BSV mtime changed but contents did not, keeping %s", self.db_path)
+        with contextlib.closing(sqlite3.connect(self.db_path)) as conn:
+            with conn:  # commits the transaction
+                conn.executemany("REPLACE INTO meta VALUES (?, ?)", self._stat_meta(stat).items())
+        return True
+
+    @staticmethod
+    def _stat_meta(stat: os.stat_result) -> dict:
+        return {"size": str(stat.st_size), "mtime_ns": str(stat.st_mtime_ns)}
+
+    def rebuild(self) -> None:
+        """
+        Parses the BSV file into a fresh SQLite store, replacing any old store atomically
+        """
+        logging.info("building concept dictionary %s from %s", self.db_path, self.bsv_path)
+
+        conn = getattr(self, "_conn", None)
+        if conn:
+            conn.close()
+
+        stat = os.stat(self.bsv_path)
+        # A unique temp file in the same directory, so concurrent rebuilds don't collide and the rename is atomic
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.db_path)), suffix=".tmp")
+        os.close(fd)
+        try:
+            self._build(tmp_path, stat)
+            os.replace(tmp_path, self.db_path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+        if conn:
+            self._conn = sqlite3.connect(self.db_path)
+
+    def _build(self, tmp_path: str, stat: os.stat_result) -> None:
+        with contextlib.closing(sqlite3.connect(tmp_path)) as tmp:
+            with tmp:  # commits the transaction
+                tmp.execute("PRAGMA journal_mode = OFF")
+                tmp.execute("PRAGMA synchronous = OFF")
+                tmp.execute("CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)")
+                tmp.execute("CREATE TABLE concept (cui TEXT, tui TEXT, code TEXT, vocab TEXT, text TEXT, pref TEXT)")
+
+                batch = []
+                for bsv in filesystem.iter_bsv(self.bsv_path, BsvConcept):
+                    batch.append((bsv.cui, bsv.tui, bsv.code, bsv.vocab, bsv.text, bsv.pref))
+                    if len(batch) >= _INSERT_BATCH_SIZE:
+                        tmp.executemany("INSERT INTO concept VALUES (?, ?, ?, ?, ?, ?)", batch)
+                        batch = []
+                tmp.executemany("INSERT INTO concept VALUES (?, ?, ?, ?, ?, ?)", batch)
+
+                # Indexes are much cheaper to build once at the end than to maintain during the inserts
+                tmp.execute("CREATE INDEX idx_cui ON concept (cui)")
+                tmp.execute("CREATE INDEX idx_tui ON concept (tui)")
+                tmp.execute("CREATE INDEX idx_code ON concept (code, vocab)")
+                tmp.execute("CREATE INDEX idx_vocab ON concept (vocab)")
+                tmp.execute("CREATE INDEX idx_text ON concept (text COLLATE NOCASE)")
+
+                meta = self._stat_meta(stat)
+                meta["schema"] = _SCHEMA_VERSION
+                meta["sha256"] = _hash_file(self.bsv_path)
+                meta["source"] = os.path.abspath(self.bsv_path)
+                tmp.executemany("INSERT INTO meta VALUES (?, ?)", meta.items())
+
+    ###########################################################################
+    #
+    # Lifecycle
+    #
+    ###########################################################################
+
+    def close(self) -> None:
+        self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -1,24 +1,42 @@
 """File loading and parsing"""
 
-from typing import List, Union
+from typing import Dict, Iterator, List, Mapping, Optional, Tuple, Union
+import concurrent.futures
+import functools
 import logging
 import json
+import mmap
 import os
+import struct
+import sys
+import tempfile
+import types
 from ctakesclient.exceptions import BSVError
+from ctakesclient.typesystem import CtakesJSON, MatchText
 
 ###############################################################################
 # Filetype: *.bsv
 #
 # BSV = Bar|Separated|Value
 #
+# Dictionaries can have millions of rows, so rows are kept compact:
+# __slots__ instead of a per-row __dict__, and the low-cardinality columns
+# (vocab, TUI, semantic group) are interned so every row shares one copy.
+#
 ###############################################################################
 
 
+def _intern(value):
+    return sys.intern(value) if isinstance(value, str) else value
+
+
 class BsvConcept:
     """
     BSV flat file of UMLS Concept
     """
 
+    __slots__ = ("cui", "tui", "code", "vocab", "text", "pref")
+
     def __init__(self, cui=None, tui=None, code=None, vocab=None, text=None, pref=None):
         """
         BSV file format =
@@ -36,20 +54,27 @@ class BsvConcept:
                      https://www.nlm.nih.gov/research/umls/new_users/online_learning/Meta_004.html
         """
         self.cui = cui
-        self.tui = tui
+        self.tui = _intern(tui)
         self.code = code
-        self.vocab = vocab
+        self.vocab = _intern(vocab)
         self.text = text
         self.pref = pref
 
     def as_json(self):
-        return self.__dict__
+        return {
+            "cui": self.cui,
+            "tui": self.tui,
+            "code": self.code,
+            "vocab": self.vocab,
+            "text": self.text,
+            "pref": self.pref,
+        }
 
     def from_json(self, source):
         self.cui = source.get("cui")
-        self.tui = source.get("tui")
+        self.tui = _intern(source.get("tui"))
         self.code = source.get("code")
-        self.vocab = source.get("vocab")
+        self.vocab = _intern(source.get("vocab"))
         self.text = source.get("text")
         self.pref = source.get("pref")
 
@@ -64,9 +89,9 @@ class BsvConcept:
             raise BSVError(f"from_bsv failed: {source}")
 
         self.cui = source[0]
-        self.tui = source[1]
+        self.tui = _intern(source[1])
         self.code = source[2]
-        self.vocab = source[3]
+        self.vocab = _intern(source[3])
         self.text = source[4]
         self.pref = source[5]
 
@@ -76,6 +101,10 @@ class BsvConcept:
     def __str__(self):
         return self.to_bsv()
 
+    def __reduce__(self):
+        # Pickle as constructor arguments, which is more compact than the default slots state
+        return self.__class__, (self.cui, self.tui, self.code, self.vocab, self.text, self.pref)
+
 
 ###############################################################################
 # Filetype: *.bsv
@@ -92,6 +121,8 @@ class BsvSemanticType:
     https://lhncbc.nlm.nih.gov/ii/tools/MetaMap/documentation/SemanticTypesAndGroups.html
     """
 
+    __slots__ = ("group_id", "group_label", "tui", "tui_label")
+
     def __init__(self, group_id=None, group_label=None, tui=None, tui_label=None):
         """
         :param group_id: UMLS Semantic Group Abbreviation
@@ -99,18 +130,23 @@ class BsvSemanticType:
         :param tui: Term Unique Identifier (of semantic type)
         :param tui_label: TUI label (human readable)
         """
-        self.group_id = group_id
-        self.group_label = group_label
-        self.tui = tui
+        self.group_id = _intern(group_id)
+        self.group_label = _intern(group_label)
+        self.tui = _intern(tui)
         self.tui_label = tui_label
 
     def as_json(self):
-        return self.__dict__
+        return {
+            "group_id": self.group_id,
+            "group_label": self.group_label,
+            "tui": self.tui,
+            "tui_label": self.tui_label,
+        }
 
     def from_json(self, source):
-        self.group_id = source.get("group_id")
-        self.group_label = source.get("group_label")
-        self.tui = source.get("tui")
+        self.group_id = _intern(source.get("group_id"))
+        self.group_label = _intern(source.get("group_label"))
+        self.tui = _intern(source.get("tui"))
         self.tui_label = source.get("tui_label")
 
     def from_bsv(self, source):
@@ -123,9 +159,9 @@ class BsvSemanticType:
         if 4 != len(source):
             raise BSVError(f"from_bsv failed: {source}")
 
-        self.group_id = source[0]
-        self.group_label = source[1]
-        self.tui = source[2]
+        self.group_id = _intern(source[0])
+        self.group_label = _intern(source[1])
+        self.tui = _intern(source[2])
         self.tui_label = source[3]
 
     def to_bsv(self):
@@ -134,6 +170,9 @@ class BsvSemanticType:
     def __str__(self):
         return self.to_bsv()
 
+    def __reduce__(self):
+        return self.__class__, (self.group_id, self.group_label, self.tui, self.tui_label)
+
 
 ###############################################################################
 # FUNCTIONS for file handling
@@ -141,6 +180,22 @@ class BsvSemanticType:
 # File Common Helper functions with INFO logging
 #
 ###############################################################################
+def iter_bsv(filename: str, class_bsv) -> Iterator:
+    """
+    Streams BSV entries one line at a time, without holding the whole file in memory
+
+    :param filename: BSV filename to parse
+    :param class_bsv: what type of BSV resource to construct
+    :return: iterator of BSV entries
+    """
+    logging.info("iter_bsv(%s)", filename)
+    with open(filename, "r", encoding="utf-8") as fp:
+        for line in fp:
+            parsed = _parse_bsv_line(filename, line, class_bsv)
+            if parsed is not None:
+                yield parsed
+
+
 def list_bsv(filename: str, class_bsv) -> list:
     """
     :param filename: BSV filename to parse
@@ -149,19 +204,98 @@ def list_bsv(filename: str, class_bsv) -> list:
     """
     entries = []
     for line in read_text_lines(filename):
-        if not line.strip():
-            pass  # OK (empty line)
-        elif line.startswith("#"):
-            logging.info("found header : %s : %s", line, filename)
-        elif "|" not in line:
-            logging.error("malformed line: %s", line)
-        else:
-            parsed = class_bsv()
-            parsed.from_bsv(line.strip())
+        parsed = _parse_bsv_line(filename, line, class_bsv)
+        if parsed is not None:
             entries.append(parsed)
     return entries
 
 
+def _parse_bsv_line(filename: str, line: str, class_bsv):
+    """
+    :param filename: BSV filename being parsed (for logging)
+    :param line: one raw line of the BSV file
+    :param class_bsv: what type of BSV resource to construct
+    :return: BSV entry, or None if the line holds no entry (blank, header, or malformed)
+    """
+    if not line.strip():
+        pass  # OK (empty line)
+    elif line.startswith("#"):
+        logging.info("found header : %s : %s", line, filename)
+    elif "|" not in line:
+        logging.error("malformed line: %s", line)
+    else:
+        parsed = class_bsv()
+        parsed.from_bsv(line.strip())
+        return parsed
+    return None
+
+
+def split_byte_ranges(filename: str, count: int) -> List[Tuple[int, int]]:
+    """
+    Splits a file into roughly equal byte ranges, each starting and ending on a line boundary
+
+    :param filename: file to split
+    :param count: how many ranges to aim for (small files may get fewer)
+    :return: list of (start, end) byte offsets, in file order, covering the whole file
+    """
+    size = os.path.getsize(filename)
+    boundaries = [0]
+    with open(filename, "rb") as fp:
+        for i in range(1, max(count, 1)):
+            fp.seek(max(size * i // count, boundaries[-1]))
+            fp.readline()  # skip ahead to the start of the next line
+            boundary = min(fp.tell(), size)
+            if boundary > boundaries[-1]:
+                boundaries.append(boundary)
+    if size > boundaries[-1] or len(boundaries) == 1:
+        boundaries.append(size)
+    return list(zip(boundaries, boundaries[1:]))
+
+
+def _list_bsv_range(filename: str, start: int, end: int, class_bsv) -> list:
+    """
+    Parses the lines of a BSV file that start within the given byte range (used by `list_bsv_parallel` workers)
+
+    :return: BSV entries, in file order
+    """
+    entries = []
+    with open(filename, "rb") as fp:
+        fp.seek(start)
+        while fp.tell() < end:
+            line = fp.readline()
+            if not line:
+                break
+            parsed = _parse_bsv_line(filename, line.decode("utf8"), class_bsv)
+            if parsed is not None:
+                entries.append(parsed)
+    return entries
+
+
+def list_bsv_parallel(filename: str, class_bsv, max_workers: int = None, chunks: int = None) -> list:
+    """
+    Like `list_bsv`, but splits the file into byte ranges and parses them in a pool of processes
+
+    This is worth it for large (multi-GB) files. Rows are parsed exactly like `list_bsv` does
+    and are returned in their original file order.
+
+    :param filename: BSV filename to parse
+    :param class_bsv: what type of BSV resource to construct (must be picklable, like the built-in BSV classes)
+    :param max_workers: number of worker processes, default = number of CPUs
+    :param chunks: number of byte ranges to split the file into, default = 4 per worker
+    :return: list of BSV entries
+    """
+    max_workers = max_workers or os.cpu_count() or 1
+    ranges = split_byte_ranges(filename, chunks or max_workers * 4)
+    logging.info("list_bsv_parallel(%s) : %d ranges", filename, len(ranges))
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as pool:
+        futures = [pool.submit(_list_bsv_range, filename, start, end, class_bsv) for start, end in ranges]
+        entries = []
+        for future in futures:  # in submission order, which is file order
+            entries.extend(future.result())
+    return entries
+
+
 def list_bsv_semantics(filename: str) -> List[BsvSemanticType]:
     return list_bsv(filename, BsvSemanticType)
 
@@ -173,10 +307,12 @@ def list_bsv_concept(filename: str) -> List[BsvConcept]:
 def map_cui_pref(concepts: Union[str, List[BsvConcept]]) -> dict:
     """
     :param concepts: a loaded BSV file, where rows are CUI|TUI|CODE|VOCAB|TXT|PREF, or a filename to load
-    :return: map of {cui:text} labels
+                     (filenames are only parsed once, until the file changes)
+    :return: map of {cui:text} labels (a new dict on every call, so callers may change it)
     """
     if isinstance(concepts, str):
-        concepts = list_bsv_concept(concepts)
+        stat = os.stat(concepts)
+        return dict(_cached_cui_pref(os.path.abspath(concepts), stat.st_mtime_ns, stat.st_size))
 
     cui_map = {}
     for bsv in concepts:
@@ -184,6 +320,187 @@ def map_cui_pref(concepts: Union[str, List[BsvConcept]]) -> dict:
     return cui_map
 
 
+@functools.lru_cache(maxsize=16)
+def _cached_cui_pref(filename: str, mtime_ns: int, size: int) -> Mapping[str, str]:
+    del mtime_ns, size  # only used as part of the cache key
+    return types.MappingProxyType(map_cui_pref(list_bsv_concept(filename)))
+
+
+###############################################################################
+# Filetype: *.bsv.idx
+#
+# Compiled BSV concept index, for read-only lookups that can be memory-mapped
+# and shared between many worker processes through the OS page cache.
+#
+# Layout (all integers are unsigned 64-bit little-endian):
+#   header : magic (8 bytes) | row count N | source size | source mtime (ns)
+#   table  : N+1 byte offsets into the heap, one per row (plus the end)
+#   heap   : UTF-8 rows "CUI|TUI|CODE|VOCAB|TXT|PREF", sorted by CUI
+#
+###############################################################################
+_INDEX_MAGIC = b"CTKBSVI2"
+_INDEX_HEADER = struct.Struct("<8sQQQ")
+_INDEX_OFFSET = struct.Struct("<Q")
+
+
+def compile_bsv_index(bsv_path: str, index_path: str = None) -> str:
+    """
+    Compiles a BSV concept file into a binary index that `BsvConceptIndex` can memory-map
+
+    :param bsv_path: BSV file of concepts, where rows are CUI|TUI|CODE|VOCAB|TXT|PREF
+    :param index_path: optional path for the index, default = bsv_path + ".idx"
+    :return: path of the written index
+    """
+    index_path = index_path or f"{bsv_path}.idx"
+    logging.info("compile_bsv_index(%s) -> %s", bsv_path, index_path)
+
+    stat = os.stat(bsv_path)
+    # sorted() is stable, so rows sharing a CUI keep their original file order
+    rows = sorted((bsv.to_bsv().encode("utf8") for bsv in iter_bsv(bsv_path, BsvConcept)), key=_index_key)
+
+    # A unique temp file in the same directory, so concurrent compiles don't collide and the rename is atomic
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(index_path)), suffix=".tmp")
+    try:
+        with open(fd, "wb") as fp:
+            fp.write(_INDEX_HEADER.pack(_INDEX_MAGIC, len(rows), stat.st_size, stat.st_mtime_ns))
+            offset = 0
+            for row in rows:
+                fp.write(_INDEX_OFFSET.pack(offset))
+                offset += len(row)
+            fp.write(_INDEX_OFFSET.pack(offset))
+            for row in rows:
+                fp.write(row)
+        os.replace(tmp_path, index_path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+    return index_path
+
+
+def _index_key(row: bytes) -> bytes:
+    return row[: row.index(b"|")]
+
+
+class BsvConceptIndex:
+    """
+    Memory-mapped, read-only view of a compiled BSV concept index (see `compile_bsv_index`)
+
+    Lookups binary-search the mapped file directly, so opening an index is instant and costs almost no RAM.
+    Only the rows that match a lookup are turned into `BsvConcept` objects.
+    """
+
+    def __init__(self, index_path: str):
+        """
+        :param index_path: path of a compiled index
+        """
+        self.index_path = index_path
+        with open(index_path, "rb") as fp:
+            if os.fstat(fp.fileno()).st_size < _INDEX_HEADER.size:
+                raise BSVError(f"not a compiled BSV index: {index_path}")
+            self._mmap = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, self._count, self.source_size, self.source_mtime_ns = _INDEX_HEADER.unpack_from(self._mmap, 0)
+        self._table = _INDEX_HEADER.size
+        self._heap = self._table + (self._count + 1) * _INDEX_OFFSET.size
+
+        if magic != _INDEX_MAGIC:
+            self._mmap.close()
+            raise BSVError(f"not a compiled BSV index: {index_path}")
+        if self._heap > len(self._mmap) or self._heap + self._heap_size() != len(self._mmap):
+            self._mmap.close()
+            raise BSVError(f"truncated compiled BSV index: {index_path}")
+
+    def _heap_size(self) -> int:
+        return _INDEX_OFFSET.unpack_from(self._mmap, self._heap - _INDEX_OFFSET.size)[0]
+
+    def __len__(self) -> int:
+        return self._count
+
+    def _row_bounds(self, i: int) -> tuple:
+        start, end = struct.unpack_from("<QQ", self._mmap, self._table + i * _INDEX_OFFSET.size)
+        return self._heap + start, self._heap + end
+
+    def _key(self, i: int) -> bytes:
+        start, end = self._row_bounds(i)
+        end = self._mmap.find(b"|", start, end)
+        return self._mmap[start:end]
+
+    def _first(self, key: bytes) -> int:
+        """Binary search for the first row whose key is >= key"""
+        low, high = 0, self._count
+        while low < high:
+            mid = (low + high) // 2
+            if self._key(mid) < key:
+                low = mid + 1
+            else:
+                high = mid
+        return low
+
+    def by_cui(self, cui: str) -> List[BsvConcept]:
+        """
+        :param cui: CUI to look up
+        :return: all concepts with that CUI, in original file order
+        """
+        key = cui.encode("utf8")
+        found = []
+        i = self._first(key)
+        while i < self._count and self._key(i) == key:
+            start, end = self._row_bounds(i)
+            concept = BsvConcept()
+            concept.from_bsv(self._mmap[start:end].decode("utf8"))
+            found.append(concept)
+            i += 1
+        return found
+
+    def __contains__(self, cui: str) -> bool:
+        key = cui.encode("utf8")
+        i = self._first(key)
+        return i < self._count and self._key(i) == key
+
+    def pref(self, cui: str) -> Optional[str]:
+        """
+        :param cui: CUI to look up
+        :return: preferred term for the CUI (like `map_cui_pref`, the last row wins), or None if not found
+        """
+        concepts = self.by_cui(cui)
+        return concepts[-1].pref.strip() if concepts else None
+
+    def close(self) -> None:
+        self._mmap.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def open_bsv_index(bsv_path: str, index_path: str = None) -> BsvConceptIndex:
+    """
+    Opens the compiled index for a BSV concept file, (re)compiling it first if it is missing, unreadable, or was
+    compiled from a different version of the BSV (compared by size and mtime, like `map_cui_pref`'s cache)
+
+    :param bsv_path: BSV file of concepts, where rows are CUI|TUI|CODE|VOCAB|TXT|PREF
+    :param index_path: optional path for the index, default = bsv_path + ".idx"
+    :return: memory-mapped index
+    """
+    index_path = index_path or f"{bsv_path}.idx"
+    if os.path.exists(index_path):
+        try:
+            index = BsvConceptIndex(index_path)
+        except BSVError:
+            logging.warning("open_bsv_index(%s) unreadable index, recompiling", index_path)
+        else:
+            stat = os.stat(bsv_path)
+            if (index.source_size, index.source_mtime_ns) == (stat.st_size, stat.st_mtime_ns):
+                return index
+            index.close()
+
+    compile_bsv_index(bsv_path, index_path)
+    return BsvConceptIndex(index_path)
+
+
 ###############################################################################
 #
 # File Common Helper functions with INFO logging
@@ -224,8 +541,12 @@ def covid_symptoms_path() -> str:
 
 
 def covid_symptoms() -> List[BsvConcept]:
-    """Returns a list of known covid symptoms"""
-    return list_bsv_concept(covid_symptoms_path())
+    """
+    Returns a list of known covid symptoms
+
+    The file is only parsed once per process, but every call gets its own row objects.
+    """
+    return [BsvConcept(*row) for row in _cached_resource(covid_symptoms_path(), BsvConcept)]
 
 
 def umls_semantic_groups_path() -> str:
@@ -237,6 +558,65 @@ def umls_semantic_groups() -> List[BsvSemanticType]:
     """
     Returns a list of UMLS semantic groups
 
+    The file is only parsed once per process, but every call gets its own row objects.
+
     See https://lhncbc.nlm.nih.gov/ii/tools/MetaMap/documentation/SemanticTypesAndGroups.html
     """
-    return list_bsv_semantics(umls_semantic_groups_path())
+    return [BsvSemanticType(*row) for row in _cached_resource(umls_semantic_groups_path(), BsvSemanticType)]
+
+
+@functools.lru_cache(maxsize=None)
+def _cached_resource(filename: str, class_bsv) -> Tuple[tuple, ...]:
+    """
+    :return: the column values of each row, as immutable tuples in constructor order (which is the __slots__ order)
+    """
+    return tuple(tuple(getattr(bsv, name) for name in class_bsv.__slots__) for bsv in list_bsv(filename, class_bsv))
+
+
+def map_tui_semantic_group() -> Dict[str, BsvSemanticType]:
+    """
+    :return: map of {tui:BsvSemanticType} for the UMLS semantic groups (new rows on every call, like
+             `umls_semantic_groups`, so callers may change them)
+    """
+    return {bsv.tui: bsv for bsv in umls_semantic_groups()}
+
+
+@functools.lru_cache(maxsize=None)
+def _map_tui_group_id() -> Mapping[str, str]:
+    """
+    :return: read-only map of {tui:group_id}, for lookups that only need the group
+    """
+    return types.MappingProxyType({bsv.tui: bsv.group_id for bsv in umls_semantic_groups()})
+
+
+@functools.lru_cache(maxsize=None)
+def map_semantic_group_tuis() -> Mapping[str, Tuple[str, ...]]:
+    """
+    :return: read-only map of {group_id:(tui, ...)} for the UMLS semantic groups
+    """
+    group_tuis = {}
+    for bsv in umls_semantic_groups():
+        group_tuis.setdefault(bsv.group_id, []).append(bsv.tui)
+    return types.MappingProxyType({group: tuple(tuis) for group, tuis in group_tuis.items()})
+
+
+def list_match_semantic_groups(ner: CtakesJSON, polarity=None) -> List[Tuple[MatchText, Tuple[str, ...]]]:
+    """
+    Labels every match with the UMLS semantic groups of its concepts, in one pass
+
+    :param ner: cTAKES response
+    :param polarity: optional polarity filter, like `CtakesJSON.list_match`
+    :return: list of (MatchText, sorted group_ids) pairs, in `list_match` order
+    """
+    tui_group = _map_tui_group_id()
+    cache = {}  # most matches share a handful of TUI combinations
+
+    labeled = []
+    for match in ner.list_match(polarity=polarity):
+        tuis = frozenset(concept.tui for concept in match.conceptAttributes)
+        groups = cache.get(tuis)
+        if groups is None:
+            groups = tuple(sorted({tui_group[tui] for tui in tuis if tui in tui_group}))
+            cache[tuis] = groups
+        labeled.append((match, groups))
+    return labeled
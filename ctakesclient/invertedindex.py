@@ -0,0 +1,357 @@
+"""Inverted index from concepts (CUI, TUI, mention type) to the notes that mention them"""
+
+import os
+from array import array
+from typing import Dict, Iterable, List, Optional, Set, Tuple, Union
+
+from ctakesclient.store import ResultStore
+from ctakesclient.typesystem import CtakesJSON, MatchText, Polarity, UmlsTypeMention, read_varint, write_varint
+
+###############################################################################
+#
+# Postings are kept per (field, value, polarity) key, where field is one of FIELDS:
+#   ("cui", "C0010200", Polarity.pos) -> sorted ids of the notes with a positive mention of C0010200
+#
+# Saved file layout (every number is an unsigned LEB128 varint):
+#   magic "CTKPOST2"
+#   store count, then per indexed ResultStore: path (as length + utf8), data file offset indexed up to
+#   note count, then (utf8 byte length, utf8 bytes) per note id, in doc id order
+#   key count, then per key: field, value (as length + utf8), polarity (0=pos 1=neg),
+#                            byte length of the postings, then the postings as gaps between sorted doc ids
+#
+###############################################################################
+
+FIELDS = ("cui", "tui", "type")
+
+_MAGIC = b"CTKPOST2"
+
+Key = Tuple[str, str, Polarity]
+Term = Union[Tuple[str, Union[str, UmlsTypeMention]], Tuple[str, Union[str, UmlsTypeMention], Optional[Polarity]]]
+
+
+def _write_string(out: bytearray, value: str) -> None:
+    encoded = value.encode("utf8")
+    write_varint(out, len(encoded))
+    out += encoded
+
+
+def _read_string(data: bytes, pos: int) -> Tuple[str, int]:
+    length, pos = read_varint(data, pos)
+    end = pos + length
+    return data[pos:end].decode("utf8"), end
+
+
+def encode_postings(doc_ids: Iterable[int]) -> bytes:
+    """
+    :param doc_ids: ascending doc ids
+    :return: the gaps between the doc ids, as varints
+    """
+    out = bytearray()
+    previous = 0
+    for doc_id in doc_ids:
+        write_varint(out, doc_id - previous)
+        previous = doc_id
+    return bytes(out)
+
+
+def decode_postings(data: bytes) -> array:
+    """
+    :param data: output of `encode_postings`
+    :return: ascending doc ids
+    """
+    doc_ids = array("I")
+    doc_id = 0
+    value = 0
+    shift = 0
+    for byte in data:
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            doc_id += value
+            doc_ids.append(doc_id)
+            value = 0
+            shift = 0
+        else:
+            shift += 7
+    return doc_ids
+
+
+class InvertedIndex:
+    """
+    Finds the notes that mention (or don't mention) concepts, without re-parsing any stored results
+
+    Each note gets an integer doc id, in the order notes are added. So every postings list stays sorted
+    just by appending, and new notes can be added at any time (like after each extraction run).
+    Adding a note again replaces what was indexed for it (like `ResultStore.get` returns its latest results):
+    the note gets a new doc id, and the old one is skipped by queries until the index is compacted.
+
+    Query terms are (field, value) or (field, value, polarity) tuples, where field is "cui", "tui" or "type":
+        index.query(all_of=[("cui", "C0010200", Polarity.pos)], none_of=[("type", UmlsTypeMention.Medication)])
+    Leaving out the polarity matches mentions of either polarity.
+
+    Saved indexes store postings delta-encoded, and only decode the postings a query actually touches.
+    """
+
+    def __init__(self):
+        self._note_ids: List[str] = []  # doc id -> note id
+        self._doc_ids: Dict[str, int] = {}  # note id -> doc id
+        self._postings: Dict[Key, array] = {}
+        self._encoded: Dict[Key, bytes] = {}  # loaded from disk, but not yet needed
+        self._replaced: Set[int] = set()  # doc ids of notes that were indexed again since
+        self._store_offsets: Dict[str, int] = {}  # ResultStore path -> data file offset indexed up to
+
+    ###########################################################################
+    #
+    # Adding notes
+    #
+    ###########################################################################
+
+    def add(self, note_id: str, nlp_results: CtakesJSON) -> bool:
+        """
+        :param note_id: unique id of the note
+        :param nlp_results: response from cTAKES or other NLP Client
+        :return: whether the note is new (False if it replaced what was indexed for the note before)
+        """
+        keys = set()
+        for match in nlp_results.list_match():
+            keys.add(("type", match.type.value, match.polarity))
+            for concept in match.conceptAttributes:
+                keys.add(("cui", concept.cui, match.polarity))
+                keys.add(("tui", concept.tui, match.polarity))
+        return self._add_keys(note_id, keys)
+
+    def add_json(self, note_id: str, ctakes_json: dict) -> bool:
+        """
+        Same as `add`, but straight from `CtakesJSON.as_json()` (skipping the cost of building CtakesJSON)
+
+        :param note_id: unique id of the note
+        :param ctakes_json: `CtakesJSON.as_json()` of the results
+        :return: whether the note is new (False if it replaced what was indexed for the note before)
+        """
+        keys = set()
+        for match_list in ctakes_json.values():
+            for match in match_list:
+                polarity = MatchText.parse_polarity(match.get("polarity"))
+                keys.add(("type", match.get("type"), polarity))
+                for concept in match.get("conceptAttributes", []):
+                    keys.add(("cui", concept.get("cui"), polarity))
+                    keys.add(("tui", concept.get("tui"), polarity))
+        return self._add_keys(note_id, keys)
+
+    def add_store(self, store: ResultStore) -> int:
+        """
+        Indexes the records appended to a store since the last call (for the same store path)
+
+        Notes that were appended again get their latest results indexed, like `ResultStore.get` would return.
+
+        :param store: stored results to index
+        :return: how many records were indexed
+        """
+        path = os.path.abspath(store.path)
+        start = self._store_offsets.get(path, 0)
+        store.flush()
+        if start > store.data_end:
+            start = 0  # the store was rewritten since, so start over
+
+        indexed = 0
+        for note_id, ctakes_json in store.iter_json(start=start):
+            self.add_json(note_id, ctakes_json)
+            indexed += 1
+        self._store_offsets[path] = store.data_end
+        return indexed
+
+    def _add_keys(self, note_id: str, keys: Set[Key]) -> bool:
+        previous = self._doc_ids.get(note_id)
+        if previous is not None:
+            self._replaced.add(previous)  # its postings stay put, but queries skip it
+
+        doc_id = len(self._note_ids)
+        self._note_ids.append(note_id)
+        self._doc_ids[note_id] = doc_id
+        for key in keys:
+            if key[1] is None:
+                continue  # like a concept without a TUI
+            postings = self._get_postings(key)
+            if postings is None:
+                postings = self._postings[key] = array("I")
+            postings.append(doc_id)
+        return previous is None
+
+    ###########################################################################
+    #
+    # Queries
+    #
+    ###########################################################################
+
+    def query(self, all_of: List[Term] = None, any_of: List[Term] = None, none_of: List[Term] = None) -> List[str]:
+        """
+        :param all_of: notes must match every one of these terms
+        :param any_of: notes must match at least one of these terms (if given)
+        :param none_of: notes must not match any of these terms
+        :return: ids of the matching notes, in the order they were (last) added
+        """
+        matches = None
+        for doc_ids in sorted((self._term_doc_ids(term) for term in all_of or []), key=len):
+            if matches is None:
+                matches = doc_ids
+            else:
+                matches &= doc_ids
+
+        if any_of:
+            union = set()
+            for term in any_of:
+                union |= self._term_doc_ids(term)
+            matches = union if matches is None else matches & union
+
+        if matches is None:
+            matches = set(range(len(self._note_ids))) - self._replaced
+        for term in none_of or []:
+            matches -= self._term_doc_ids(term)
+
+        return [self._note_ids[doc_id] for doc_id in sorted(matches)]
+
+    def count(self, term: Term) -> int:
+        """
+        :param term: (field, value) or (field, value, polarity)
+        :return: how many notes match the term
+        """
+        return len(self._term_doc_ids(term))
+
+    def __contains__(self, note_id: str) -> bool:
+        return note_id in self._doc_ids
+
+    def __len__(self) -> int:
+        return len(self._doc_ids)
+
+    @staticmethod
+    def _term_keys(term: Term) -> List[Key]:
+        field, value, *rest = term
+        if field not in FIELDS:
+            raise ValueError(f"field unknown: {field}, expected one of {FIELDS}")
+        if isinstance(value, UmlsTypeMention):
+            value = value.value
+        polarity = rest[0] if rest else None
+        if polarity is None:
+            return [(field, value, Polarity.pos), (field, value, Polarity.neg)]
+        return [(field, value, MatchText.parse_polarity(polarity))]
+
+    def _term_doc_ids(self, term: Term) -> set:
+        doc_ids = set()
+        for key in self._term_keys(term):
+            postings = self._get_postings(key)
+            if postings is not None:
+                doc_ids.update(postings)
+        return doc_ids - self._replaced if self._replaced else doc_ids
+
+    def _get_postings(self, key: Key) -> Optional[array]:
+        postings = self._postings.get(key)
+        if postings is None:
+            encoded = self._encoded.pop(key, None)
+            if encoded is not None:
+                postings = self._postings[key] = decode_postings(encoded)
+        return postings
+
+    ###########################################################################
+    #
+    # Saving and loading
+    #
+    ###########################################################################
+
+    def compact(self) -> None:
+        """
+        Drops the postings of replaced notes, renumbering the remaining doc ids (`save` does this automatically)
+        """
+        if not self._replaced:
+            return
+
+        live = [doc_id for doc_id in range(len(self._note_ids)) if doc_id not in self._replaced]
+        renumbered = {old: new for new, old in enumerate(live)}  # keeps the order, so postings stay sorted
+        for key in list(self._encoded):
+            self._get_postings(key)
+
+        postings = {}
+        for key, doc_ids in self._postings.items():
+            kept = array("I", (renumbered[doc_id] for doc_id in doc_ids if doc_id in renumbered))
+            if kept:
+                postings[key] = kept
+        self._postings = postings
+        self._note_ids = [self._note_ids[doc_id] for doc_id in live]
+        self._doc_ids = {note_id: doc_id for doc_id, note_id in enumerate(self._note_ids)}
+        self._replaced = set()
+
+    def save(self, path: str) -> None:
+        """
+        :param path: file to write the index to (replaced atomically)
+        """
+        self.compact()
+
+        out = bytearray(_MAGIC)
+        write_varint(out, len(self._store_offsets))
+        for store_path, offset in self._store_offsets.items():
+            _write_string(out, store_path)
+            write_varint(out, offset)
+
+        write_varint(out, len(self._note_ids))
+        for note_id in self._note_ids:
+            _write_string(out, note_id)
+
+        keys = sorted(set(self._postings) | set(self._encoded), key=lambda k: (k[0], k[1], k[2].value))
+        write_varint(out, len(keys))
+        for key in keys:
+            field, value, polarity = key
+            encoded = self._encoded.get(key)
+            if encoded is None:
+                encoded = encode_postings(self._postings[key])
+            _write_string(out, field)
+            _write_string(out, value)
+            out.append(0 if polarity == Polarity.pos else 1)
+            write_varint(out, len(encoded))
+            out += encoded
+
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(out)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> "InvertedIndex":
+        """
+        :param path: file written by `save`
+        :return: the index (postings are decoded lazily, on first use)
+        """
+        with open(path, "rb") as f:
+            data = f.read()
+        if not data.startswith(_MAGIC):
+            raise ValueError(f"{path} is not an inverted index")
+
+        index = cls()
+        count, pos = read_varint(data, len(_MAGIC))
+        for _ in range(count):
+            store_path, pos = _read_string(data, pos)
+            index._store_offsets[store_path], pos = read_varint(data, pos)
+
+        count, pos = read_varint(data, pos)
+        for doc_id in range(count):
+            note_id, pos = _read_string(data, pos)
+            index._note_ids.append(note_id)
+            index._doc_ids[note_id] = doc_id
+
+        count, pos = read_varint(data, pos)
+        for _ in range(count):
+            field, pos = _read_string(data, pos)
+            value, pos = _read_string(data, pos)
+            polarity = Polarity.neg if data[pos] else Polarity.pos
+            length, pos = read_varint(data, pos + 1)
+            end = pos + length
+            index._encoded[(field, value, polarity)] = data[pos:end]
+            pos = end
+        return index
+
+    @classmethod
+    def from_store(cls, store: ResultStore) -> "InvertedIndex":
+        """
+        :param store: stored results to index
+        :return: index of every note in the store
+        """
+        index = cls()
+        index.add_store(store)
+        return index
@@ -0,0 +1,423 @@
+"""
+Instrumentation hooks, to see where the time goes in a batch job
+
+Nothing is measured until a hook is registered, and the checks along the way cost next to nothing until then.
+
+    collector = metrics.MetricsCollector()
+    metrics.add_hook(collector)
+    ... # run your NLP
+    collector.write_prometheus("/var/lib/node_exporter/ctakesclient.prom")
+
+Hooks see every HTTP call made by `client.post` and `transformer.list_polarity` (as a `RequestTiming`),
+plus timings of local work: parsing responses into CtakesJSON ("parse"),
+fixing cTAKES span offsets ("adjust_offsets"), and building FHIR resources ("fhir").
+
+Hooks only see work done in their own process (so not `text2fhir.nlp_fhir_pooled` worker processes).
+"""
+
+import bisect
+import dataclasses
+import logging
+import os
+import tempfile
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+import httpx
+
+###############################################################################
+#
+# Hooks
+#
+###############################################################################
+
+
+@dataclasses.dataclass
+class RequestTiming:
+    """One HTTP call to an NLP server"""
+
+    endpoint: str  # "ctakes" or a cNLP transformer model, like "negation"
+    url: str
+    text_length: int  # characters of clinical text sent
+    seconds: float  # the whole call, from sending the request to decoding the response JSON
+    sent_bytes: int
+    received_bytes: int = 0
+    status: Optional[int] = None  # None if no response arrived
+    error: Optional[str] = None  # exception class name, if the call failed
+    # Breakdown of `seconds` where available: "connect", "upload", "server" (waiting for the response headers),
+    # "download", and "decode" (JSON parsing). Connections reused from the pool have no "connect".
+    phases: Dict[str, float] = dataclasses.field(default_factory=dict)
+
+
+class Hook:
+    """Base class for instrumentation hooks, override whichever methods you care about"""
+
+    def request(self, timing: RequestTiming) -> None:
+        """Called after every HTTP call, successful or not"""
+
+    def stage(self, name: str, seconds: float) -> None:
+        """Called after each local processing stage (like "parse")"""
+
+    def retry(self, endpoint: str, error: Exception) -> None:
+        """Called when a failed call is about to be retried (by callers that retry, like the command line tool)"""
+
+
+_hooks: List[Hook] = []
+
+
+def add_hook(hook: Hook) -> None:
+    """
+    :param hook: starts receiving measurements
+    """
+    _hooks.append(hook)
+
+
+def remove_hook(hook: Hook) -> None:
+    """
+    :param hook: stops receiving measurements
+    """
+    _hooks.remove(hook)
+
+
+def enabled() -> bool:
+    """
+    :return: whether any hooks are registered
+    """
+    return bool(_hooks)
+
+
+def _emit(method: str, *args) -> None:
+    for hook in list(_hooks):
+        try:
+            getattr(hook, method)(*args)
+        except Exception:  # pylint: disable=broad-except
+            logging.exception("metrics hook %r failed", hook)  # never let metrics break the actual work
+
+
+###############################################################################
+#
+# Measuring
+#
+###############################################################################
+
+
+def start() -> Optional[float]:
+    """
+    Marks the start of a stage, to pass to `stage` when it's done
+
+    :return: start time, or None if there are no hooks (so nothing needs measuring)
+    """
+    return time.perf_counter() if _hooks else None
+
+
+def stage(name: str, started: Optional[float]) -> None:
+    """
+    :param name: stage name, like "parse"
+    :param started: return value of `start`
+    """
+    if started is not None:
+        _emit("stage", name, time.perf_counter() - started)
+
+
+def retry(endpoint: str, error: Exception) -> None:
+    """
+    :param endpoint: which server the failed call went to, like "ctakes"
+    :param error: why it failed
+    """
+    if _hooks:
+        _emit("retry", endpoint, error)
+
+
+# httpcore trace event name -> phase it counts towards
+_TRACE_PHASES = {
+    "connect_tcp": "connect",
+    "start_tls": "connect",
+    "send_request_headers": "upload",
+    "send_request_body": "upload",
+    "receive_response_headers": "server",
+    "receive_response_body": "download",
+}
+
+
+class _PhaseTracer:
+    """An httpx "trace" extension, summing the time spent in each phase of a request"""
+
+    def __init__(self):
+        self.phases: Dict[str, float] = {}
+        self._started: Dict[str, float] = {}
+
+    async def __call__(self, event: str, info: dict) -> None:
+        name, _, what = event.rpartition(".")
+        step = name.rpartition(".")[2]  # event is like "http11.send_request_body.started"
+        phase = _TRACE_PHASES.get(step)
+        if phase is None:
+            return
+        if what == "started":
+            self._started[step] = time.perf_counter()
+        elif step in self._started:
+            self.phases[phase] = self.phases.get(phase, 0) + time.perf_counter() - self._started.pop(step)
+
+
+async def post_json(client: httpx.AsyncClient, endpoint: str, url: str, text_length: int, **kwargs) -> Any:
+    """
+    POSTs to an NLP server, reporting how it went to the hooks
+
+    :param client: HTTPX client session
+    :param endpoint: name for the server in measurements, like "ctakes"
+    :param url: server URL
+    :param text_length: characters of clinical text in the request
+    :param kwargs: request arguments for httpx, like `content` or `json`
+    :return: parsed json response
+    """
+    if not _hooks:
+        response = await client.post(url, **kwargs)
+        response.raise_for_status()
+        return response.json()
+
+    tracer = _PhaseTracer()
+    request = client.build_request("POST", url, extensions={"trace": tracer}, **kwargs)
+    timing = RequestTiming(endpoint, url, text_length, 0, len(request.content), phases=tracer.phases)
+    tic = time.perf_counter()
+    try:
+        response = await client.send(request)
+        timing.status = response.status_code
+        timing.received_bytes = len(response.content)
+        response.raise_for_status()
+        decode_tic = time.perf_counter()
+        result = response.json()
+        tracer.phases["decode"] = time.perf_counter() - decode_tic
+        return result
+    except Exception as exc:
+        timing.error = type(exc).__name__
+        raise
+    finally:
+        timing.seconds = time.perf_counter() - tic
+        _emit("request", timing)
+
+
+###############################################################################
+#
+# Collecting metrics, for Prometheus
+#
+###############################################################################
+
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+STAGE_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5)
+# Upper bounds in characters, for the "size" label of request latencies (bigger notes are labeled ">64000")
+NOTE_SIZE_BUCKETS = (1000, 4000, 16000, 64000)
+
+
+class _Histogram:
+    def __init__(self, bounds: Tuple[float, ...]):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # last one is +Inf
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+
+def note_size_label(text_length: int) -> str:
+    """
+    :param text_length: characters in a note
+    :return: its size bucket, like "<=4000"
+    """
+    index = bisect.bisect_left(NOTE_SIZE_BUCKETS, text_length)
+    return f"<={NOTE_SIZE_BUCKETS[index]}" if index < len(NOTE_SIZE_BUCKETS) else f">{NOTE_SIZE_BUCKETS[-1]}"
+
+
+def _labels(names: Tuple[str, ...], values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _number(value: float) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class MetricsCollector(Hook):
+    """
+    A hook that keeps running totals, to export in the Prometheus text format
+
+    Safe to share between threads.
+    """
+
+    def __init__(self, namespace: str = "ctakesclient"):
+        """
+        :param namespace: prefix for all metric names
+        """
+        self.namespace = namespace
+        self._lock = threading.Lock()
+        self._latency: Dict[tuple, _Histogram] = {}  # (endpoint, size) -> request seconds
+        self._stages: Dict[tuple, _Histogram] = {}  # (stage,) -> seconds
+        self._requests: Dict[tuple, int] = {}  # (endpoint, status) -> count
+        self._phases: Dict[tuple, float] = {}  # (endpoint, phase) -> seconds
+        self._sent: Dict[tuple, int] = {}  # (endpoint,) -> bytes
+        self._received: Dict[tuple, int] = {}  # (endpoint,) -> bytes
+        self._retries: Dict[tuple, int] = {}  # (endpoint,) -> count
+
+    def request(self, timing: RequestTiming) -> None:
+        endpoint = (timing.endpoint,)
+        status = str(timing.status) if timing.status is not None else "error"
+        with self._lock:
+            key = (timing.endpoint, note_size_label(timing.text_length))
+            self._histogram(self._latency, key, LATENCY_BUCKETS).observe(timing.seconds)
+            self._add(self._requests, (timing.endpoint, status), 1)
+            self._add(self._sent, endpoint, timing.sent_bytes)
+            self._add(self._received, endpoint, timing.received_bytes)
+            for phase, seconds in timing.phases.items():
+                self._add(self._phases, (timing.endpoint, phase), seconds)
+
+    def stage(self, name: str, seconds: float) -> None:
+        with self._lock:
+            self._histogram(self._stages, (name,), STAGE_BUCKETS).observe(seconds)
+
+    def retry(self, endpoint: str, error: Exception) -> None:
+        with self._lock:
+            self._add(self._retries, (endpoint,), 1)
+
+    @staticmethod
+    def _histogram(histograms: dict, key: tuple, bounds: Tuple[float, ...]) -> _Histogram:
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = histograms[key] = _Histogram(bounds)
+        return histogram
+
+    @staticmethod
+    def _add(counters: dict, key: tuple, value) -> None:
+        counters[key] = counters.get(key, 0) + value
+
+    ###########################################################################
+    #
+    # Prometheus export
+    #
+    ###########################################################################
+
+    def to_prometheus(self) -> str:
+        """
+        :return: all metrics, in the Prometheus text exposition format
+        """
+        lines = []
+        with self._lock:
+            self._format_histograms(
+                lines, "request_duration_seconds", "NLP server calls", ("endpoint", "size"), self._latency
+            )
+            self._format_counters(lines, "requests_total", "NLP server calls", ("endpoint", "status"), self._requests)
+            self._format_counters(
+                lines, "request_phase_seconds_total", "time in each part of a call", ("endpoint", "phase"), self._phases
+            )
+            self._format_counters(lines, "sent_bytes_total", "request body bytes", ("endpoint",), self._sent)
+            self._format_counters(lines, "received_bytes_total", "response body bytes", ("endpoint",), self._received)
+            self._format_counters(lines, "retries_total", "retried calls", ("endpoint",), self._retries)
+            self._format_histograms(lines, "stage_duration_seconds", "local processing", ("stage",), self._stages)
+        return "".join(f"{line}\n" for line in lines)
+
+    def write_prometheus(self, path: str) -> None:
+        """
+        Writes all metrics to a file, like for the node_exporter textfile collector
+
+        The file is replaced atomically, so a scrape never sees half of it.
+
+        :param path: where to write (usually ending in .prom)
+        """
+        text = self.to_prometheus()
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w", encoding="utf8") as f:
+                f.write(text)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def _format_counters(self, lines: list, name: str, help_text: str, label_names: tuple, counters: dict) -> None:
+        if not counters:
+            return
+        name = f"{self.namespace}_{name}"
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} counter"]
+        for key in sorted(counters):
+            lines.append(f"{name}{_labels(label_names, key)} {_number(counters[key])}")
+
+    def _format_histograms(self, lines: list, name: str, help_text: str, label_names: tuple, histograms: dict) -> None:
+        if not histograms:
+            return
+        name = f"{self.namespace}_{name}"
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} histogram"]
+        for key in sorted(histograms):
+            histogram = histograms[key]
+            total = 0
+            for bound, count in zip([*histogram.bounds, "+Inf"], histogram.counts):
+                total += count
+                le = f'le="{bound}"'
+                lines.append(f"{name}_bucket{_labels(label_names, key, le)} {total}")
+            lines.append(f"{name}_sum{_labels(label_names, key)} {_number(histogram.sum)}")
+            lines.append(f"{name}_count{_labels(label_names, key)} {total}")
+
+
+###############################################################################
+#
+# OpenTelemetry
+#
+###############################################################################
+
+
+class OpenTelemetryHook(Hook):
+    """
+    A hook that turns measurements into OpenTelemetry spans
+
+    Spans are created after the fact (with their real start and end times),
+    as children of whatever span is current when the work finishes.
+    """
+
+    def __init__(self, tracer):
+        """
+        :param tracer: an OpenTelemetry tracer, like `opentelemetry.trace.get_tracer("ctakesclient")`
+        """
+        self.tracer = tracer
+        try:
+            from opentelemetry.trace import SpanKind, StatusCode  # pylint: disable=import-outside-toplevel
+        except ImportError:  # tolerate look-alike tracers without the opentelemetry package
+            SpanKind = StatusCode = None  # pylint: disable=invalid-name
+        self._client_kind = SpanKind and SpanKind.CLIENT
+        self._error_status = StatusCode and StatusCode.ERROR
+
+    def request(self, timing: RequestTiming) -> None:
+        attributes = {
+            "http.request.method": "POST",
+            "url.full": timing.url,
+            "http.request.body.size": timing.sent_bytes,
+            "http.response.body.size": timing.received_bytes,
+            "ctakesclient.endpoint": timing.endpoint,
+            "ctakesclient.text_length": timing.text_length,
+        }
+        if timing.status is not None:
+            attributes["http.response.status_code"] = timing.status
+        for phase, seconds in timing.phases.items():
+            attributes[f"ctakesclient.phase.{phase}_seconds"] = seconds
+        if timing.error:
+            attributes["error.type"] = timing.error
+        self._span(f"POST {timing.endpoint}", timing.seconds, attributes, self._client_kind, bool(timing.error))
+
+    def stage(self, name: str, seconds: float) -> None:
+        self._span(f"ctakesclient.{name}", seconds, {}, None, False)
+
+    def retry(self, endpoint: str, error: Exception) -> None:
+        self._span("ctakesclient.retry", 0, {"ctakesclient.endpoint": endpoint, "error.type": type(error).__name__})
+
+    def _span(self, name: str, seconds: float, attributes: dict, kind=None, failed: bool = False) -> None:
+        end = time.time_ns()
+        kwargs = {"attributes": attributes, "start_time": end - int(seconds * 1e9)}
+        if kind is not None:
+            kwargs["kind"] = kind
+        span = self.tracer.start_span(name, **kwargs)
+        if failed and self._error_status is not None:
+            span.set_status(self._error_status)
+        span.end(end_time=end)
@@ -0,0 +1,167 @@
+"""
+Offline dictionary pre-screen for clinical text.
+
+When you only care about a small set of concepts (like `filesystem.covid_symptoms()`),
+most notes won't mention any of them, and sending those notes to cTAKES is wasted time.
+A `TermMatcher` quickly checks a note for any of the dictionary terms first,
+so that `client.extract` can skip the notes (or paragraphs) that can't match.
+"""
+
+import collections
+import re
+from typing import Iterable, List, Tuple
+
+from ctakesclient.filesystem import BsvConcept
+
+_WHITESPACE = re.compile(r"\s+")
+_PARAGRAPH_BREAK = re.compile(r"\n[^\S\n]*\n\s*")
+
+
+def normalize(text: str) -> str:
+    """
+    :param text: any text
+    :return: lowercase text, with every run of whitespace collapsed into a single space
+    """
+    return _WHITESPACE.sub(" ", text.lower())
+
+
+def _normalize_with_origins(text: str) -> Tuple[str, List[int]]:
+    """
+    :param text: any text
+    :return: same as `normalize`, plus the index in the original text of each normalized character
+    """
+    normalized = []
+    origins = []
+    for match in re.finditer(r"(\s+)|\S+", text):
+        if match.group(1):
+            normalized.append(" ")
+            origins.append(match.start())
+        else:
+            for i, char in enumerate(match.group(), match.start()):
+                lowered = char.lower()  # can be more than one character
+                normalized.append(lowered)
+                origins.extend([i] * len(lowered))
+    return "".join(normalized), origins
+
+
+def split_paragraphs(text: str) -> List[Tuple[int, int]]:
+    """
+    :param text: any text
+    :return: (begin, end) character spans of the paragraphs (separated by blank lines) in the text
+    """
+    spans = []
+    begin = 0
+    for gap in _PARAGRAPH_BREAK.finditer(text):
+        if gap.start() > begin:
+            spans.append((begin, gap.start()))
+        begin = gap.end()
+    if len(text) > begin:
+        spans.append((begin, len(text)))
+    return spans
+
+
+class TermMatcher:
+    """
+    Aho-Corasick automaton over a dictionary of terms, matching case- and whitespace-insensitively
+
+    Every term is searched for in a single pass over the text, no matter how big the dictionary is.
+
+    Matches must start on a word boundary but may end mid-word, which is deliberately generous:
+    cTAKES normalizes word endings (like "coughing" to "cough"), and a pre-screen must never skip
+    a note that cTAKES would have found something in.
+    """
+
+    def __init__(self, terms: Iterable[str]):
+        """
+        :param terms: dictionary terms to look for (blank terms are ignored)
+        """
+        self._goto = [{}]  # node -> {character: next node}
+        self._fail = [0]  # node -> longest proper suffix that is also a trie node
+        self._out = [()]  # node -> lengths of every term ending at this node (including via suffixes)
+
+        for term in terms:
+            term = normalize(term).strip()
+            if term:
+                self._add(term)
+        self._link()
+
+    @classmethod
+    def from_concepts(cls, concepts: Iterable[BsvConcept]) -> "TermMatcher":
+        """
+        :param concepts: dictionary rows, like `filesystem.covid_symptoms()`
+        :return: matcher for the text and preferred term of every concept
+        """
+        terms = set()
+        for concept in concepts:
+            terms.add(concept.text)
+            terms.add(concept.pref)
+        return cls(term for term in terms if term)
+
+    def _add(self, term: str) -> None:
+        node = 0
+        for char in term:
+            child = self._goto[node].get(char)
+            if child is None:
+                child = len(self._goto)
+                self._goto[node][char] = child
+                self._goto.append({})
+                self._fail.append(0)
+                self._out.append(())
+            node = child
+        self._out[node] = (len(term),)
+
+    def _link(self) -> None:
+        """Computes failure links breadth-first, folding each node's suffix outputs into its own"""
+        queue = collections.deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, child in self._goto[node].items():
+                queue.append(child)
+                fallback = self._fail[node]
+                while fallback and char not in self._goto[fallback]:
+                    fallback = self._fail[fallback]
+                target = self._goto[fallback].get(char, 0)
+                self._fail[child] = target if target != child else 0
+                self._out[child] = self._out[child] + self._out[self._fail[child]]
+
+    def _iter_matches(self, normalized: str):
+        goto, fail, out = self._goto, self._fail, self._out
+        node = 0
+        for i, char in enumerate(normalized):
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+            for length in out[node]:
+                begin = i + 1 - length
+                if begin == 0 or not normalized[begin - 1].isalnum():
+                    yield begin, i + 1
+
+    def find(self, text: str) -> List[str]:
+        """
+        :param text: text to search
+        :return: every dictionary term found in the text (normalized), in order of where they end
+        """
+        normalized = normalize(text)
+        return [normalized[begin:end] for begin, end in self._iter_matches(normalized)]
+
+    def find_spans(self, text: str) -> List[Tuple[int, int]]:
+        """
+        :param text: text to search
+        :return: (begin, end) character spans in the original text of every dictionary term found
+        """
+        normalized, origins = _normalize_with_origins(text)
+        return [(origins[begin], origins[end - 1] + 1) for begin, end in self._iter_matches(normalized)]
+
+    def contains_any(self, text: str) -> bool:
+        """
+        :param text: text to search
+        :return: whether the text holds at least one dictionary term
+        """
+        return next(self._iter_matches(normalize(text)), None) is not None
+
+    def select_paragraphs(self, text: str) -> List[Tuple[int, int]]:
+        """
+        :param text: text to search
+        :return: (begin, end) character spans of the paragraphs that hold at least one dictionary term
+        """
+        return [(begin, end) for begin, end in split_paragraphs(text) if self.contains_any(text[begin:end])]
@@ -0,0 +1,426 @@
+"""Append-only NDJSON store of cTAKES results, with a sidecar index for random access by note id"""
+
+import gzip
+import json
+import logging
+import os
+import shutil
+import zlib
+from typing import BinaryIO, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from ctakesclient.typesystem import CtakesJSON
+
+###############################################################################
+#
+# Data file: one {"note_id": ..., "ctakes": CtakesJSON.as_json()} record per line.
+#   When compressed, lines are grouped into blocks and each block is its own gzip member.
+#   Concatenated gzip members are still a valid gzip file, so `zcat` and `gzip.open` read it as usual.
+#
+# Index file (data file + ".idx"): a JSON header line, then one JSON line per record:
+#   [note_id, offset, length, inner_offset, inner_length]
+#   where offset/length is the byte range of the record's block in the data file,
+#   and inner_offset/inner_length is the record's range inside the (decompressed) block.
+#
+###############################################################################
+
+_INDEX_FORMAT = "ctakesclient-store"
+_INDEX_VERSION = 1
+
+IndexEntry = Tuple[int, int, int, int]
+
+
+def _iter_gzip_members(f: BinaryIO, chunk_size: int = 1024 * 1024) -> Iterator[Tuple[int, int, bytes]]:
+    """
+    :param f: file of concatenated gzip members
+    :param chunk_size: bytes to read at a time
+    :return: (offset, compressed length, decompressed data) of each complete member, stopping at anything else
+    """
+    offset = 0
+    data = b""
+    while True:
+        decompressor = zlib.decompressobj(wbits=31)  # exactly one gzip member
+        block = []
+        length = 0
+        while not decompressor.eof:
+            if not data:
+                data = f.read(chunk_size)
+                if not data:
+                    return  # end of file (or a member that was cut short)
+            try:
+                block.append(decompressor.decompress(data))
+            except zlib.error:
+                return
+            length += len(data) - len(decompressor.unused_data)
+            data = decompressor.unused_data
+        yield offset, length, b"".join(block)
+        offset += length
+
+
+class ResultStore:
+    """
+    Stores (note_id, CtakesJSON) records in an NDJSON file, with O(1) lookup by note id
+
+    Records are buffered in memory and written a block at a time (see `block_size`).
+    Index entries are only written after their block is safely on disk, so after a crash the index never points
+    at missing data. When the store is re-opened, complete blocks that never got their index entries are indexed,
+    a partial index entry is dropped, and any partial block left at the end of the data file is cut off.
+
+    If a note id is appended more than once, lookups find the latest record, while iteration yields every record.
+
+    To write in parallel, give each worker its own store ("shard") and combine them afterwards with `merge`.
+    """
+
+    def __init__(self, path: str, compress: bool = None, block_size: int = 256 * 1024):
+        """
+        :param path: data file to read and append to (created if needed), the index is kept at path + ".idx"
+        :param compress: whether to gzip each block, default = whatever an existing store uses, else False
+        :param block_size: (uncompressed) bytes of records to buffer before writing them out as one block
+        """
+        self.path = path
+        self.index_path = f"{path}.idx"
+        self.block_size = block_size
+
+        self._index: Dict[str, IndexEntry] = {}
+        self._data_end = 0  # end of the last indexed block in the data file
+        self._pending: List[Tuple[str, bytes]] = []
+        self._pending_ids: Dict[str, int] = {}  # note_id -> position in _pending
+        self._pending_size = 0
+
+        stored_compress = self._load_index() if os.path.exists(self.index_path) else None
+        if stored_compress is not None and compress is not None and stored_compress != compress:
+            raise ValueError(f"{path} was written with compress={stored_compress}")
+        self.compress = bool(compress) if stored_compress is None else stored_compress
+
+        self._file = open(path, "a+b")  # pylint: disable=consider-using-with
+        if stored_compress is None:
+            self.reindex()  # new store, or a data file that lost its index
+        else:
+            self._recover_tail()
+
+    ###########################################################################
+    #
+    # Writing
+    #
+    ###########################################################################
+
+    def append(self, note_id: str, nlp_results: CtakesJSON) -> None:
+        """
+        :param note_id: unique id of the note (like a DocumentReference id)
+        :param nlp_results: response from cTAKES or other NLP Client
+        """
+        self.append_json(note_id, nlp_results.as_json())
+
+    def append_json(self, note_id: str, ctakes_json: dict) -> None:
+        """
+        :param note_id: unique id of the note (like a DocumentReference id)
+        :param ctakes_json: `CtakesJSON.as_json()` of the results
+        """
+        record = {"note_id": note_id, "ctakes": ctakes_json}
+        line = json.dumps(record, separators=(",", ":")).encode("utf8") + b"\n"
+        self._pending_ids[note_id] = len(self._pending)
+        self._pending.append((note_id, line))
+        self._pending_size += len(line)
+        if self._pending_size >= self.block_size:
+            self.flush()
+
+    def append_all(self, records: Iterable[Tuple[str, CtakesJSON]]) -> None:
+        """
+        :param records: (note_id, nlp_results) pairs
+        """
+        for note_id, nlp_results in records:
+            self.append(note_id, nlp_results)
+
+    def flush(self) -> None:
+        """Writes out any buffered records as a block, then their index entries"""
+        if not self._pending:
+            return
+
+        block = b"".join(line for _, line in self._pending)
+        start = self._data_end
+        entries = []
+        if self.compress:
+            payload = gzip.compress(block, mtime=0)
+            inner = 0
+            for note_id, line in self._pending:
+                entries.append((note_id, (start, len(payload), inner, len(line))))
+                inner += len(line)
+        else:
+            payload = block
+            offset = start
+            for note_id, line in self._pending:
+                entries.append((note_id, (offset, len(line), 0, len(line))))
+                offset += len(line)
+
+        self._file.write(payload)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._write_entries(entries)
+
+        self._pending = []
+        self._pending_ids = {}
+        self._pending_size = 0
+
+    ###########################################################################
+    #
+    # Reading
+    #
+    ###########################################################################
+
+    def get(self, note_id: str) -> Optional[CtakesJSON]:
+        """
+        :param note_id: note to look up
+        :return: the (latest) results stored for the note, or None if not found
+        """
+        ctakes_json = self.get_json(note_id)
+        return None if ctakes_json is None else CtakesJSON(ctakes_json)
+
+    def get_json(self, note_id: str) -> Optional[dict]:
+        """
+        :param note_id: note to look up
+        :return: the (latest) `CtakesJSON.as_json()` stored for the note, or None if not found
+        """
+        position = self._pending_ids.get(note_id)
+        if position is not None:
+            return json.loads(self._pending[position][1])["ctakes"]
+
+        entry = self._index.get(note_id)
+        if entry is None:
+            return None
+        offset, length, inner_offset, inner_length = entry
+        self._file.seek(offset)
+        data = self._file.read(length)
+        if self.compress:
+            inner_end = inner_offset + inner_length
+            data = gzip.decompress(data)[inner_offset:inner_end]
+        return json.loads(data)["ctakes"]
+
+    def note_ids(self) -> List[str]:
+        """
+        :return: every stored note id (once each)
+        """
+        return list(self._index) + [note_id for note_id in self._pending_ids if note_id not in self._index]
+
+    def __contains__(self, note_id: str) -> bool:
+        return note_id in self._index or note_id in self._pending_ids
+
+    def __len__(self) -> int:
+        return len(self.note_ids())
+
+    @property
+    def data_end(self) -> int:
+        """Offset in the data file just past the last written block (pending records are not counted)"""
+        return self._data_end
+
+    def iter_json(self, start: int = 0) -> Iterator[Tuple[str, dict]]:
+        """
+        :param start: data file offset to start reading at, like an earlier `data_end` (to skip older records)
+        :return: every (note_id, `CtakesJSON.as_json()`) record, in the order they were appended
+        """
+        self.flush()
+        end = self._data_end
+        with open(self.path, "rb") as f:
+            f.seek(start)
+            if self.compress:
+                for offset, _, block in _iter_gzip_members(f):
+                    if start + offset >= end:
+                        break
+                    yield from self._iter_lines(block.splitlines())
+            else:
+                while f.tell() < end:
+                    yield from self._iter_lines([f.readline()])
+
+    def __iter__(self) -> Iterator[Tuple[str, CtakesJSON]]:
+        for note_id, ctakes_json in self.iter_json():
+            yield note_id, CtakesJSON(ctakes_json)
+
+    @staticmethod
+    def _iter_lines(lines: Iterable[bytes]) -> Iterator[Tuple[str, dict]]:
+        for line in lines:
+            record = json.loads(line)
+            yield record["note_id"], record["ctakes"]
+
+    ###########################################################################
+    #
+    # Index handling
+    #
+    ###########################################################################
+
+    def _load_index(self) -> bool:
+        """
+        :return: whether the store is compressed, per the index header
+        """
+        entries = []
+        starts = []  # index file offset of each entry's line
+        torn = False
+        with open(self.index_path, "rb") as f:
+            header = json.loads(f.readline())
+            if header.get("format") != _INDEX_FORMAT or header.get("version") != _INDEX_VERSION:
+                raise ValueError(f"{self.index_path} is not a result store index")
+            good_end = f.tell()
+            for line in f:
+                try:
+                    if not line.endswith(b"\n"):
+                        raise ValueError("incomplete line")
+                    note_id, offset, length, inner_offset, inner_length = json.loads(line)
+                except ValueError:
+                    torn = True
+                    break
+                entries.append((note_id, (offset, length, inner_offset, inner_length)))
+                starts.append(good_end)
+                good_end += len(line)
+
+        if torn:
+            # The write was interrupted, so the last block may only be partly indexed: forget all of its entries,
+            # and let _recover_tail() index the block again from the data file.
+            logging.warning(
+                "%s ends with an incomplete entry (from an interrupted write?), cutting it off", self.index_path
+            )
+            last_block = entries[-1][1][0] if entries else None
+            while entries and entries[-1][1][0] == last_block:
+                entries.pop()
+                good_end = starts.pop()
+            os.truncate(self.index_path, good_end)
+
+        self._write_entries(entries, append=False)
+        return header["compress"]
+
+    @staticmethod
+    def _index_lines(entries: List[Tuple[str, IndexEntry]]) -> bytes:
+        return b"".join(json.dumps([note_id, *entry]).encode("utf8") + b"\n" for note_id, entry in entries)
+
+    def _write_entries(self, entries: List[Tuple[str, IndexEntry]], append: bool = True) -> None:
+        if append:
+            with open(self.index_path, "ab") as f:
+                f.write(self._index_lines(entries))
+                f.flush()
+                os.fsync(f.fileno())
+        self._index.update(entries)
+        for _, (offset, length, _, _) in entries:
+            self._data_end = max(self._data_end, offset + length)
+
+    def _scan(self, start: int) -> Tuple[List[Tuple[str, IndexEntry]], int]:
+        """
+        :param start: data file offset to scan from (the start of a block)
+        :return: index entries of the complete records from there on, and the offset where the last one ends
+        """
+        entries = []
+        end = start
+        with open(self.path, "rb") as f:
+            f.seek(start)
+            if self.compress:
+                for offset, length, block in _iter_gzip_members(f):
+                    block_start = start + offset
+                    inner = 0
+                    for line in block.splitlines(keepends=True):
+                        entries.append((json.loads(line)["note_id"], (block_start, length, inner, len(line))))
+                        inner += len(line)
+                    end = block_start + length
+            else:
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        break
+                    entries.append((json.loads(line)["note_id"], (end, len(line), 0, len(line))))
+                    end += len(line)
+        return entries, end
+
+    def _recover_tail(self) -> None:
+        """Indexes any complete records past the indexed ones (from an interrupted write), and cuts off the rest"""
+        entries, end = self._scan(self._data_end)
+        if entries:
+            logging.warning("%s holds %d unindexed records (from an interrupted write?)", self.path, len(entries))
+            self._write_entries(entries)
+        if os.path.getsize(self.path) > end:
+            logging.warning("%s holds unindexed data (from an interrupted write?), cutting it off", self.path)
+            self._file.truncate(end)
+
+    def reindex(self) -> None:
+        """
+        Rebuilds the index by scanning the whole data file
+
+        Opening a store does this automatically if the data file exists but its index does not.
+        Any incomplete record or block at the end of the data file is cut off.
+        """
+        self.flush()
+        entries, end = self._scan(0)
+
+        if os.path.getsize(self.path) > end:
+            logging.warning("%s ends with an incomplete record, cutting it off", self.path)
+            self._file.truncate(end)
+
+        tmp_path = f"{self.index_path}.tmp"
+        header = {"format": _INDEX_FORMAT, "version": _INDEX_VERSION, "compress": self.compress}
+        with open(tmp_path, "wb") as f:
+            f.write(json.dumps(header).encode("utf8") + b"\n")
+            f.write(self._index_lines(entries))
+        os.replace(tmp_path, self.index_path)
+        self._index = {}
+        self._data_end = 0
+        self._write_entries(entries, append=False)
+
+    ###########################################################################
+    #
+    # Merging shards
+    #
+    ###########################################################################
+
+    def merge(self, shard: "ResultStore") -> None:
+        """
+        Appends every record of another store to this one
+
+        When both stores use the same compression, the data is copied as raw bytes (without re-parsing anything)
+        and only the index offsets are shifted.
+
+        :param shard: store to copy from (like the output of one parallel worker)
+        """
+        self.flush()
+        shard.flush()
+        if shard.compress != self.compress:
+            for note_id, ctakes_json in shard.iter_json():
+                self.append_json(note_id, ctakes_json)
+            self.flush()
+            return
+
+        start = self._data_end
+        with open(shard.path, "rb") as f:
+            shutil.copyfileobj(f, self._file)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+        # Re-read the shard's index file rather than its dict, to keep duplicate ids in their original order
+        shifted = []
+        with open(shard.index_path, "rb") as f:
+            f.readline()  # header
+            for line in f:
+                note_id, offset, length, inner_offset, inner_length = json.loads(line)
+                shifted.append((note_id, (start + offset, length, inner_offset, inner_length)))
+        self._write_entries(shifted)
+
+    @classmethod
+    def merge_files(cls, path: str, shard_paths: Iterable[str], compress: bool = None) -> "ResultStore":
+        """
+        :param path: store to merge into (created if needed)
+        :param shard_paths: data files of the stores to merge, in order
+        :param compress: whether the merged store gzips its blocks (see `ResultStore`)
+        :return: the merged store (remember to close it)
+        """
+        merged = cls(path, compress=compress)
+        for shard_path in shard_paths:
+            with cls(shard_path) as shard:
+                merged.merge(shard)
+        return merged
+
+    ###########################################################################
+    #
+    # Lifecycle
+    #
+    ###########################################################################
+
+    def close(self) -> None:
+        self.flush()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,364 @@
+"""
+A stand-in for cTAKES and cNLP transformer servers, for offline load and performance testing
+
+It speaks the same HTTP contracts as the real servers:
+- cTAKES: POST text to /ctakes-web-rest/service/analyze (with utf16 span offsets, just like cTAKES)
+- cNLP: POST {"doc_text", "entities"} JSON to /negation/process or /termexists/process
+
+Answers come from a fixed fixture JSON, or from a dictionary matcher over BSV concepts
+(the packaged COVID symptoms by default), with a crude negation check for polarity.
+Latency, error rate and concurrency are configurable, to exercise a client's concurrency, retries and caching.
+
+    async with StubServer(latency=lognormal_latency(0.2), error_rate=0.01, max_concurrency=2) as server:
+        ner = await client.extract(text, url=server.ctakes_url)
+
+Or from the command line: ctakesclient stub-server --port 8080 --port 8000 --port 8001
+"""
+
+import asyncio
+import bisect
+import collections
+import json
+import math
+import random
+import re
+from typing import Callable, Iterable, List, Optional, Tuple, Union
+
+from ctakesclient import filesystem
+from ctakesclient.filesystem import BsvConcept
+from ctakesclient.prefilter import TermMatcher, normalize
+from ctakesclient.typesystem import Polarity, UmlsTypeMention
+
+CTAKES_PATH = "/ctakes-web-rest/service/analyze"
+NEGATION_PATH = "/negation/process"
+TERM_EXISTS_PATH = "/termexists/process"
+
+_ROUTES = {CTAKES_PATH: "ctakes", NEGATION_PATH: "negation", TERM_EXISTS_PATH: "termexists"}
+
+# A negation trigger, with no sentence break or terminating word (like "but") between it and the end of the text
+_NEGATION = re.compile(
+    r"\b(?:no|not|denies|denied|without|negative for|free of|absence of|ruled out)\b"
+    r"(?:(?!\b(?:but|however|although|though|except|yet)\b)[^.;:!?\n])*$",
+    re.IGNORECASE,
+)
+_NEGATION_WINDOW = 60  # characters before a mention to look for a trigger in
+
+# Semantic group -> mention type, for dictionary matches (DISO is split further, see _mention_type)
+_GROUP_MENTIONS = {
+    "ANAT": UmlsTypeMention.AnatomicalSite,
+    "CHEM": UmlsTypeMention.Medication,
+    "DISO": UmlsTypeMention.DiseaseDisorder,
+    "PROC": UmlsTypeMention.Procedure,
+}
+_SIGN_SYMPTOM_TUIS = {"T033", "T184"}  # Finding, Sign or Symptom
+
+Latency = Union[float, Callable[[int], float]]
+
+###############################################################################
+#
+# Latency distributions
+#
+###############################################################################
+
+
+def lognormal_latency(
+    median: float, sigma: float = 0.5, per_1k_chars: float = 0, seed: int = None
+) -> Callable[[int], float]:
+    """
+    Latency with a long tail, like real servers
+
+    :param median: median seconds per request (for an empty note)
+    :param sigma: spread of the distribution (0 for a constant)
+    :param per_1k_chars: extra median seconds for every 1000 characters in the note
+    :param seed: random seed, for repeatable runs
+    :return: function of note length to seconds, for StubServer's `latency`
+    """
+    rng = random.Random(seed)
+
+    def latency(text_length: int) -> float:
+        return (median + per_1k_chars * text_length / 1000) * math.exp(rng.gauss(0, sigma))
+
+    return latency
+
+
+###############################################################################
+#
+# Answers
+#
+###############################################################################
+
+
+def is_negated(text: str, begin: int) -> bool:
+    """
+    :param text: note text
+    :param begin: character index of a mention
+    :return: whether a negation trigger (like "denies") comes shortly before the mention, in the same sentence
+    """
+    return _NEGATION.search(text, max(0, begin - _NEGATION_WINDOW), begin) is not None
+
+
+def _mention_type(concept: BsvConcept, tui_groups: dict) -> UmlsTypeMention:
+    semantic_type = tui_groups.get(concept.tui)
+    mention_type = _GROUP_MENTIONS.get(semantic_type.group_id) if semantic_type else None
+    if mention_type == UmlsTypeMention.DiseaseDisorder and concept.tui in _SIGN_SYMPTOM_TUIS:
+        return UmlsTypeMention.SignSymptom
+    return mention_type or UmlsTypeMention.CustomDict
+
+
+class DictionaryAnnotator:
+    """Finds dictionary concepts in text, answering like cTAKES would"""
+
+    def __init__(self, concepts: Iterable[BsvConcept]):
+        """
+        :param concepts: dictionary rows, like `filesystem.covid_symptoms()`
+        """
+        tui_groups = filesystem.map_tui_semantic_group()
+        self._terms = collections.defaultdict(lambda: collections.defaultdict(dict))  # term -> type -> concepts
+        for concept in concepts:
+            attributes = {"code": concept.code, "cui": concept.cui, "codingScheme": concept.vocab, "tui": concept.tui}
+            for term in (concept.text, concept.pref):
+                term = normalize(term or "").strip()
+                if term:
+                    mention_type = _mention_type(concept, tui_groups).value
+                    self._terms[term][mention_type][tuple(attributes.values())] = attributes
+        self._matcher = TermMatcher(self._terms)
+
+    def annotate(self, text: str) -> dict:
+        """
+        :param text: note text
+        :return: cTAKES response JSON, with cTAKES-style utf16 span offsets
+        """
+        to_utf16 = _utf16_indexer(text)
+        response = {}
+        for begin, end in sorted(self._matcher.find_spans(text)):
+            if end < len(text) and text[end].isalnum():
+                continue  # unlike a prefilter, only take whole words (so "ha" doesn't match in "has")
+            found = text[begin:end]
+            polarity = Polarity.neg if is_negated(text, begin) else Polarity.pos
+            for mention_type, concepts in self._terms.get(normalize(found).strip(), {}).items():
+                response.setdefault(mention_type, []).append(
+                    {
+                        "begin": to_utf16(begin),
+                        "end": to_utf16(end),
+                        "text": found,
+                        "polarity": polarity.value,
+                        "conceptAttributes": list(concepts.values()),
+                        "type": mention_type,
+                    }
+                )
+        return response
+
+
+def _utf16_indexer(text: str) -> Callable[[int], int]:
+    """
+    :param text: any text
+    :return: function from a character index into the text to a utf16 code unit index (what cTAKES uses)
+    """
+    astral = [i for i, char in enumerate(text) if ord(char) > 0xFFFF]
+    if not astral:
+        return lambda index: index
+    return lambda index: index + bisect.bisect_left(astral, index)  # each astral character is two utf16 units
+
+
+def polarity_statuses(text: str, spans: List[Tuple[int, int]], model: str) -> List[int]:
+    """
+    :param text: note text
+    :param spans: (begin, end) character spans to check
+    :param model: "negation" or "termexists"
+    :return: cNLP statuses for the spans (negation: 1 is negated, termexists: -1 is negated)
+    """
+    negated = 1 if model == "negation" else -1
+    return [negated if is_negated(text, begin) else -negated for begin, _ in spans]
+
+
+###############################################################################
+#
+# Server
+#
+###############################################################################
+
+
+class _BadRequest(Exception):
+    pass
+
+
+class StubServer:
+    """
+    An asyncio HTTP/1.1 server answering like cTAKES and cNLP do
+
+    Start it with `async with` (or `start`/`stop`), then point clients at `ctakes_url` and friends.
+    """
+
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        fixture: dict = None,
+        concepts: Iterable[BsvConcept] = None,
+        latency: Latency = 0,
+        error_rate: float = 0,
+        error_status: int = 503,
+        max_concurrency: int = None,
+        seed: int = None,
+    ):
+        """
+        :param host: interface to listen on
+        :param port: port to listen on (0 picks a free one, see `port` once started)
+        :param fixture: cTAKES response JSON to answer every cTAKES request with (instead of a dictionary lookup)
+        :param concepts: dictionary to annotate notes with (default: the packaged COVID symptoms)
+        :param latency: seconds to wait before answering, or a function of note length to seconds
+        :param error_rate: fraction of requests (0 to 1) to fail with `error_status`
+        :param error_status: HTTP status for failed requests
+        :param max_concurrency: requests to work on at once (more wait their turn, like a real server's workers)
+        :param seed: random seed for errors, for repeatable runs
+        """
+        self.host = host
+        self.port = port
+        self.fixture = fixture
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.annotator = None if fixture is not None else DictionaryAnnotator(concepts or filesystem.covid_symptoms())
+
+        self.requests = collections.Counter()  # route -> requests answered (including errors)
+        self.errors = 0  # deliberately failed requests
+        self.active = 0  # requests being worked on right now
+        self.max_active = 0  # most requests worked on at once
+
+        self._random = random.Random(seed)
+        self._slots = asyncio.Semaphore(max_concurrency) if max_concurrency else None
+        self._server: Optional[asyncio.Server] = None
+        self._connections = {}  # handler task -> its writer
+
+    @property
+    def base_url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    @property
+    def ctakes_url(self) -> str:
+        return self.base_url + CTAKES_PATH
+
+    @property
+    def negation_url(self) -> str:
+        return self.base_url + NEGATION_PATH
+
+    @property
+    def term_exists_url(self) -> str:
+        return self.base_url + TERM_EXISTS_PATH
+
+    async def start(self) -> None:
+        self._server = await asyncio.start_server(self._serve, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def stop(self) -> None:
+        self._server.close()
+        handlers = list(self._connections)
+        for writer in self._connections.values():
+            writer.close()  # idle keep-alive connections would otherwise never end
+        await asyncio.gather(*handlers, return_exceptions=True)
+        await self._server.wait_closed()
+
+    async def serve_forever(self) -> None:
+        if self._server is None:
+            await self.start()
+        await self._server.serve_forever()
+
+    async def __aenter__(self) -> "StubServer":
+        await self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback) -> None:
+        await self.stop()
+
+    ###########################################################################
+    #
+    # HTTP
+    #
+    ###########################################################################
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        handler = asyncio.current_task()
+        self._connections[handler] = writer
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break  # connection closed
+
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+
+                method, path, *_ = request_line.decode("latin-1").split()
+                status, payload = await self._answer(method, path.partition("?")[0], body)
+
+                keep_alive = headers.get("connection", "").lower() != "close"
+                data = json.dumps(payload).encode("utf8")
+                writer.write(
+                    f"HTTP/1.1 {status} {'OK' if status == 200 else 'Error'}\r\n"
+                    f"Content-Type: application/json\r\n"
+                    f"Content-Length: {len(data)}\r\n"
+                    f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode("latin-1") + data
+                )
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass  # client went away or sent garbage, either way we're done with this connection
+        finally:
+            del self._connections[handler]
+            writer.close()
+
+    async def _answer(self, method: str, path: str, body: bytes) -> Tuple[int, object]:
+        route = _ROUTES.get(path)
+        if route is None:
+            return 404, {"error": f"unknown path {path}"}
+        if method != "POST":
+            return 405, {"error": "use POST"}
+
+        # Branch rather than fall back to nullcontext(), which only supports "async with" from Python 3.10 on
+        if self._slots is None:
+            return await self._work(route, body)
+        async with self._slots:
+            return await self._work(route, body)
+
+    async def _work(self, route: str, body: bytes) -> Tuple[int, object]:
+        self.requests[route] += 1
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        try:
+            try:
+                text, spans = self._parse(route, body)
+            except _BadRequest as exc:
+                return 400, {"error": str(exc)}
+
+            latency = self.latency(len(text)) if callable(self.latency) else self.latency
+            if latency > 0:
+                await asyncio.sleep(latency)
+
+            if self.error_rate and self._random.random() < self.error_rate:
+                self.errors += 1
+                return self.error_status, {"error": "simulated failure"}
+
+            if route != "ctakes":
+                return 200, {"statuses": polarity_statuses(text, spans, route)}
+            if self.fixture is not None:
+                return 200, self.fixture
+            return 200, self.annotator.annotate(text)
+        finally:
+            self.active -= 1
+
+    @staticmethod
+    def _parse(route: str, body: bytes) -> Tuple[str, List[Tuple[int, int]]]:
+        try:
+            if route == "ctakes":
+                return body.decode("utf8"), []
+            doc = json.loads(body)
+            return doc["doc_text"], [tuple(span) for span in doc["entities"]]
+        except (UnicodeDecodeError, ValueError, KeyError, TypeError) as exc:
+            raise _BadRequest(f"bad request body: {exc}") from exc
@@ -1,8 +1,14 @@
 """Transforms cTAKES output into FHIR resources"""
 
+import asyncio
+import collections
+import concurrent.futures
+import hashlib
+import json
+import os
 import uuid
 from enum import Enum
-from typing import List, Optional
+from typing import AsyncIterable, AsyncIterator, Iterable, Iterator, List, Optional, Tuple, Union
 
 from fhirclient.models.codeableconcept import CodeableConcept
 from fhirclient.models.coding import Coding
@@ -16,7 +22,8 @@ from fhirclient.models.procedure import Procedure
 from fhirclient.models.resource import Resource
 
 import ctakesclient
-from ctakesclient.typesystem import CtakesJSON, MatchText, Polarity, Span
+from ctakesclient import metrics
+from ctakesclient.typesystem import CtakesJSON, MatchText, Polarity, Span, UmlsTypeMention
 
 
 ###############################################################################
@@ -126,6 +133,44 @@ def _random_id() -> str:
     return str(uuid.uuid4())
 
 
+# Namespace for deterministic resource ids (never change this, or every stable id would change with it)
+NLP_ID_NAMESPACE = uuid.UUID("6b0b5e43-7d8b-4b4c-9a52-1f6a2d1c7e90")
+
+
+def stable_id(resource_type: str, docref_id: str, match: MatchText) -> str:
+    """
+    Provides a deterministic id for a resource derived from an NLP match
+
+    Re-running NLP over an unchanged note gives the same ids, so stored resources can be updated in place
+    (or skipped, see `resource_hash`) rather than deleted and re-inserted.
+
+    :param resource_type: Name of resource, like "Observation"
+    :param docref_id: ID for the DocumentReference the match came from
+    :param match: NLP match (its span, mention type, and concepts make up the id)
+    :return: UUID5 string
+    """
+    concepts = sorted((c.codingScheme or "", c.code or "", c.cui or "", c.tui or "") for c in match.conceptAttributes)
+    name = json.dumps([resource_type, docref_id, match.begin, match.end, match.type.value, concepts])
+    return str(uuid.uuid5(NLP_ID_NAMESPACE, name))
+
+
+def _resource_id(resource_type: str, docref_id: str, match: MatchText, deterministic_id: bool) -> str:
+    return stable_id(resource_type, docref_id, match) if deterministic_id else _random_id()
+
+
+def resource_hash(resource: dict) -> str:
+    """
+    Content hash of a FHIR resource JSON, independent of key order
+
+    Pair with deterministic ids to skip serializing and upserting resources that are already stored unchanged.
+
+    :param resource: FHIR resource JSON
+    :return: sha256 hex digest
+    """
+    canonical = json.dumps(resource, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(canonical.encode("utf8")).hexdigest()
+
+
 def _ref_resource(resource_type: str, resource_id: str) -> FHIRReference:
     """
     Reference the FHIR proper way
@@ -290,10 +335,10 @@ def nlp_concept(match: MatchText) -> CodeableConcept:
     :return: FHIR CodeableConcept with both UMLS CUI and source vocab CODE
     """
     coded = []
-    cuis = set()
+    cuis = {}  # CUIs are often duplicated across vocab mentions, so dedupe them (keeping mention order)
     for concept in match.conceptAttributes:
         coded.append(Coding({"system": _vocab_url(concept.codingScheme), "code": concept.code}))
-        cuis.add(concept.cui)  # collect CUIs as a set, because they are often duplicated across vocab mentions
+        cuis[concept.cui] = None
 
     for cui in cuis:
         coded.append(Coding({"system": Vocab.UMLS.value, "code": cui}))
@@ -307,6 +352,7 @@ def nlp_condition(
     docref_id: str,
     nlp_match: MatchText,
     source: Extension = None,
+    deterministic_id: bool = False,
 ) -> Condition:
     """
     FHIR Condition from an NLP match (e.g. a disease disorder)
@@ -319,12 +365,13 @@ def nlp_condition(
     :param docref_id: ID for DocumentReference (isa REF can be UUID)
     :param nlp_match: response from cTAKES or other NLP Client
     :param source: NLP Version information, if none is provided use version of ctakesclient.
-    :return: FHIR Condition (note it will have a random id)
+    :param deterministic_id: use a `stable_id` instead of a random id
+    :return: FHIR Condition (note it will have a random id, unless deterministic_id is set)
     """
     condition = Condition()
 
     # id linkage
-    condition.id = _random_id()
+    condition.id = _resource_id("Condition", docref_id, nlp_match, deterministic_id)
     condition.subject = _ref_subject(subject_id)
     condition.encounter = _ref_encounter(encounter_id)
 
@@ -345,6 +392,7 @@ def nlp_observation(
     docref_id: str,
     nlp_match: MatchText,
     source: Extension = None,
+    deterministic_id: bool = False,
 ) -> Observation:
     """
     FHIR Observation from an NLP match (e.g. a sign symptom)
@@ -356,12 +404,13 @@ def nlp_observation(
     :param encounter_id: ID for visit (isa REF can be UUID)
     :param nlp_match: response from cTAKES or other NLP Client
     :param source: NLP Version information, if none is provided use version of ctakesclient.
-    :return: FHIR Observation (note it will have a random id)
+    :param deterministic_id: use a `stable_id` instead of a random id
+    :return: FHIR Observation (note it will have a random id, unless deterministic_id is set)
     """
     observation = Observation()
 
     # id linkage
-    observation.id = _random_id()
+    observation.id = _resource_id("Observation", docref_id, nlp_match, deterministic_id)
     observation.subject = _ref_subject(subject_id)
     observation.encounter = _ref_encounter(encounter_id)
     observation.status = "preliminary"
@@ -379,6 +428,7 @@ def nlp_medication(
     docref_id: str,
     nlp_match: MatchText,
     source: Extension = None,
+    deterministic_id: bool = False,
 ) -> MedicationStatement:
     """
     FHIR MedicationStatement from an NLP match
@@ -390,12 +440,13 @@ def nlp_medication(
     :param encounter_id: ID for encounter (isa REF can be UUID)
     :param nlp_match: response from cTAKES or other NLP Client
     :param source: NLP Version information, if none is provided use version of ctakesclient.
-    :return: FHIR MedicationStatement (note it will have a random id)
+    :param deterministic_id: use a `stable_id` instead of a random id
+    :return: FHIR MedicationStatement (note it will have a random id, unless deterministic_id is set)
     """
     medication = MedicationStatement()
 
     # id linkage
-    medication.id = _random_id()
+    medication.id = _resource_id("MedicationStatement", docref_id, nlp_match, deterministic_id)
     medication.subject = _ref_subject(subject_id)
     medication.context = _ref_encounter(encounter_id)
     medication.status = "unknown"
@@ -413,6 +464,7 @@ def nlp_procedure(
     docref_id: str,
     nlp_match: MatchText,
     source: Extension = None,
+    deterministic_id: bool = False,
 ) -> Procedure:
     """
     FHIR Procedure from an NLP match
@@ -425,12 +477,13 @@ def nlp_procedure(
     :param docref_id: ID for DocumentReference (isa REF can be UUID)
     :param nlp_match: response from cTAKES or other NLP Client
     :param source: NLP Version information, if none is provided use version of ctakesclient.
-    :return: FHIR Procedure (note it will have a random id)
+    :param deterministic_id: use a `stable_id` instead of a random id
+    :return: FHIR Procedure (note it will have a random id, unless deterministic_id is set)
     """
     procedure = Procedure()
 
     # id linkage
-    procedure.id = _random_id()
+    procedure.id = _resource_id("Procedure", docref_id, nlp_match, deterministic_id)
     procedure.subject = _ref_subject(subject_id)
     procedure.encounter = _ref_encounter(encounter_id)
     procedure.status = "unknown"
@@ -449,6 +502,7 @@ def nlp_fhir(
     nlp_results: CtakesJSON,
     source: Extension = None,
     polarity: Polarity = Polarity.pos,
+    deterministic_id: bool = False,
 ) -> List[DomainResource]:
     """
     Returns all FHIR resources we can generate from a patient encounter.
@@ -465,20 +519,546 @@ def nlp_fhir(
     :param nlp_results: response from cTAKES or other NLP Client
     :param source: NLP Version information, if none is provided use version of ctakesclient.
     :param polarity: filter only positive mentions by default
+    :param deterministic_id: use `stable_id` ids instead of random ids
     :return: List of FHIR Resources (DomainResource)
     """
+    tic = metrics.start()
     as_fhir = []
+    ids = deterministic_id
 
     for match in nlp_results.list_sign_symptom(polarity):
-        as_fhir.append(nlp_observation(subject_id, encounter_id, docref_id, match, source))
+        as_fhir.append(nlp_observation(subject_id, encounter_id, docref_id, match, source, deterministic_id=ids))
 
     for match in nlp_results.list_medication(polarity):
-        as_fhir.append(nlp_medication(subject_id, encounter_id, docref_id, match, source))
+        as_fhir.append(nlp_medication(subject_id, encounter_id, docref_id, match, source, deterministic_id=ids))
 
     for match in nlp_results.list_disease_disorder(polarity):
-        as_fhir.append(nlp_condition(subject_id, encounter_id, docref_id, match, source))
+        as_fhir.append(nlp_condition(subject_id, encounter_id, docref_id, match, source, deterministic_id=ids))
 
     for match in nlp_results.list_procedure(polarity):
-        as_fhir.append(nlp_procedure(subject_id, encounter_id, docref_id, match, source))
+        as_fhir.append(nlp_procedure(subject_id, encounter_id, docref_id, match, source, deterministic_id=ids))
 
+    metrics.stage("fhir", tic)
     return as_fhir
+
+
+###############################################################################
+#
+# Fast JSON conversion functions
+#
+# These build the exact same FHIR JSON as calling as_json() on the results of the functions above,
+# but directly as plain dicts, skipping the (slow) validating fhirclient model classes.
+#
+###############################################################################
+
+
+def _json_reference(resource_type: str, resource_id: str) -> dict:
+    """
+    :param resource_type: Name of resource, like "Patient"
+    :param resource_id: ID for resource (isa REF can be UUID)
+    :return: FHIR Reference JSON as Resource/$id
+    """
+    if not resource_id:
+        raise ValueError("Missing resource ID")
+    return {"reference": f"{resource_type}/{resource_id}"}
+
+
+def _json_nlp_source(source=None) -> dict:
+    """
+    :param source: NLP Version information (Extension or its JSON), if none is provided use version of ctakesclient.
+    :return: FHIR Extension JSON for "nlp-source"
+    """
+    if source is None:
+        return {
+            "extension": [_nlp_algorithm().as_json(), _nlp_version().as_json()],
+            "url": NLP_SOURCE_URL,
+        }
+    if isinstance(source, Extension):
+        return source.as_json()
+    return source
+
+
+def _json_nlp_modifier(source_json: dict, polarity: Optional[Polarity]) -> list:
+    """
+    :param source_json: "nlp-source" Extension JSON
+    :param polarity: pos= concept is true, neg=concept is negated ("patient denies cough")
+    :return: FHIR resource.modifierExtension JSON
+    """
+    if polarity is None:
+        return [source_json]
+    return [source_json, {"url": NLP_POLARITY_URL, "valueBoolean": polarity == Polarity.pos}]
+
+
+def _json_nlp_derivation(docref_id: str, span: Span) -> dict:
+    """
+    :param docref_id: ID for the DocumentReference from which NLP resource was derived.
+    :param span: character span of the match in the document
+    :return: FHIR Extension JSON for DerivationReference
+    """
+    values = [{"url": "reference", "valueReference": _json_reference("DocumentReference", docref_id)}]
+
+    offset = span.begin
+    length = span.end - span.begin
+    if offset:
+        values.append({"url": "offset", "valueInteger": offset})
+    if length:
+        values.append({"url": "length", "valueInteger": length})
+
+    return {"extension": values, "url": FHIR_DERIVATION_REF_URL}
+
+
+def _json_coding(system: Optional[str], code: Optional[str]) -> dict:
+    coding = {}
+    if code is not None:
+        coding["code"] = code
+    if system is not None:
+        coding["system"] = system
+    return coding
+
+
+def nlp_concept_json(match: MatchText) -> dict:
+    """
+    Same as `nlp_concept(match).as_json()`, but faster
+
+    :param match: everything needed to make CodeableConcept
+    :return: FHIR CodeableConcept JSON with both UMLS CUI and source vocab CODE
+    """
+    coded = []
+    cuis = {}  # deduped in mention order, like nlp_concept
+    for concept in match.conceptAttributes:
+        coded.append(_json_coding(_vocab_url(concept.codingScheme), concept.code))
+        cuis[concept.cui] = None
+
+    for cui in cuis:
+        coded.append(_json_coding(Vocab.UMLS.value, cui))
+
+    concept_json = {}
+    if coded:
+        concept_json["coding"] = coded
+    if match.text is not None:
+        concept_json["text"] = match.text
+    return concept_json
+
+
+def nlp_condition_json(
+    subject_id: str,
+    encounter_id: str,
+    docref_id: str,
+    nlp_match: MatchText,
+    source=None,
+    deterministic_id: bool = False,
+) -> dict:
+    """
+    Same as `nlp_condition(...).as_json()`, but faster
+
+    :param subject_id: ID for patient (isa REF can be UUID)
+    :param encounter_id: ID for visit (isa REF can be UUID)
+    :param docref_id: ID for DocumentReference (isa REF can be UUID)
+    :param nlp_match: response from cTAKES or other NLP Client
+    :param source: NLP Version information (Extension or its JSON), if none is provided use version of ctakesclient.
+    :param deterministic_id: use a `stable_id` instead of a random id
+    :return: FHIR Condition JSON (note it will have a random id, unless deterministic_id is set)
+    """
+    return {
+        "id": _resource_id("Condition", docref_id, nlp_match, deterministic_id),
+        "extension": [_json_nlp_derivation(docref_id, nlp_match.span())],
+        "modifierExtension": _json_nlp_modifier(_json_nlp_source(source), nlp_match.polarity),
+        "code": nlp_concept_json(nlp_match),
+        "encounter": _json_reference("Encounter", encounter_id),
+        "subject": _json_reference("Patient", subject_id),
+        "verificationStatus": {
+            "coding": [{"code": "unconfirmed", "system": "http://terminology.hl7.org/CodeSystem/condition-ver-status"}],
+            "text": "Unconfirmed",
+        },
+        "resourceType": "Condition",
+    }
+
+
+def nlp_observation_json(
+    subject_id: str,
+    encounter_id: str,
+    docref_id: str,
+    nlp_match: MatchText,
+    source=None,
+    deterministic_id: bool = False,
+) -> dict:
+    """
+    Same as `nlp_observation(...).as_json()`, but faster
+
+    :param subject_id: ID for patient (isa REF can be UUID)
+    :param encounter_id: ID for visit (isa REF can be UUID)
+    :param docref_id: ID for DocumentReference (isa REF can be UUID)
+    :param nlp_match: response from cTAKES or other NLP Client
+    :param source: NLP Version information (Extension or its JSON), if none is provided use version of ctakesclient.
+    :param deterministic_id: use a `stable_id` instead of a random id
+    :return: FHIR Observation JSON (note it will have a random id, unless deterministic_id is set)
+    """
+    return {
+        "id": _resource_id("Observation", docref_id, nlp_match, deterministic_id),
+        "extension": [_json_nlp_derivation(docref_id, nlp_match.span())],
+        "modifierExtension": _json_nlp_modifier(_json_nlp_source(source), nlp_match.polarity),
+        "code": nlp_concept_json(nlp_match),
+        "encounter": _json_reference("Encounter", encounter_id),
+        "status": "preliminary",
+        "subject": _json_reference("Patient", subject_id),
+        "resourceType": "Observation",
+    }
+
+
+def nlp_medication_json(
+    subject_id: str,
+    encounter_id: str,
+    docref_id: str,
+    nlp_match: MatchText,
+    source=None,
+    deterministic_id: bool = False,
+) -> dict:
+    """
+    Same as `nlp_medication(...).as_json()`, but faster
+
+    :param subject_id: ID for patient (isa REF can be UUID)
+    :param encounter_id: ID for encounter (isa REF can be UUID)
+    :param docref_id: ID for DocumentReference (isa REF can be UUID)
+    :param nlp_match: response from cTAKES or other NLP Client
+    :param source: NLP Version information (Extension or its JSON), if none is provided use version of ctakesclient.
+    :param deterministic_id: use a `stable_id` instead of a random id
+    :return: FHIR MedicationStatement JSON (note it will have a random id, unless deterministic_id is set)
+    """
+    return {
+        "id": _resource_id("MedicationStatement", docref_id, nlp_match, deterministic_id),
+        "extension": [_json_nlp_derivation(docref_id, nlp_match.span())],
+        "modifierExtension": _json_nlp_modifier(_json_nlp_source(source), nlp_match.polarity),
+        "context": _json_reference("Encounter", encounter_id),
+        "medicationCodeableConcept": nlp_concept_json(nlp_match),
+        "status": "unknown",
+        "subject": _json_reference("Patient", subject_id),
+        "resourceType": "MedicationStatement",
+    }
+
+
+def nlp_procedure_json(
+    subject_id: str,
+    encounter_id: str,
+    docref_id: str,
+    nlp_match: MatchText,
+    source=None,
+    deterministic_id: bool = False,
+) -> dict:
+    """
+    Same as `nlp_procedure(...).as_json()`, but faster
+
+    :param subject_id: ID for Patient (isa REF can be UUID)
+    :param encounter_id: ID for visit (isa REF can be UUID)
+    :param docref_id: ID for DocumentReference (isa REF can be UUID)
+    :param nlp_match: response from cTAKES or other NLP Client
+    :param source: NLP Version information (Extension or its JSON), if none is provided use version of ctakesclient.
+    :param deterministic_id: use a `stable_id` instead of a random id
+    :return: FHIR Procedure JSON (note it will have a random id, unless deterministic_id is set)
+    """
+    return {
+        "id": _resource_id("Procedure", docref_id, nlp_match, deterministic_id),
+        "extension": [_json_nlp_derivation(docref_id, nlp_match.span())],
+        "modifierExtension": _json_nlp_modifier(_json_nlp_source(source), nlp_match.polarity),
+        "code": nlp_concept_json(nlp_match),
+        "encounter": _json_reference("Encounter", encounter_id),
+        "status": "unknown",
+        "subject": _json_reference("Patient", subject_id),
+        "resourceType": "Procedure",
+    }
+
+
+def nlp_fhir_json(
+    subject_id: str,
+    encounter_id: str,
+    docref_id: str,
+    nlp_results: CtakesJSON,
+    source=None,
+    polarity: Polarity = Polarity.pos,
+    deterministic_id: bool = False,
+) -> List[dict]:
+    """
+    Same as `[x.as_json() for x in nlp_fhir(...)]`, but faster
+
+    :param subject_id: ID for Patient (isa REF can be UUID)
+    :param encounter_id: ID for visit (isa REF can be UUID)
+    :param docref_id: ID for DocumentReference (isa REF can be UUID)
+    :param nlp_results: response from cTAKES or other NLP Client
+    :param source: NLP Version information (Extension or its JSON), if none is provided use version of ctakesclient.
+    :param polarity: filter only positive mentions by default
+    :param deterministic_id: use `stable_id` ids instead of random ids
+    :return: List of FHIR resource JSON
+    """
+    tic = metrics.start()
+    source = _json_nlp_source(source)
+    as_fhir = []
+    ids = deterministic_id
+
+    for match in nlp_results.list_sign_symptom(polarity):
+        as_fhir.append(nlp_observation_json(subject_id, encounter_id, docref_id, match, source, deterministic_id=ids))
+
+    for match in nlp_results.list_medication(polarity):
+        as_fhir.append(nlp_medication_json(subject_id, encounter_id, docref_id, match, source, deterministic_id=ids))
+
+    for match in nlp_results.list_disease_disorder(polarity):
+        as_fhir.append(nlp_condition_json(subject_id, encounter_id, docref_id, match, source, deterministic_id=ids))
+
+    for match in nlp_results.list_procedure(polarity):
+        as_fhir.append(nlp_procedure_json(subject_id, encounter_id, docref_id, match, source, deterministic_id=ids))
+
+    metrics.stage("fhir", tic)
+    return as_fhir
+
+
+###############################################################################
+#
+# Batch conversion of many documents
+#
+###############################################################################
+
+_CONDITION_VERIFICATION_STATUS = {
+    "coding": [{"code": "unconfirmed", "system": "http://terminology.hl7.org/CodeSystem/condition-ver-status"}],
+    "text": "Unconfirmed",
+}
+
+
+class NlpFhirConverter:
+    """
+    Converts the NLP results of many documents into FHIR JSON, sharing as much work between them as possible
+
+    The output is identical to calling `nlp_fhir_json` on each document, but:
+    - each document's mentions are walked once
+    - the parts that never change (like the "nlp-source" extension and the Patient/Encounter/DocumentReference
+      references of a document) are built once and shared by every resource that uses them
+    - the CodeableConcept of each unique concept set is built once and shared too
+
+    Because of that sharing, treat the returned resources as read-only (or deep-copy them before editing).
+    """
+
+    _CONCEPT_CACHE_SIZE = 100000
+
+    def __init__(self, source=None, polarity: Polarity = Polarity.pos, deterministic_id: bool = False):
+        """
+        :param source: NLP Version information (Extension or its JSON), if none is provided use version of ctakesclient.
+        :param polarity: filter only positive mentions by default (None for all mentions)
+        :param deterministic_id: use `stable_id` ids instead of random ids
+        """
+        self.source = source
+        self.deterministic_id = deterministic_id
+        self.polarity = None if polarity is None else MatchText.parse_polarity(polarity)
+
+        source_json = _json_nlp_source(source)
+        self._modifiers = {p: _json_nlp_modifier(source_json, p) for p in [None, *Polarity]}
+        self._concepts = {}
+
+    def convert(self, subject_id: str, encounter_id: str, docref_id: str, nlp_results: CtakesJSON) -> List[dict]:
+        """
+        :param subject_id: ID for Patient (isa REF can be UUID)
+        :param encounter_id: ID for visit (isa REF can be UUID)
+        :param docref_id: ID for DocumentReference (isa REF can be UUID)
+        :param nlp_results: response from cTAKES or other NLP Client
+        :return: List of FHIR resource JSON, in the same order as `nlp_fhir_json`
+        """
+        tic = metrics.start()
+        subject = _json_reference("Patient", subject_id)
+        encounter = _json_reference("Encounter", encounter_id)
+        docref = {"url": "reference", "valueReference": _json_reference("DocumentReference", docref_id)}
+
+        as_fhir = []
+        for mention_type, resource_type, build in [
+            (UmlsTypeMention.SignSymptom, "Observation", self._observation),
+            (UmlsTypeMention.Medication, "MedicationStatement", self._medication),
+            (UmlsTypeMention.DiseaseDisorder, "Condition", self._condition),
+            (UmlsTypeMention.Procedure, "Procedure", self._procedure),
+        ]:
+            for match in nlp_results.mentions.get(mention_type, []):
+                if self.polarity is None or self.polarity == match.polarity:
+                    common = {
+                        "id": _resource_id(resource_type, docref_id, match, self.deterministic_id),
+                        "extension": [self._derivation(docref, match)],
+                        "modifierExtension": self._modifiers[match.polarity],
+                    }
+                    as_fhir.append(build(common, subject, encounter, self._concept(match)))
+        metrics.stage("fhir", tic)
+        return as_fhir
+
+    def convert_many(self, documents: Iterable[Tuple[str, str, str, CtakesJSON]]) -> Iterator[List[dict]]:
+        """
+        :param documents: (subject_id, encounter_id, docref_id, nlp_results) for each document
+        :return: the FHIR resource JSON of each document, in order
+        """
+        for subject_id, encounter_id, docref_id, nlp_results in documents:
+            yield self.convert(subject_id, encounter_id, docref_id, nlp_results)
+
+    def _concept(self, match: MatchText) -> dict:
+        key = (match.text, tuple((c.codingScheme, c.code, c.cui) for c in match.conceptAttributes))
+        concept = self._concepts.get(key)
+        if concept is None:
+            if len(self._concepts) >= self._CONCEPT_CACHE_SIZE:
+                self._concepts.clear()
+            concept = nlp_concept_json(match)
+            self._concepts[key] = concept
+        return concept
+
+    @staticmethod
+    def _derivation(docref: dict, match: MatchText) -> dict:
+        values = [docref]
+        length = match.end - match.begin
+        if match.begin:
+            values.append({"url": "offset", "valueInteger": match.begin})
+        if length:
+            values.append({"url": "length", "valueInteger": length})
+        return {"extension": values, "url": FHIR_DERIVATION_REF_URL}
+
+    # The resource builders below keep the exact key order of the fhirclient models
+
+    @staticmethod
+    def _observation(common: dict, subject: dict, encounter: dict, concept: dict) -> dict:
+        common.update(code=concept, encounter=encounter, status="preliminary", subject=subject)
+        common["resourceType"] = "Observation"
+        return common
+
+    @staticmethod
+    def _medication(common: dict, subject: dict, encounter: dict, concept: dict) -> dict:
+        common.update(context=encounter, medicationCodeableConcept=concept, status="unknown", subject=subject)
+        common["resourceType"] = "MedicationStatement"
+        return common
+
+    @staticmethod
+    def _condition(common: dict, subject: dict, encounter: dict, concept: dict) -> dict:
+        common.update(
+            code=concept, encounter=encounter, subject=subject, verificationStatus=_CONDITION_VERIFICATION_STATUS
+        )
+        common["resourceType"] = "Condition"
+        return common
+
+    @staticmethod
+    def _procedure(common: dict, subject: dict, encounter: dict, concept: dict) -> dict:
+        common.update(code=concept, encounter=encounter, status="unknown", subject=subject)
+        common["resourceType"] = "Procedure"
+        return common
+
+
+def nlp_fhir_batch(
+    documents: Iterable[Tuple[str, str, str, CtakesJSON]],
+    source=None,
+    polarity: Polarity = Polarity.pos,
+    deterministic_id: bool = False,
+) -> Iterator[List[dict]]:
+    """
+    Same as calling `nlp_fhir_json` on each document, but faster (see `NlpFhirConverter`)
+
+    :param documents: (subject_id, encounter_id, docref_id, nlp_results) for each document
+    :param source: NLP Version information (Extension or its JSON), if none is provided use version of ctakesclient.
+    :param polarity: filter only positive mentions by default
+    :param deterministic_id: use `stable_id` ids instead of random ids
+    :return: the FHIR resource JSON of each document, in order (treat as read-only, parts are shared)
+    """
+    converter = NlpFhirConverter(source=source, polarity=polarity, deterministic_id=deterministic_id)
+    return converter.convert_many(documents)
+
+
+###############################################################################
+#
+# Conversion in a pool of worker processes, off the asyncio event loop
+#
+# Pickling: documents are sent to workers in the compact `CtakesJSON.to_bytes()` encoding (with the "nlp-source"
+# as JSON), never as typesystem or fhirclient objects, and results come back as plain FHIR JSON dicts.
+# So nothing but builtin types ever crosses the process boundary.
+#
+###############################################################################
+
+_worker_converters = {}  # per-process converters, so the concept cache survives between chunks
+
+
+def _convert_chunk(chunk: List[tuple], source_json: dict, polarity: Polarity, deterministic_id: bool) -> List[list]:
+    """
+    Worker side of `nlp_fhir_pooled`
+
+    :param chunk: (subject_id, encounter_id, docref_id, `CtakesJSON.to_bytes()`) for each document
+    :return: FHIR resource JSON for each document
+    """
+    key = (json.dumps(source_json, sort_keys=True), polarity, deterministic_id)
+    converter = _worker_converters.get(key)
+    if converter is None:
+        converter = NlpFhirConverter(source=source_json, polarity=polarity, deterministic_id=deterministic_id)
+        _worker_converters[key] = converter
+
+    return [
+        converter.convert(subject_id, encounter_id, docref_id, CtakesJSON.from_bytes(encoded))
+        for subject_id, encounter_id, docref_id, encoded in chunk
+    ]
+
+
+async def _aiter_chunks(documents: Union[Iterable, AsyncIterable], chunk_size: int) -> AsyncIterator[List[tuple]]:
+    chunk = []
+
+    async def _aiter():
+        if hasattr(documents, "__aiter__"):
+            async for document in documents:
+                yield document
+        else:
+            for document in documents:
+                yield document
+
+    async for subject_id, encounter_id, docref_id, nlp_results in _aiter():
+        chunk.append((subject_id, encounter_id, docref_id, nlp_results.to_bytes()))
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+async def nlp_fhir_pooled(
+    documents: Union[Iterable[Tuple[str, str, str, CtakesJSON]], AsyncIterable[Tuple[str, str, str, CtakesJSON]]],
+    executor: concurrent.futures.Executor = None,
+    chunk_size: int = 32,
+    max_pending: int = None,
+    source=None,
+    polarity: Polarity = Polarity.pos,
+    deterministic_id: bool = False,
+) -> AsyncIterator[List[dict]]:
+    """
+    Converts documents to FHIR JSON in worker processes, without blocking the asyncio event loop
+
+    FHIR conversion is CPU-bound pure Python, so running it inline starves any in-flight HTTP requests.
+    This ships documents to an executor in chunks, and yields each document's resources back in input order.
+
+    Example:
+        async for resources in text2fhir.nlp_fhir_pooled(documents):
+            writer.write_all(resources)
+
+    :param documents: (subject_id, encounter_id, docref_id, nlp_results) for each document (sync or async iterable)
+    :param executor: optional executor to use, default = a new ProcessPoolExecutor just for this call
+    :param chunk_size: documents sent to a worker at once (bigger chunks amortize inter-process overhead)
+    :param max_pending: chunks allowed in flight at once, default = two per CPU
+    :param source: NLP Version information (Extension or its JSON), if none is provided use version of ctakesclient.
+    :param polarity: filter only positive mentions by default
+    :param deterministic_id: use `stable_id` ids instead of random ids
+    :return: the FHIR resource JSON of each document, in order
+    """
+    loop = asyncio.get_running_loop()
+    own_executor = executor is None
+    if own_executor:
+        executor = concurrent.futures.ProcessPoolExecutor()
+    max_pending = max_pending or 2 * (os.cpu_count() or 1)
+    source_json = _json_nlp_source(source)
+
+    pending = collections.deque()
+    try:
+        async for chunk in _aiter_chunks(documents, chunk_size):
+            pending.append(
+                loop.run_in_executor(executor, _convert_chunk, chunk, source_json, polarity, deterministic_id)
+            )
+            while len(pending) >= max_pending:
+                for resources in await pending.popleft():
+                    yield resources
+
+        while pending:
+            for resources in await pending.popleft():
+                yield resources
+    finally:
+        for future in pending:
+            future.cancel()  # also cancels the chunk in the executor, if it has not started yet
+        if own_executor:
+            executor.shutdown(wait=False)  # no cancel_futures, it needs python 3.9
@@ -18,6 +18,7 @@ from typing import List, Tuple
 
 import httpx
 
+from ctakesclient import metrics
 from ctakesclient.exceptions import ClientError
 from ctakesclient.typesystem import Polarity
 
@@ -79,9 +80,7 @@ async def list_polarity(
         raise ValueError(f"Transformer model '{model.value}' not recognized.")
 
     doc = {"doc_text": sentence, "entities": spans}
-    response = await client.post(url=url, json=doc)
-    response.raise_for_status()
-    response = response.json()
+    response = await metrics.post_json(client, model.value, url, len(sentence), json=doc)
     polarities = []
 
     for status in response["statuses"]:
@@ -1,7 +1,7 @@
 """UMLS (Unified Medical Language System)"""
 import json
 import logging
-from typing import List
+from typing import Dict, List, Optional, Tuple
 from enum import Enum
 
 
@@ -182,6 +182,200 @@ class MatchText:
         }
 
 
+###############################################################################
+#
+# Compact binary encoding of CtakesJSON
+#
+# The layout is (every number is an unsigned LEB128 varint):
+#   magic "CTKJ", format version
+#   string table:       count, then (utf8 byte length, utf8 bytes) per string
+#   concept table:      count, then (codingScheme, code, cui, tui) string refs per concept
+#   concept-set table:  count, then (size, concept index...) per set
+#   mention groups:     count, then per group (type string ref, match count, matches...)
+#   each match:         begin, end, text string ref, polarity (0=pos 1=neg 2=None), type string ref, concept-set index
+#
+# String refs and begin/end are "optional" numbers: 0 is None, anything else is shifted up by one.
+# (begin/end are also zigzag-encoded, so that the format can never lose a value.)
+#
+# Version 1 wrote a None polarity as 1 (neg). Version 2 only adds the None value, so both can be read.
+#
+###############################################################################
+
+_BINARY_MAGIC = b"CTKJ"
+_BINARY_VERSION = 2
+_BINARY_READABLE_VERSIONS = (1, 2)
+_POLARITY_CODES = {Polarity.pos: 0, Polarity.neg: 1, None: 2}
+_POLARITY_VALUES = {code: polarity for polarity, code in _POLARITY_CODES.items()}
+
+
+def write_varint(out: bytearray, value: int) -> None:
+    """
+    Appends an unsigned LEB128 varint (the number format of this binary encoding, and of `invertedindex` files)
+
+    :param out: buffer to append to
+    :param value: non-negative number
+    """
+    while value > 0x7F:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def read_varint(data: bytes, pos: int) -> Tuple[int, int]:
+    """
+    :param data: bytes holding a varint written by `write_varint`
+    :param pos: where the varint starts
+    :return: (decoded number, position after it)
+    """
+    result = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        result |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return result, pos
+        shift += 7
+
+
+def _encode_offset(value: Optional[int]) -> int:
+    if value is None:
+        return 0
+    zigzag = value << 1 if value >= 0 else (-value << 1) - 1
+    return zigzag + 1
+
+
+def _decode_offset(value: int) -> Optional[int]:
+    if value == 0:
+        return None
+    value -= 1
+    return -((value + 1) >> 1) if value & 1 else value >> 1
+
+
+class _BinaryWriter:
+    """Collects the tables of the binary encoding, de-duplicating strings, concepts and concept sets"""
+
+    def __init__(self):
+        self.strings: Dict[str, int] = {}
+        self.concepts: Dict[tuple, int] = {}
+        self.concept_sets: Dict[tuple, int] = {}
+
+    def string(self, value: Optional[str]) -> int:
+        if value is None:
+            return 0
+        return self.strings.setdefault(value, len(self.strings)) + 1
+
+    def concept_set(self, concepts: List[UmlsConcept]) -> int:
+        indexes = []
+        for c in concepts:
+            key = (self.string(c.codingScheme), self.string(c.code), self.string(c.cui), self.string(c.tui))
+            indexes.append(self.concepts.setdefault(key, len(self.concepts)))
+        return self.concept_sets.setdefault(tuple(indexes), len(self.concept_sets))
+
+    def encode(self, mentions: Dict[UmlsTypeMention, List[MatchText]]) -> bytes:
+        body = bytearray()
+        write_varint(body, len(mentions))
+        for mention, match_list in mentions.items():
+            write_varint(body, self.string(mention.value))
+            write_varint(body, len(match_list))
+            for m in match_list:
+                write_varint(body, _encode_offset(m.begin))
+                write_varint(body, _encode_offset(m.end))
+                write_varint(body, self.string(m.text))
+                body.append(_POLARITY_CODES[m.polarity])
+                write_varint(body, self.string(m.type.value))
+                write_varint(body, self.concept_set(m.conceptAttributes))
+
+        out = bytearray(_BINARY_MAGIC)
+        write_varint(out, _BINARY_VERSION)
+        write_varint(out, len(self.strings))
+        for value in self.strings:
+            encoded = value.encode("utf8")
+            write_varint(out, len(encoded))
+            out += encoded
+        write_varint(out, len(self.concepts))
+        for key in self.concepts:
+            for ref in key:
+                write_varint(out, ref)
+        write_varint(out, len(self.concept_sets))
+        for indexes in self.concept_sets:
+            write_varint(out, len(indexes))
+            for index in indexes:
+                write_varint(out, index)
+        out += body
+        return bytes(out)
+
+
+def _decode_binary(data: bytes) -> Dict[UmlsTypeMention, List[MatchText]]:
+    if data[: len(_BINARY_MAGIC)] != _BINARY_MAGIC:
+        raise ValueError("not a binary CtakesJSON encoding")
+    version, pos = read_varint(data, len(_BINARY_MAGIC))
+    if version not in _BINARY_READABLE_VERSIONS:
+        raise ValueError(f"binary CtakesJSON version unknown: {version}")
+
+    count, pos = read_varint(data, pos)
+    strings = [None]
+    for _ in range(count):
+        length, pos = read_varint(data, pos)
+        end = pos + length
+        strings.append(data[pos:end].decode("utf8"))
+        pos = end
+
+    count, pos = read_varint(data, pos)
+    concepts = []
+    for _ in range(count):
+        refs = []
+        for _ in range(4):
+            ref, pos = read_varint(data, pos)
+            refs.append(strings[ref])
+        concepts.append(refs)
+
+    count, pos = read_varint(data, pos)
+    concept_sets = []
+    for _ in range(count):
+        size, pos = read_varint(data, pos)
+        indexes = []
+        for _ in range(size):
+            index, pos = read_varint(data, pos)
+            indexes.append(concepts[index])
+        concept_sets.append(indexes)
+
+    mentions = {}
+    count, pos = read_varint(data, pos)
+    for _ in range(count):
+        ref, pos = read_varint(data, pos)
+        match_list = mentions.setdefault(MatchText.parse_mention(strings[ref]), [])
+        size, pos = read_varint(data, pos)
+        for _ in range(size):
+            m = MatchText()
+            begin, pos = read_varint(data, pos)
+            end, pos = read_varint(data, pos)
+            text, pos = read_varint(data, pos)
+            m.begin = _decode_offset(begin)
+            m.end = _decode_offset(end)
+            m.text = strings[text]
+            if data[pos] not in _POLARITY_VALUES:
+                raise ValueError(f"binary CtakesJSON polarity unknown: {data[pos]}")
+            m.polarity = _POLARITY_VALUES[data[pos]]
+            ref, pos = read_varint(data, pos + 1)
+            m.type = MatchText.parse_mention(strings[ref])
+
+            index, pos = read_varint(data, pos)
+            m.conceptAttributes = []
+            for coding_scheme, code, cui, tui in concept_sets[index]:
+                # Fresh objects for every match (not shared), because callers are free to edit them
+                c = UmlsConcept()
+                c.codingScheme, c.code, c.cui, c.tui = coding_scheme, code, cui, tui
+                m.conceptAttributes.append(c)
+            match_list.append(m)
+
+    return mentions
+
+
+def _ctakes_from_bytes(cls, data: bytes) -> "CtakesJSON":
+    return cls.from_bytes(data)
+
+
 class CtakesJSON:
     """Ctakes JSON contain MatchText with list of UmlsConcept"""
 
@@ -266,3 +460,25 @@ class CtakesJSON:
 
             res[mention.value] = match_json
         return res
+
+    def to_bytes(self) -> bytes:
+        """
+        :return: compact binary encoding of these results (much smaller and faster to load than `as_json`)
+        """
+        return _BinaryWriter().encode(self.mentions)
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "CtakesJSON":
+        """
+        :param data: output of `to_bytes`
+        :return: results exactly as they were encoded (concepts are not re-sorted)
+        """
+        ctakes = cls()
+        ctakes.mentions = _decode_binary(data)
+        return ctakes
+
+    def __reduce__(self):
+        # Pickle (for example, to send to another process) via the compact binary encoding,
+        # keeping the subclass and any attributes it added
+        state = {key: value for key, value in self.__dict__.items() if key != "mentions"}
+        return _ctakes_from_bytes, (type(self), self.to_bytes()), state or None
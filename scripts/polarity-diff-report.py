@@ -4,38 +4,203 @@
 
 import argparse
 import asyncio
+import collections
+import concurrent.futures
 import csv
+import heapq
 import json
+import mmap
 import os
+import struct
 import sys
 import time
 from json.decoder import JSONDecodeError
+from typing import Iterator, Optional, Tuple
+
+import httpx
 
 import ctakesclient
 from ctakesclient.typesystem import MatchText, Polarity
 
 
+_HTTP_TIMEOUT = 600  # seconds -- busy servers may queue concurrent requests for a while
+_REORDER_WINDOW = 4  # how many notes (per unit of concurrency) may be in flight or awaiting their turn to be written
+
+
+###############################################################################
+#
+# Report index (notes.pdr.ndjson.idx), so that --continue and "show" can seek straight to a note
+#
+# An 8-byte header, then one fixed-size record per report line, in report order:
+#   (instance_num or -1 if it is not an integer, CSV row number, CSV byte offset just past the row,
+#    report byte offset of the line, report line length)
+#
+###############################################################################
+
+_INDEX_MAGIC = b"PDRIDX1\n"
+_INDEX_RECORD = struct.Struct("<qQQQQ")
+
+
+def index_path_for(pdr_path: str) -> str:
+    return f"{pdr_path}.idx"
+
+
+def instance_key(instance_num) -> int:
+    try:
+        return int(instance_num)
+    except (TypeError, ValueError):
+        return -1
+
+
+def read_index_record(index_file, position: int) -> Optional[tuple]:
+    """Returns the record for the given (0-based) report line, if any"""
+    index_file.seek(len(_INDEX_MAGIC) + position * _INDEX_RECORD.size)
+    data = index_file.read(_INDEX_RECORD.size)
+    return _INDEX_RECORD.unpack(data) if len(data) == _INDEX_RECORD.size else None
+
+
+def count_index_records(index_path: str) -> int:
+    return max(0, os.path.getsize(index_path) - len(_INDEX_MAGIC)) // _INDEX_RECORD.size
+
+
+def iter_index_records(index_path: str) -> Iterator[tuple]:
+    with open(index_path, "rb") as index_file:
+        if index_file.read(len(_INDEX_MAGIC)) != _INDEX_MAGIC:
+            raise ValueError(f"{index_path} is not a polarity difference report index")
+        while True:
+            data = index_file.read(_INDEX_RECORD.size * 4096)
+            whole = len(data) - len(data) % _INDEX_RECORD.size
+            yield from _INDEX_RECORD.iter_unpack(data[:whole])
+            if len(data) < _INDEX_RECORD.size * 4096:
+                return
+
+
+class CsvRows:
+    """
+    Reads CSV rows as dicts (like csv.DictReader), but from a binary file, tracking the byte offset past each row
+
+    This lets a later run seek straight back to where this one stopped.
+    """
+
+    def __init__(self, path: str, start: int = None):
+        self._file = open(path, "rb")  # pylint: disable=consider-using-with
+        self.offset = 0
+        self._reader = csv.reader(self._lines())
+        self.fieldnames = next(self._reader)
+        if start is not None:
+            self._file.seek(start)
+            self.offset = start
+
+    def _lines(self) -> Iterator[str]:
+        # The csv module pulls exactly as many lines as each row needs, so self.offset stays row-aligned
+        while True:
+            line = self._file.readline()
+            if not line:
+                return
+            self.offset += len(line)
+            yield line.decode("utf8")
+
+    def __iter__(self) -> Iterator[Tuple[dict, int]]:
+        """Yields (row, byte offset past the row), skipping blank rows"""
+        for values in self._reader:
+            if not values:
+                continue  # blank line, which DictReader skips too
+            row = dict(zip(self.fieldnames, values))
+            # Like DictReader: extra values are kept in a list under None, and missing values are None
+            width, count = len(self.fieldnames), len(values)
+            if count > width:
+                row[None] = values[width:]
+            for key in self.fieldnames[count:]:
+                row[key] = None
+            yield row, self.offset
+
+    def close(self) -> None:
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def rebuild_index(pdr_path: str, notes_path: str) -> None:
+    """Indexes a report written without an index, by walking the report and its CSV side by side (just once)"""
+    print("Indexing existing report (only needed once)...")
+    records = []
+    with open(pdr_path, "rb") as pdr, CsvRows(notes_path) as rows:
+        report_offset = 0
+        for row, (line, (note, csv_offset)) in enumerate(zip(pdr, rows), start=1):
+            if not line.endswith(b"\n"):
+                break  # interrupted write
+            instance_num = json.loads(line)["instance_num"]
+            if instance_num != note["INSTANCE_NUM"]:
+                raise ValueError(f"{pdr_path} line {row} does not match the CSV (instance id {instance_num})")
+            records.append(_INDEX_RECORD.pack(instance_key(instance_num), row, csv_offset, report_offset, len(line)))
+            report_offset += len(line)
+
+    tmp_path = f"{index_path_for(pdr_path)}.tmp"
+    with open(tmp_path, "wb") as index_file:
+        index_file.write(_INDEX_MAGIC)
+        index_file.write(b"".join(records))
+    os.replace(tmp_path, index_path_for(pdr_path))
+
+
+def read_last_index_record(index_path: str) -> Optional[tuple]:
+    """Returns the last index record (dropping any partial record after it), or None if there are none"""
+    count = count_index_records(index_path)
+    with open(index_path, "r+b") as index_file:
+        if index_file.read(len(_INDEX_MAGIC)) != _INDEX_MAGIC:
+            raise ValueError(f"{index_path} is not a polarity difference report index")
+        index_file.truncate(len(_INDEX_MAGIC) + count * _INDEX_RECORD.size)  # drop any partial record
+        return read_index_record(index_file, count - 1) if count else None
+
+
+def load_checkpoint(pdr_path: str, notes_path: str) -> Optional[tuple]:
+    """
+    Finds where to resume, and cuts off anything written past the last indexed report line
+
+    The index is rebuilt first if it is missing, or stale (pointing past the end of the report,
+    like when an older report was copied over this one).
+
+    Returns the last index record, or None if nothing was processed yet
+    """
+    index_path = index_path_for(pdr_path)
+    last = read_last_index_record(index_path) if os.path.exists(index_path) else None
+    report_end = last[3] + last[4] if last else 0
+    if not os.path.exists(index_path) or report_end > os.path.getsize(pdr_path):
+        rebuild_index(pdr_path, notes_path)
+        last = read_last_index_record(index_path)
+        report_end = last[3] + last[4] if last else 0
+
+    with open(pdr_path, "r+b") as pdr:
+        pdr.truncate(report_end)  # drop any line that never made it into the index
+    return last
+
+
 def default(parser, args):
     del args
 
     parser.print_help()
 
 
-async def compare_note_polarity(text: str):
+async def compare_note_polarity(text: str, client: httpx.AsyncClient = None) -> Tuple[list, list]:
     """
-    Prints difference summary (if any)
+    Returns the differences (if any), plus [mention type, cTAKES polarity, cNLP polarity, count] for every mention
     """
-    ner = await ctakesclient.client.extract(text)
+    ner = await ctakesclient.client.extract(text, client=client)
 
     matches = ner.list_match()
     spans = ner.list_spans(matches)
 
-    polarities_cnlp = await ctakesclient.transformer.list_polarity(text, spans)
+    polarities_cnlp = await ctakesclient.transformer.list_polarity(text, spans, client=client)
     if len(matches) != len(polarities_cnlp):
         raise JSONDecodeError("Polarity lists had different lengths!", text, 0)
 
     differing = []
+    pairs = collections.Counter()
     for i in range(len(matches)):
+        pairs[(matches[i].type.value, matches[i].polarity.value, polarities_cnlp[i].value)] += 1
         if matches[i].polarity.value != polarities_cnlp[i].value:
             differing.append(
                 {
@@ -44,64 +209,114 @@ async def compare_note_polarity(text: str):
                 }
             )
 
-    return differing
+    return differing, [[*key, count] for key, count in sorted(pairs.items())]
+
+
+async def process_note(note: dict, client: httpx.AsyncClient, slots: asyncio.Semaphore) -> dict:
+    """Compares one CSV row's note, returning its report line"""
+    async with slots:
+        try:
+            error = None
+            differences, polarity_pairs = await compare_note_polarity(note["OBSERVATION_BLOB"], client=client)
+        except (JSONDecodeError, httpx.HTTPError) as e:
+            # Recorded in the note's report line (like a bad response), rather than failing the notes in flight
+            error = str(e) or type(e).__name__  # some transport errors have no message
+            differences, polarity_pairs = [], []
+
+    return {
+        # Save the instance id for later sanity checking
+        "instance_num": note["INSTANCE_NUM"],
+        "note": note["OBSERVATION_BLOB"],
+        "error": error,
+        "differences": differences,
+        # Counts of every (mention type, cTAKES polarity, cNLP polarity), agreements included, for "summary"
+        "polarity_pairs": polarity_pairs,
+    }
+
+
+def report_path_for(notes_path: str, shards: int = None, shard_index: int = None) -> str:
+    base = os.path.splitext(notes_path)[0]
+    if shards:
+        return f"{base}.pdr.shard-{shard_index}-of-{shards}.ndjson"
+    return f"{base}.pdr.ndjson"
+
+
+async def calculate_shards(args) -> None:
+    """Runs one calculate process per shard on this machine, then merges their reports"""
+    script = os.path.abspath(__file__)
+    processes = []
+    for shard_index in range(args.shards):
+        command = [sys.executable, script, "calculate", args.notes_path, "--concurrency", str(args.concurrency)]
+        command += ["--shards", str(args.shards), "--shard-index", str(shard_index)]
+        if args.resume:
+            command.append("--continue")
+        processes.append(await asyncio.create_subprocess_exec(*command))
+
+    codes = [await process.wait() for process in processes]
+    if any(codes):
+        print("Some shards failed, fix the problem and run again with --continue to finish them", file=sys.stderr)
+        sys.exit(1)
+
+    merge_reports(args.notes_path, args.shards, replace=args.resume)
 
 
 async def calculate(parser, args):
     del parser
 
-    output_path = os.path.splitext(args.notes_path)[0] + ".pdr.ndjson"
+    if args.concurrency < 1:
+        print("--concurrency must be at least 1", file=sys.stderr)
+        sys.exit(1)
+
+    if args.shard_index is not None and not (args.shards and 0 <= args.shard_index < args.shards):
+        print("--shard-index needs --shards, and must be less than it", file=sys.stderr)
+        sys.exit(1)
+
+    if args.shards and args.shard_index is None:
+        await calculate_shards(args)
+        return
+
+    output_path = report_path_for(args.notes_path, args.shards, args.shard_index)
     if os.path.exists(output_path) and not args.resume:
         print("Output file already exists. Use --continue if this is intended.", file=sys.stderr)
         sys.exit(1)
 
     print("Processing...")
 
-    if args.resume:
-        mode = "r+"
+    index_path = index_path_for(output_path)
+    checkpoint = load_checkpoint(output_path, args.notes_path) if args.resume and os.path.exists(output_path) else None
+    if checkpoint:
+        instance, row, csv_offset, report_offset, report_length = checkpoint
+        print(f"Resuming after note {row} (instance id: {instance})...")
+        first_row, report_end = row + 1, report_offset + report_length
     else:
-        mode = "w"
+        first_row, csv_offset, report_end = 1, None, 0
+        with open(index_path, "wb") as index_file:
+            index_file.write(_INDEX_MAGIC)
+
+    # Up to --concurrency notes talk to the servers at once, and a few more may wait in the reorder window.
+    # Results are always written in CSV order, so the output is a clean prefix of the CSV (for --continue).
+    slots = asyncio.Semaphore(args.concurrency)
+    window = collections.deque()  # (count, note, CSV offset past the note, start time, task) in CSV order
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
 
     total_tic = time.perf_counter()
-    with open(output_path, mode, buffering=1, encoding="utf8") as output_file:
-        start_processing_after = None
-        if args.resume:
-            # Read until the end
-            line = None
-            for line in output_file:
-                pass
-            if line:
-                start_processing_after = json.loads(line)["instance_num"]
-                print(f"Resuming after instance id {start_processing_after}...")
-
-        with open(args.notes_path, "r", encoding="utf8") as notes_file:
-            notes = csv.DictReader(notes_file)
-            for count, note in enumerate(notes, start=1):
-                if start_processing_after is not None:
-                    if note["INSTANCE_NUM"] == start_processing_after:
-                        start_processing_after = None
-                    continue
-
-                note_tic = time.perf_counter()
-                try:
-                    error = None
-                    differences = await compare_note_polarity(note["OBSERVATION_BLOB"])
-                except JSONDecodeError as e:
-                    error = str(e)
-                    differences = []
-
-                json.dump(
-                    {
-                        # Save the instance id for later sanity checking
-                        "instance_num": note["INSTANCE_NUM"],
-                        "note": note["OBSERVATION_BLOB"],
-                        "error": error,
-                        "differences": differences,
-                    },
-                    output_file,
-                )
-                output_file.write("\n")
+    async with httpx.AsyncClient(limits=limits, timeout=_HTTP_TIMEOUT) as client:
+        with open(output_path, "ab") as output_file, open(index_path, "ab") as index_file:
+
+            def write_oldest():
+                nonlocal report_end
+                count, note, note_csv_offset, note_tic, task = window.popleft()
+                line = json.dumps(task.result()).encode("utf8") + b"\n"
+                output_file.write(line)
                 output_file.flush()  # just in case we want to stop halfway
+                # Only index the line once it is written, so the index never points past the report
+                index_file.write(
+                    _INDEX_RECORD.pack(
+                        instance_key(note["INSTANCE_NUM"]), count, note_csv_offset, report_end, len(line)
+                    )
+                )
+                index_file.flush()
+                report_end += len(line)
                 note_toc = time.perf_counter()
 
                 print(
@@ -109,11 +324,93 @@ async def calculate(parser, args):
                     f"(instance id: {note['INSTANCE_NUM']}) "
                     f"in {note_toc - note_tic:.0f} seconds"
                 )
+
+            try:
+                with CsvRows(args.notes_path, start=csv_offset) as notes:
+                    for count, (note, note_csv_offset) in enumerate(notes, start=first_row):
+                        if args.shards and (count - 1) % args.shards != args.shard_index:
+                            continue  # another shard's row
+
+                        task = asyncio.create_task(process_note(note, client, slots))
+                        window.append((count, note, note_csv_offset, time.perf_counter(), task))
+                        while len(window) > _REORDER_WINDOW * args.concurrency:
+                            await window[0][4]
+                            write_oldest()
+
+                while window:
+                    await window[0][4]
+                    write_oldest()
+            finally:
+                tasks = [task for *_, task in window]
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)  # let them finish before the client closes
     total_toc = time.perf_counter()
 
     print(f"Total time spent: {total_toc - total_tic:.0f} seconds")
 
 
+def merge_reports(notes_path: str, shards: int, replace: bool = False) -> None:
+    """
+    Interleaves shard reports back into one report (and index) in CSV order, stopping at the first missing row
+
+    Does nothing if the report already holds every shard row. With replace, an incomplete report is merged again.
+    """
+    output_path = report_path_for(notes_path)
+    shard_paths = [report_path_for(notes_path, shards, i) for i in range(shards)]
+    missing = [path for path in shard_paths if not os.path.exists(index_path_for(path))]
+    if missing:
+        print(f"Missing shard reports: {', '.join(missing)}", file=sys.stderr)
+        sys.exit(1)
+
+    if os.path.exists(output_path):
+        total = sum(count_index_records(index_path_for(path)) for path in shard_paths)
+        output_index = index_path_for(output_path)
+        if os.path.exists(output_index) and count_index_records(output_index) == total:
+            print(f"{output_path} already holds all {total} notes of the shards")
+            return
+        if not replace:
+            print(f"{output_path} already exists, remove it first to merge shards into it", file=sys.stderr)
+            sys.exit(1)
+
+    def records(shard: int) -> Iterator[tuple]:
+        for record in iter_index_records(index_path_for(shard_paths[shard])):
+            yield record[1], shard, record  # CSV row number first, for sorting
+
+    print("Merging...")
+    tmp_path = f"{output_path}.tmp"
+    expected_row = 1
+    report_end = 0
+    shard_files = [open(path, "rb") for path in shard_paths]  # pylint: disable=consider-using-with
+    try:
+        with open(tmp_path, "wb") as output_file, open(index_path_for(tmp_path), "wb") as index_file:
+            index_file.write(_INDEX_MAGIC)
+            for row, shard, record in heapq.merge(*(records(i) for i in range(shards))):
+                if row != expected_row:
+                    print(f"Row {expected_row} is missing from the shards, stopping the merge there", file=sys.stderr)
+                    break
+                instance, _, csv_offset, offset, length = record
+                shard_files[shard].seek(offset)
+                line = shard_files[shard].read(length)
+                output_file.write(line)
+                index_file.write(_INDEX_RECORD.pack(instance, row, csv_offset, report_end, length))
+                report_end += length
+                expected_row += 1
+    finally:
+        for shard_file in shard_files:
+            shard_file.close()
+
+    os.replace(tmp_path, output_path)
+    os.replace(index_path_for(tmp_path), index_path_for(output_path))
+    print(f"Merged {expected_row - 1} notes into {output_path}")
+
+
+async def merge(parser, args):
+    del parser
+
+    merge_reports(args.notes_path, args.shards)
+
+
 def note_context(text: str, match: MatchText) -> str:
     """Returns the original line that the match comes from"""
     start = text.rfind("\n", 0, match.begin) + 1
@@ -160,6 +457,52 @@ def show_note(args, note):
         print("No matching differences found!")
 
 
+def find_instance_record(index_path: str, instance: int) -> Optional[tuple]:
+    """
+    Returns the first index record for an instance id, if any
+
+    Records are in CSV order, and instance ids can come in any order there, so there is nothing to binary search.
+    Instead, this searches the memory-mapped index for the id's bytes, which runs at memchr speed
+    and never decodes the records that don't match.
+    """
+    if os.path.getsize(index_path) <= len(_INDEX_MAGIC):
+        return None
+    key = struct.pack("<q", instance)
+    with open(index_path, "rb") as index_file, mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        pos = data.find(key, len(_INDEX_MAGIC))
+        while pos >= 0:
+            offset = pos - len(_INDEX_MAGIC)
+            if offset % _INDEX_RECORD.size == 0:  # the instance field, not some other field that happens to match
+                return _INDEX_RECORD.unpack_from(data, pos) if pos + _INDEX_RECORD.size <= len(data) else None
+            pos = data.find(key, pos + 1)
+    return None
+
+
+def find_note(pdr_path: str, note: Optional[int], instance: Optional[int]) -> Optional[dict]:
+    """Looks up a report line by note number or instance id, via the report index if there is one"""
+    index_path = index_path_for(pdr_path)
+    if not os.path.exists(index_path):
+        # Older report without an index, so scan the whole thing
+        with open(pdr_path, "r", encoding="utf8") as pdr:
+            for count, line in enumerate(pdr, start=1):
+                note_data = json.loads(line)
+                if note == count or (instance and str(instance) == str(note_data["instance_num"])):
+                    return note_data
+        return None
+
+    if note:
+        with open(index_path, "rb") as index_file:
+            record = read_index_record(index_file, note - 1) if note <= count_index_records(index_path) else None
+    else:
+        record = find_instance_record(index_path, instance)
+    if record is None:
+        return None
+
+    with open(pdr_path, "rb") as pdr:
+        pdr.seek(record[3])
+        return json.loads(pdr.read(record[4]))
+
+
 async def report(parser, args):
     del parser
 
@@ -171,22 +514,175 @@ async def report(parser, args):
         print("You must provide a note number or an instance number", file=sys.stderr)
         sys.exit(1)
 
-    with open(args.pdr_path, "r", encoding="utf8") as pdr:
-        for count, line in enumerate(pdr, start=1):
-            note_data = json.loads(line)
-
-            if args.note and args.note == count:
-                show_note(args, note_data)
-                return
-
-            if args.instance and args.instance == note_data["instance_num"]:
-                show_note(args, note_data)
-                return
+    note_data = find_note(args.pdr_path, args.note, args.instance)
+    if note_data is not None:
+        show_note(args, note_data)
+        return
 
     print("Note not found!", file=sys.stderr)
     sys.exit(1)
 
 
+###############################################################################
+#
+# Corpus summary
+#
+###############################################################################
+
+
+_MATRIX_CELLS = ("ctakes_pos_cnlp_pos", "ctakes_pos_cnlp_neg", "ctakes_neg_cnlp_pos", "ctakes_neg_cnlp_neg")
+
+
+class Summary:
+    """Running totals over report lines, small enough to merge between worker processes"""
+
+    def __init__(self):
+        self.notes = 0
+        self.errors = 0
+        self.notes_with_differences = 0
+        self.notes_without_pairs = 0  # older reports only recorded the differences, not the agreements
+        self.matrix = collections.Counter()  # (mention type, cTAKES polarity, cNLP polarity) -> mentions
+        self.cuis = collections.Counter()  # CUI -> differing mentions
+        self.texts = collections.Counter()  # lowercase text -> differing mentions
+
+    def add(self, note_data: dict) -> None:
+        self.notes += 1
+        self.errors += bool(note_data["error"])
+        self.notes_with_differences += bool(note_data["differences"])
+
+        pairs = note_data.get("polarity_pairs")
+        if pairs is None:
+            self.notes_without_pairs += 1
+            for diff in note_data["differences"]:
+                m = diff["match"]
+                self.matrix[(m["type"], m["polarity"], diff["cnlp_polarity"])] += 1
+        else:
+            for mention_type, ctakes_polarity, cnlp_polarity, count in pairs:
+                self.matrix[(mention_type, ctakes_polarity, cnlp_polarity)] += count
+
+        for diff in note_data["differences"]:
+            m = diff["match"]
+            self.texts[m["text"].lower()] += 1
+            self.cuis.update({c["cui"] for c in m["conceptAttributes"]})
+
+    def merge(self, other: "Summary") -> None:
+        self.notes += other.notes
+        self.errors += other.errors
+        self.notes_with_differences += other.notes_with_differences
+        self.notes_without_pairs += other.notes_without_pairs
+        self.matrix.update(other.matrix)
+        self.cuis.update(other.cuis)
+        self.texts.update(other.texts)
+
+    def as_json(self, top: int) -> dict:
+        complete = self.notes_without_pairs == 0
+        by_type = {}
+        totals = collections.Counter()
+        for mention_type in sorted({key[0] for key in self.matrix}):
+            cells = {
+                f"ctakes_{Polarity(ctakes).name}_cnlp_{Polarity(cnlp).name}": self.matrix[(mention_type, ctakes, cnlp)]
+                for ctakes in (Polarity.pos.value, Polarity.neg.value)
+                for cnlp in (Polarity.pos.value, Polarity.neg.value)
+            }
+            totals.update(cells)
+            by_type[mention_type] = self._rates(cells, complete)
+
+        return {
+            "notes": self.notes,
+            "notes_with_errors": {"count": self.errors, "rate": self.errors / self.notes if self.notes else None},
+            "notes_with_differences": self.notes_with_differences,
+            "complete": complete,  # whether agreements were counted too (false for reports from older versions)
+            "mentions": self._rates(dict(totals), complete),
+            "by_type": by_type,
+            "top_cuis": self.cuis.most_common(top),
+            "top_texts": self.texts.most_common(top),
+        }
+
+    @staticmethod
+    def _rates(cells: dict, complete: bool) -> dict:
+        cells = {key: cells.get(key, 0) for key in _MATRIX_CELLS}
+        disagree = cells["ctakes_pos_cnlp_neg"] + cells["ctakes_neg_cnlp_pos"]
+        total = sum(cells.values())
+        if not complete:
+            # Agreements are unknown, rather than zero
+            cells["ctakes_pos_cnlp_pos"] = cells["ctakes_neg_cnlp_neg"] = None
+        cells["disagreements"] = disagree
+        cells["disagreement_rate"] = disagree / total if complete and total else None
+        return cells
+
+
+def summarize_range(pdr_path: str, start: int, end: int) -> Summary:
+    """Summarizes the report lines that start within the given byte range"""
+    part = Summary()
+    with open(pdr_path, "rb") as pdr:
+        pdr.seek(start)
+        while pdr.tell() < end:
+            line = pdr.readline()
+            if not line.endswith(b"\n"):
+                break  # interrupted write
+            part.add(json.loads(line))
+    return part
+
+
+def format_summary(result: dict) -> str:
+    def rate(value) -> str:
+        return "n/a" if value is None else f"{value:.1%}"
+
+    def cell(value) -> str:
+        return "?" if value is None else str(value)
+
+    errors = result["notes_with_errors"]
+    lines = [
+        f"Notes: {result['notes']}  (with differences: {result['notes_with_differences']}, "
+        f"with errors: {errors['count']} = {rate(errors['rate'])})",
+    ]
+    if not result["complete"]:
+        lines.append("Note: this report predates agreement counts, so only disagreements are known.")
+
+    header = f"{'Mention type':<24} {'pos/pos':>9} {'pos/neg':>9} {'neg/pos':>9} {'neg/neg':>9} {'disagree':>9}"
+    lines += ["", "cTAKES/cNLP polarity", header, "-" * len(header)]
+    for name, cells in [*result["by_type"].items(), ("TOTAL", result["mentions"])]:
+        lines.append(
+            f"{name:<24} {cell(cells['ctakes_pos_cnlp_pos']):>9} {cell(cells['ctakes_pos_cnlp_neg']):>9} "
+            f"{cell(cells['ctakes_neg_cnlp_pos']):>9} {cell(cells['ctakes_neg_cnlp_neg']):>9} "
+            f"{rate(cells['disagreement_rate']):>9}"
+        )
+
+    for title, top in [("Top disagreeing CUIs", result["top_cuis"]), ("Top disagreeing texts", result["top_texts"])]:
+        lines += ["", title]
+        lines += [f"{count:>9}  {value}" for value, count in top]
+    return "\n".join(lines)
+
+
+async def summary(parser, args):
+    del parser
+
+    ranges = ctakesclient.filesystem.split_byte_ranges(args.pdr_path, args.processes)
+    total = Summary()
+    if args.processes > 1 and len(ranges) > 1:
+        loop = asyncio.get_running_loop()
+        with concurrent.futures.ProcessPoolExecutor(max_workers=args.processes) as executor:
+            parts = [loop.run_in_executor(executor, summarize_range, args.pdr_path, *r) for r in ranges]
+            for part in await asyncio.gather(*parts):
+                total.merge(part)
+    else:
+        for start, end in ranges:
+            total.merge(summarize_range(args.pdr_path, start, end))
+
+    result = total.as_json(args.top)
+    if args.json:
+        print(json.dumps(result, indent=2))
+    else:
+        print(format_summary(result))
+
+
+def positive_int(value: str) -> int:
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, not {number}")
+    return number
+
+
 async def main():
     parser = argparse.ArgumentParser()
     subparsers = parser.add_subparsers()
@@ -196,9 +692,28 @@ async def main():
     calculate_parser = subparsers.add_parser("calculate")
     calculate_parser.add_argument("notes_path", metavar="notes.csv")
     calculate_parser.add_argument("-c", "--continue", dest="resume", action="store_true")
+    calculate_parser.add_argument(
+        "--concurrency", type=int, default=1, metavar="N", help="how many notes to process at once (default 1)"
+    )
+    calculate_parser.add_argument(
+        "--shards",
+        type=positive_int,
+        metavar="K",
+        help="split the notes into K shards (every Kth row), run locally as K processes unless --shard-index is given",
+    )
+    calculate_parser.add_argument(
+        "--shard-index", type=int, metavar="I", help="only process shard I (0-based), into its own report"
+    )
     # TODO: offer an --update option (and/or a --replace with a danger prompt)
     calculate_parser.set_defaults(func=calculate)
 
+    merge_parser = subparsers.add_parser("merge", help="combine shard reports into one report")
+    merge_parser.add_argument("notes_path", metavar="notes.csv")
+    merge_parser.add_argument(
+        "--shards", type=positive_int, required=True, metavar="K", help="how many shards there are"
+    )
+    merge_parser.set_defaults(func=merge)
+
     report_parser = subparsers.add_parser("show")
     report_parser.add_argument("pdr_path", metavar="notes.pdr.ndjson")
     report_parser.add_argument("--show-full", action="store_true")
@@ -208,6 +723,13 @@ async def main():
     report_parser.add_argument("--mention", action="append", default=[], help="only show these mention types")
     report_parser.set_defaults(func=report)
 
+    summary_parser = subparsers.add_parser("summary")
+    summary_parser.add_argument("pdr_path", metavar="notes.pdr.ndjson")
+    summary_parser.add_argument("--json", action="store_true", help="print JSON instead of a table")
+    summary_parser.add_argument("--top", type=int, default=10, help="how many top CUIs and texts to list")
+    summary_parser.add_argument("--processes", type=int, default=1, help="how many processes to read with")
+    summary_parser.set_defaults(func=summary)
+
     args = parser.parse_args()
     await args.func(parser, args)
 
@@ -0,0 +1,136 @@
+"""Tests for the aggregate module"""
+
+import importlib.util
+import itertools
+import os
+import tempfile
+import unittest
+
+import ddt
+
+from ctakesclient.aggregate import ConceptAggregator
+from ctakesclient.store import ResultStore
+from ctakesclient.typesystem import CtakesJSON, Polarity
+from tests.test_resources import LoadResource
+
+HAS_SCIPY = importlib.util.find_spec("scipy") is not None
+
+
+def naive_counts(documents: list, polarity) -> tuple:
+    """The nested loops this module replaces, as a reference"""
+    mentions, frequency, pairs = {}, {}, {}
+    for ctakes in documents:
+        cuis = []
+        for match in ctakes.list_match(polarity=polarity):
+            cuis.extend({c.cui for c in match.conceptAttributes})
+        for cui in cuis:
+            mentions[cui] = mentions.get(cui, 0) + 1
+        for cui in set(cuis):
+            frequency[cui] = frequency.get(cui, 0) + 1
+        for pair in itertools.combinations(sorted(set(cuis)), 2):
+            pairs[pair] = pairs.get(pair, 0) + 1
+    return mentions, frequency, pairs
+
+
+@ddt.ddt
+class TestConceptAggregator(unittest.TestCase):
+    """Test case for concept counts and co-occurrence"""
+
+    def setUp(self):
+        super().setUp()
+        self.synthetic = CtakesJSON(LoadResource.SYNTHETIC_JSON.value)
+        self.physician = CtakesJSON(LoadResource.PHYSICIAN_NOTE_JSON.value)
+        self.documents = [self.synthetic, self.physician, self.physician]
+
+    def as_pairs(self, aggregator: ConceptAggregator) -> dict:
+        return {tuple(sorted((a, b))): count for a, b, count in aggregator.pairs()}
+
+    @ddt.data(Polarity.pos, Polarity.neg, None)
+    def test_matches_naive_loops(self, polarity):
+        aggregator = ConceptAggregator(polarity=polarity)
+        for document in self.documents:
+            aggregator.add(document)
+
+        mentions, frequency, pairs = naive_counts(self.documents, polarity)
+        self.assertEqual(3, aggregator.document_count)
+        self.assertEqual(mentions, aggregator.mention_counts())
+        self.assertEqual(frequency, aggregator.document_frequency())
+        self.assertEqual(pairs, self.as_pairs(aggregator))
+
+    def test_queries(self):
+        aggregator = ConceptAggregator()
+        for document in self.documents:
+            aggregator.add(document)
+
+        self.assertEqual(2, aggregator.cooccurrence("C0010200", "C0011991"))  # cough & diarrhea
+        self.assertEqual(2, aggregator.cooccurrence("C0011991", "C0010200"))
+        self.assertEqual(0, aggregator.cooccurrence("C0010200", "C0010200"))
+        self.assertEqual(0, aggregator.cooccurrence("C0010200", "nope"))
+        self.assertEqual([("C0010200", 2), ("C0011991", 2)], aggregator.most_common(2))
+
+    def test_semantic_group_filter(self):
+        aggregator = ConceptAggregator(semantic_groups=["CHEM"])
+        aggregator.add(self.synthetic)
+        aggregator.add(self.physician)
+        self.assertEqual({"C0000970": 1, "C0304290": 1}, aggregator.document_frequency())
+        self.assertEqual(2, aggregator.document_count)
+
+    def test_json_and_store_input(self):
+        expected = ConceptAggregator(polarity=None)
+        for document in self.documents:
+            expected.add(document)
+
+        from_json = ConceptAggregator(polarity=None)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with ResultStore(os.path.join(tmpdir, "results.ndjson")) as store:
+                for i, document in enumerate(self.documents):
+                    store.append(str(i), document)
+                from_json.add_store(store)
+
+        self.assertEqual(expected.mention_counts(), from_json.mention_counts())
+        self.assertEqual(self.as_pairs(expected), self.as_pairs(from_json))
+
+    def test_merge(self):
+        expected = ConceptAggregator(polarity=None)
+        for document in self.documents:
+            expected.add(document)
+
+        # Parts see CUIs in different orders, so their ids differ
+        first, second = ConceptAggregator(polarity=None), ConceptAggregator(polarity=None)
+        second.add(self.physician)
+        second.add(self.physician)
+        first.add(self.synthetic)
+        first.merge(second)
+
+        self.assertEqual(3, first.document_count)
+        self.assertEqual(expected.mention_counts(), first.mention_counts())
+        self.assertEqual(expected.document_frequency(), first.document_frequency())
+        self.assertEqual(self.as_pairs(expected), self.as_pairs(first))
+
+        with self.assertRaisesRegex(ValueError, "different filters"):
+            first.merge(ConceptAggregator())
+
+    def test_coo(self):
+        aggregator = ConceptAggregator()
+        aggregator.add(self.physician)
+        rows, columns, counts = aggregator.to_coo()
+        self.assertEqual([0], list(rows))
+        self.assertEqual([1], list(columns))
+        self.assertEqual([1], list(counts))
+        self.assertEqual({"C0010200", "C0011991"}, set(aggregator.cuis))
+
+    @unittest.skipUnless(HAS_SCIPY, "scipy not installed")
+    def test_scipy(self):
+        aggregator = ConceptAggregator()
+        aggregator.add(self.physician)
+        matrix = aggregator.to_scipy()
+        self.assertEqual([[0, 1], [1, 0]], matrix.toarray().tolist())
+
+    @unittest.skipIf(HAS_SCIPY, "scipy is installed")
+    def test_scipy_missing(self):
+        with self.assertRaisesRegex(ImportError, "pip install scipy"):
+            ConceptAggregator().to_scipy()
+
+
+if __name__ == "__main__":
+    unittest.main()
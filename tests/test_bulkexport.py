@@ -0,0 +1,147 @@
+"""Tests for the bulkexport module"""
+
+import gzip
+import json
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from ctakesclient import bulkexport, text2fhir
+from ctakesclient.typesystem import CtakesJSON, Polarity
+from tests.test_resources import LoadResource
+
+
+def read_ndjson(path: str) -> list:
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rt", encoding="utf8") as f:
+        return [json.loads(line) for line in f]
+
+
+class TestBulkExportWriter(unittest.TestCase):
+    """Test case for writing FHIR NDJSON files"""
+
+    def setUp(self):
+        super().setUp()
+        tmpdir = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.addCleanup(tmpdir.cleanup)
+        self.dir = tmpdir.name
+        self.ctakes = CtakesJSON(LoadResource.SYNTHETIC_JSON.value)
+
+    def listdir(self) -> list:
+        return sorted(os.listdir(self.dir))
+
+    def test_one_file_per_type(self):
+        resources = text2fhir.nlp_fhir_json("1234", "5678", "ABCD", self.ctakes)
+        with bulkexport.BulkExportWriter(self.dir) as writer:
+            writer.write_all(resources)
+
+        self.assertEqual(
+            [
+                "Condition.000.ndjson",
+                "MedicationStatement.000.ndjson",
+                "Observation.000.ndjson",
+                "Procedure.000.ndjson",
+            ],
+            self.listdir(),
+        )
+        written = []
+        for name in self.listdir():
+            written += read_ndjson(os.path.join(self.dir, name))
+        self.assertEqual(sorted(resources, key=json.dumps), sorted(written, key=json.dumps))
+
+    def test_write_nlp(self):
+        with bulkexport.BulkExportWriter(self.dir, compress=True) as writer:
+            writer.write_documents([("p1", "e1", "d1", self.ctakes), ("p2", "e2", "d2", self.ctakes)])
+
+        observations = read_ndjson(os.path.join(self.dir, "Observation.000.ndjson.gz"))
+        self.assertEqual(len(self.ctakes.list_sign_symptom(Polarity.pos)) * 2, len(observations))
+        self.assertEqual({"Patient/p1", "Patient/p2"}, {x["subject"]["reference"] for x in observations})
+
+    def test_size_limit_rolls_over(self):
+        resources = text2fhir.nlp_fhir_json("1234", "5678", "ABCD", self.ctakes)
+        observations = [x for x in resources if x["resourceType"] == "Observation"]
+        line_size = max(len(json.dumps(x, separators=(",", ":"))) + 1 for x in observations)
+
+        with bulkexport.BulkExportWriter(self.dir, max_file_size=line_size * 2) as writer:
+            writer.write_all(observations)
+            paths = writer.close()
+
+        self.assertEqual(paths, sorted(paths))
+        self.assertEqual(len(paths), len(self.listdir()))
+        self.assertLessEqual((len(observations) + 1) // 2, len(paths))
+        written = []
+        for path in paths:
+            self.assertLessEqual(os.path.getsize(path), line_size * 2)
+            written += read_ndjson(path)
+        self.assertEqual(observations, written)
+
+    def test_incomplete_files_keep_temporary_names(self):
+        writer = bulkexport.BulkExportWriter(self.dir)
+        writer.write({"resourceType": "Observation", "id": "1"})
+        self.assertEqual(["Observation.000.ndjson.tmp"], self.listdir())
+
+        writer.close()
+        self.assertEqual(["Observation.000.ndjson"], self.listdir())
+
+    def test_exception_leaves_files_unfinished(self):
+        with self.assertRaises(RuntimeError):
+            with bulkexport.BulkExportWriter(self.dir, max_file_size=1) as writer:
+                writer.write({"resourceType": "Observation", "id": "1"})
+                writer.write({"resourceType": "Observation", "id": "2"})
+                raise RuntimeError("boom")
+
+        # The rolled over file was complete, but the one being written when the error hit is not
+        self.assertEqual(["Observation.000.ndjson", "Observation.001.ndjson.tmp"], self.listdir())
+
+    def test_reopening_removes_unfinished_files(self):
+        with self.assertRaises(RuntimeError):
+            with bulkexport.BulkExportWriter(self.dir, max_file_size=1) as writer:
+                writer.write({"resourceType": "Observation", "id": "1"})
+                writer.write({"resourceType": "Observation", "id": "2"})
+                writer.write({"resourceType": "Condition", "id": "3"})
+                raise RuntimeError("boom")
+
+        with bulkexport.BulkExportWriter(self.dir) as writer:
+            writer.write({"resourceType": "Observation", "id": "4"})
+
+        # the unfinished part's number is not reused; Condition was not written again, so its file is left alone
+        self.assertEqual(
+            ["Condition.000.ndjson.tmp", "Observation.000.ndjson", "Observation.002.ndjson"], self.listdir()
+        )
+        self.assertEqual(
+            [{"resourceType": "Observation", "id": "4"}], read_ndjson(f"{self.dir}/Observation.002.ndjson")
+        )
+
+    def test_write_nlp_reuses_converter_for_int_polarity(self):
+        with mock.patch("ctakesclient.bulkexport.NlpFhirConverter", wraps=text2fhir.NlpFhirConverter) as converter:
+            with bulkexport.BulkExportWriter(self.dir) as writer:
+                writer.write_nlp("p1", "e1", "d1", self.ctakes, polarity=0)
+                writer.write_nlp("p2", "e2", "d2", self.ctakes, polarity=0)
+                writer.write_nlp("p3", "e3", "d3", self.ctakes, polarity=Polarity.pos)
+        self.assertEqual(1, converter.call_count)
+
+    def test_reopening_continues_numbering(self):
+        for i in range(2):
+            with bulkexport.BulkExportWriter(self.dir) as writer:
+                writer.write({"resourceType": "Observation", "id": str(i)})
+
+        self.assertEqual(["Observation.000.ndjson", "Observation.001.ndjson"], self.listdir())
+        self.assertEqual(
+            [{"resourceType": "Observation", "id": "1"}], read_ndjson(f"{self.dir}/Observation.001.ndjson")
+        )
+
+    def test_known_hashes_are_skipped(self):
+        resources = text2fhir.nlp_fhir_json("1234", "5678", "ABCD", self.ctakes, deterministic_id=True)
+        known = {text2fhir.resource_hash(x) for x in resources[1:]}
+
+        with bulkexport.BulkExportWriter(self.dir, known_hashes=known) as writer:
+            writer.write_nlp("1234", "5678", "ABCD", self.ctakes, deterministic_id=True)
+
+        self.assertEqual(len(resources) - 1, writer.skipped)
+        self.assertEqual(["Observation.000.ndjson"], self.listdir())
+        self.assertEqual([resources[0]], read_ndjson(os.path.join(self.dir, "Observation.000.ndjson")))
+
+
+if __name__ == "__main__":
+    unittest.main()
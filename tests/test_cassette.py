@@ -0,0 +1,94 @@
+"""Tests for the cassette module"""
+
+import os
+import tempfile
+import time
+import unittest
+import zipfile
+
+import httpx
+import respx
+
+from ctakesclient import client, transformer
+from ctakesclient.cassette import Cassette, Interaction, RecordingTransport, ReplayTransport, request_key
+from ctakesclient.exceptions import ClientError, FileError
+from ctakesclient.typesystem import Polarity
+from tests.test_resources import LoadResource
+
+CTAKES_URL = "http://localhost:8080/ctakes-web-rest/service/analyze"
+NEGATION_URL = "http://localhost:8000/negation/process"
+
+
+class TestCassette(unittest.IsolatedAsyncioTestCase):
+    """Test case for recording and replaying server responses"""
+
+    def setUp(self):
+        super().setUp()
+        tmpdir = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.addCleanup(tmpdir.cleanup)
+        self.path = os.path.join(tmpdir.name, "responses.cassette")
+
+    async def record(self) -> Cassette:
+        cassette = Cassette()
+        with respx.mock:
+            respx.post(CTAKES_URL).side_effect = [
+                httpx.Response(503),
+                httpx.Response(200, json=LoadResource.PHYSICIAN_NOTE_JSON.value),
+            ]
+            respx.post(NEGATION_URL).respond(json={"statuses": [1, -1]})
+            async with httpx.AsyncClient(transport=RecordingTransport(cassette)) as http:
+                with self.assertRaises(httpx.HTTPStatusError):
+                    await client.extract("cough", client=http)
+                await client.extract("cough", client=http)
+                await transformer.list_polarity("no cough, fever", [(3, 8), (10, 15)], client=http)
+        cassette.save(self.path)
+        return cassette
+
+    async def test_record_and_replay(self):
+        recorded = await self.record()
+        self.assertEqual(3, len(recorded))
+
+        cassette = Cassette.load(self.path)
+        # Replayed against another host, with no servers (or mocks) around
+        url = "http://elsewhere:1234/ctakes-web-rest/service/analyze"
+        async with httpx.AsyncClient(transport=ReplayTransport(cassette, latency_scale=0)) as http:
+            with self.assertRaises(httpx.HTTPStatusError):
+                await client.extract("cough", url=url, client=http)
+            for _ in range(2):  # the last recorded response repeats
+                ner = await client.extract("cough", url=url, client=http)
+                self.assertEqual({"Diarrhea", "cough"}, {m.text for m in ner.list_sign_symptom(Polarity.pos)})
+
+            polarities = await transformer.list_polarity("no cough, fever", [(3, 8), (10, 15)], client=http)
+            self.assertEqual([Polarity.neg, Polarity.pos], polarities)
+
+            with self.assertRaisesRegex(ClientError, "no recorded response"):
+                await client.extract("something else", url=url, client=http)
+
+        cassette.rewind()
+        self.assertEqual(503, cassette.next_interaction(next(iter(cassette.interactions))).status)
+
+    async def test_latency_scale(self):
+        request = httpx.Request("POST", CTAKES_URL, content=b"cough")
+        cassette = Cassette()
+        cassette.record(request_key(request), Interaction("POST", CTAKES_URL, 200, [], b"{}", elapsed=0.1))
+        for scale, low, high in [(0, 0, 0.05), (0.5, 0.05, 0.1), (1, 0.1, 0.2)]:
+            async with httpx.AsyncClient(transport=ReplayTransport(cassette, latency_scale=scale)) as http:
+                tic = time.perf_counter()
+                await client.post("cough", client=http)
+                self.assertTrue(low <= time.perf_counter() - tic < high, scale)
+
+    async def test_archive(self):
+        await self.record()
+        with zipfile.ZipFile(self.path) as archive:
+            names = archive.namelist()
+        self.assertEqual("cassette.json", names[0])
+        self.assertEqual(4, len(names))  # 3 distinct bodies
+
+        with open(self.path, "wb") as f:
+            f.write(b"nope")
+        with self.assertRaisesRegex(FileError, "not a cassette"):
+            Cassette.load(self.path)
+
+
+if __name__ == "__main__":
+    unittest.main()
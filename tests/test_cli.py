@@ -0,0 +1,175 @@
+"""Tests for the cli module"""
+
+import csv
+import io
+import json
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import httpx
+import respx
+
+from ctakesclient import cli
+from ctakesclient.store import ResultStore
+from ctakesclient.typesystem import Polarity
+from tests.test_resources import LoadResource, PathResource
+
+CTAKES_URL = "http://localhost:8080/ctakes-web-rest/service/analyze"
+NEGATION_URL = "http://localhost:8000/negation/process"
+
+
+@mock.patch.dict(os.environ, {"URL_CTAKES_REST": "", "URL_CNLP_NEGATION": ""})
+@mock.patch("ctakesclient.cli.Stats.draw", new=lambda self, force=False: None)
+class TestExtractCommand(unittest.TestCase):
+    """Test case for `ctakesclient extract`"""
+
+    def setUp(self):
+        super().setUp()
+        tmpdir = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.addCleanup(tmpdir.cleanup)
+        self.dir = tmpdir.name
+        self.output = os.path.join(self.dir, "results.ndjson")
+        self.notes_csv = os.path.join(self.dir, "notes.csv")
+        self.write_csv(["a", "b", "c"])
+
+    def write_csv(self, note_ids: list) -> None:
+        with open(self.notes_csv, "w", encoding="utf8", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["id", "text", "subject_id", "encounter_id"])
+            for note_id in note_ids:
+                writer.writerow([note_id, f"note {note_id}: cough", f"patient-{note_id}", f"visit-{note_id}"])
+
+    def run_cli(self, *args) -> int:
+        return cli.main(["extract", *args, "--backoff", "0"])
+
+    def stored(self) -> dict:
+        with ResultStore(self.output) as store:
+            return dict(store.iter_json())
+
+    @respx.mock
+    def test_csv_to_store(self):
+        route = respx.post(CTAKES_URL).respond(json=LoadResource.PHYSICIAN_NOTE_JSON.value)
+        self.assertEqual(0, self.run_cli(self.notes_csv, self.output))
+        self.assertEqual(3, route.call_count)
+        self.assertEqual(["a", "b", "c"], sorted(self.stored()))
+
+    @respx.mock
+    def test_other_inputs(self):
+        respx.post(CTAKES_URL).respond(json=LoadResource.PHYSICIAN_NOTE_JSON.value)
+
+        folder = os.path.join(self.dir, "notes")
+        os.mkdir(folder)
+        for name in ("one.txt", "two.txt"):
+            with open(os.path.join(folder, name), "w", encoding="utf8") as f:
+                f.write("cough")
+        self.assertEqual(0, self.run_cli(folder, self.output))
+        self.assertEqual(["one.txt", "two.txt"], sorted(self.stored()))
+
+        notes_ndjson = os.path.join(self.dir, "notes.ndjson")
+        with open(notes_ndjson, "w", encoding="utf8") as f:
+            f.write(json.dumps({"doc": 17, "body": "cough"}) + "\n")
+        output = os.path.join(self.dir, "other.ndjson")
+        self.assertEqual(0, cli.main(["extract", notes_ndjson, output, "--id-field", "doc", "--text-field", "body"]))
+        with ResultStore(output) as store:
+            self.assertEqual(["17"], store.note_ids())
+
+    @respx.mock
+    def test_resume(self):
+        route = respx.post(CTAKES_URL).respond(json=LoadResource.PHYSICIAN_NOTE_JSON.value)
+        self.assertEqual(0, self.run_cli(self.notes_csv, self.output))
+
+        self.write_csv(["a", "b", "c", "d"])
+        with mock.patch("sys.stderr", new=io.StringIO()):
+            self.assertEqual(2, self.run_cli(self.notes_csv, self.output))  # needs --continue
+        self.assertEqual(0, self.run_cli(self.notes_csv, self.output, "--continue"))
+        self.assertEqual(4, route.call_count)
+        self.assertEqual(["a", "b", "c", "d"], sorted(self.stored()))
+
+    @respx.mock
+    def test_retries(self):
+        route = respx.post(CTAKES_URL)
+        route.side_effect = [httpx.Response(503), httpx.ConnectError("down")] + [
+            httpx.Response(200, json=LoadResource.PHYSICIAN_NOTE_JSON.value)
+        ] * 3
+        self.assertEqual(0, self.run_cli(self.notes_csv, self.output, "--concurrency", "1"))
+        self.assertEqual(5, route.call_count)
+
+    @respx.mock
+    def test_failures_are_left_for_next_run(self):
+        respx.post(CTAKES_URL).respond(400)
+        with self.assertLogs(level="ERROR"):
+            self.assertEqual(1, self.run_cli(self.notes_csv, self.output))
+        self.assertEqual({}, self.stored())
+
+    @respx.mock
+    def test_cnlp_polarity(self):
+        respx.post(CTAKES_URL).respond(json=LoadResource.PHYSICIAN_NOTE_JSON.value)
+        matches = sum(len(x) for x in LoadResource.PHYSICIAN_NOTE_JSON.value.values())
+        respx.post(NEGATION_URL).respond(json={"statuses": [1] * matches})  # everything negated
+
+        self.assertEqual(0, self.run_cli(self.notes_csv, self.output, "--polarity", "negation"))
+        polarities = {m["polarity"] for x in self.stored()["a"].values() for m in x}
+        self.assertEqual({Polarity.neg.value}, polarities)
+
+    @respx.mock
+    def test_cache(self):
+        route = respx.post(CTAKES_URL).respond(json=LoadResource.PHYSICIAN_NOTE_JSON.value)
+        cache = os.path.join(self.dir, "cache.ndjson")
+        self.assertEqual(0, self.run_cli(self.notes_csv, self.output, "--cache", cache))
+        os.remove(self.output)
+        os.remove(f"{self.output}.idx")
+        self.assertEqual(0, self.run_cli(self.notes_csv, self.output, "--cache", cache))
+        self.assertEqual(3, route.call_count)
+        self.assertEqual(["a", "b", "c"], sorted(self.stored()))
+
+    @respx.mock
+    def test_fhir_output(self):
+        respx.post(CTAKES_URL).respond(json=LoadResource.PHYSICIAN_NOTE_JSON.value)
+        fhir_dir = os.path.join(self.dir, "fhir")
+        self.assertEqual(0, self.run_cli(self.notes_csv, self.output, "--fhir", fhir_dir))
+        with open(os.path.join(fhir_dir, "Observation.000.ndjson"), encoding="utf8") as f:
+            subjects = {json.loads(line)["subject"]["reference"] for line in f}
+        self.assertEqual({"Patient/patient-a", "Patient/patient-b", "Patient/patient-c"}, subjects)
+
+    @respx.mock
+    def test_metrics(self):
+        route = respx.post(CTAKES_URL)
+        route.side_effect = [httpx.Response(503)] + [
+            httpx.Response(200, json=LoadResource.PHYSICIAN_NOTE_JSON.value)
+        ] * 3
+        path = os.path.join(self.dir, "metrics.prom")
+        self.assertEqual(0, self.run_cli(self.notes_csv, self.output, "--metrics", path, "--concurrency", "1"))
+        with open(path, encoding="utf8") as f:
+            text = f.read()
+        self.assertIn('ctakesclient_requests_total{endpoint="ctakes",status="200"} 3\n', text)
+        self.assertIn('ctakesclient_retries_total{endpoint="ctakes"} 1\n', text)
+
+    def test_record_and_replay(self):
+        path = os.path.join(self.dir, "responses.cassette")
+        with respx.mock:
+            respx.post(CTAKES_URL).respond(json=LoadResource.PHYSICIAN_NOTE_JSON.value)
+            self.assertEqual(0, self.run_cli(self.notes_csv, self.output, "--record", path))
+        recorded = self.stored()
+
+        os.remove(self.output)
+        os.remove(f"{self.output}.idx")
+        with respx.mock:  # no routes, so any real request would fail
+            self.assertEqual(0, self.run_cli(self.notes_csv, self.output, "--replay", path))
+        self.assertEqual(recorded, self.stored())
+
+    @respx.mock
+    def test_prefilter(self):
+        route = respx.post(CTAKES_URL).respond(json=LoadResource.PHYSICIAN_NOTE_JSON.value)
+        self.write_csv(["a"])
+        with open(self.notes_csv, "a", encoding="utf8", newline="") as f:
+            csv.writer(f).writerow(["z", "nothing to see", "patient-z", "visit-z"])
+
+        self.assertEqual(0, self.run_cli(self.notes_csv, self.output, "--prefilter", PathResource.CONCEPTS_BSV.value))
+        self.assertEqual(1, route.call_count)
+        self.assertEqual({}, self.stored()["z"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -7,6 +7,7 @@ from unittest import mock
 import respx
 
 from ctakesclient import client
+from ctakesclient.prefilter import TermMatcher
 from ctakesclient.typesystem import Polarity
 
 from tests.test_resources import LoadResource
@@ -43,3 +44,56 @@ class TestClient(unittest.IsolatedAsyncioTestCase):
         expected = {"Diarrhea", "cough"}
         sign_symptom_pos = [m.text for m in ner.list_sign_symptom(Polarity.pos)]
         self.assertEqual(expected, set(sign_symptom_pos))
+
+    @respx.mock
+    async def test_prefilter_skips_irrelevant_text(self):
+        """Confirm that text without any dictionary terms never reaches cTAKES"""
+        route = respx.post("http://localhost:8080/ctakes-web-rest/service/analyze")
+
+        ner = await client.extract("Routine physical, no complaints.", prefilter=TermMatcher(["fever"]))
+
+        self.assertFalse(route.called)
+        self.assertEqual({}, ner.as_json())
+
+    @respx.mock
+    async def test_prefilter_sends_relevant_text(self):
+        sentence = "Patient has a fever."
+        route = respx.post("http://localhost:8080/ctakes-web-rest/service/analyze", content=sentence).respond(
+            json=LoadResource.PHYSICIAN_NOTE_JSON.value
+        )
+
+        ner = await client.extract(sentence, prefilter=TermMatcher(["fever"]))
+
+        self.assertTrue(route.called)
+        self.assertEqual(LoadResource.PHYSICIAN_NOTE_JSON.value, ner.as_json())
+
+    @respx.mock
+    async def test_prefilter_paragraphs(self):
+        """Confirm that only matching paragraphs are sent, and that spans point back into the full text"""
+        sentence = "No complaints.\n\nPatient has a 🤒 fever.\n\nFollow up in a week.\n\nCough resolved."
+        respx.post(
+            "http://localhost:8080/ctakes-web-rest/service/analyze",
+            content="Patient has a 🤒 fever.\n\nCough resolved.",
+        ).respond(
+            json={
+                "SignSymptomMention": [
+                    # These are utf16 code-point indexes, like cTAKES gives us
+                    {"begin": 17, "end": 22, "text": "fever", "polarity": 0, "type": "SignSymptomMention"},
+                    {"begin": 25, "end": 30, "text": "Cough", "polarity": 0, "type": "SignSymptomMention"},
+                ]
+            }
+        )
+
+        ner = await client.extract(sentence, prefilter=TermMatcher(["fever", "cough"]), prefilter_paragraphs=True)
+
+        spans = ner.list_spans(ner.list_sign_symptom())
+        self.assertEqual(["fever", "Cough"], [sentence[begin:end] for begin, end in spans])
+
+    @respx.mock
+    async def test_prefilter_paragraphs_without_matches(self):
+        route = respx.post("http://localhost:8080/ctakes-web-rest/service/analyze")
+
+        ner = await client.extract("No complaints.", prefilter=TermMatcher(["fever"]), prefilter_paragraphs=True)
+
+        self.assertFalse(route.called)
+        self.assertEqual({}, ner.as_json())
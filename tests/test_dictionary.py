@@ -0,0 +1,85 @@
+"""Tests for the dictionary module"""
+
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from ctakesclient import dictionary, filesystem
+from tests.test_resources import PathResource
+
+
+class TestConceptDictionary(unittest.TestCase):
+    """Test case for the SQLite-backed concept dictionary"""
+
+    def setUp(self):
+        super().setUp()
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.bsv_path = os.path.join(tmpdir, "concepts.bsv")
+        shutil.copy(PathResource.CONCEPTS_BSV.value, self.bsv_path)
+
+    def open(self) -> dictionary.ConceptDictionary:
+        concepts = dictionary.ConceptDictionary(self.bsv_path)
+        self.addCleanup(concepts.close)
+        return concepts
+
+    def test_lookups(self):
+        concepts = self.open()
+        self.assertEqual(2, len(concepts))
+        self.assertEqual(
+            ["C0239134|T033|28743005|SNOMEDCT_US|Productive Cough|Cough"], [str(x) for x in concepts.by_cui("C0239134")]
+        )
+        self.assertEqual(["C0015672"], [x.cui for x in concepts.by_tui("T184")])
+        self.assertEqual(["C0015672"], [x.cui for x in concepts.by_code("84229001")])
+        self.assertEqual(["C0015672"], [x.cui for x in concepts.by_code("84229001", vocab="SNOMEDCT_US")])
+        self.assertEqual([], concepts.by_code("84229001", vocab="ICD10CM"))
+        self.assertEqual(2, len(concepts.by_vocab("SNOMEDCT_US")))
+        self.assertEqual(["C0239134"], [x.cui for x in concepts.by_text("productive cough")])
+        self.assertEqual("Cough", concepts.pref("C0239134"))
+        self.assertIsNone(concepts.pref("C9999999"))
+
+    def test_store_is_reused(self):
+        self.open().close()
+        self.assertTrue(os.path.exists(f"{self.bsv_path}.sqlite"))
+
+        with mock.patch.object(dictionary.ConceptDictionary, "rebuild") as rebuild:
+            self.open()
+        rebuild.assert_not_called()
+
+    def test_touched_but_unchanged_source_is_not_rebuilt(self):
+        self.open().close()
+        stat = os.stat(self.bsv_path)
+        os.utime(self.bsv_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+
+        with mock.patch.object(dictionary.ConceptDictionary, "rebuild") as rebuild:
+            self.open()
+        rebuild.assert_not_called()
+
+    def test_changed_source_is_rebuilt(self):
+        self.open().close()
+        with open(self.bsv_path, "a", encoding="utf8") as f:
+            f.write("\nC0010200|T184|49727002|SNOMEDCT_US|Cough|Cough\n")
+
+        concepts = self.open()
+        self.assertEqual(3, len(concepts))
+        self.assertEqual("Cough", concepts.pref("C0010200"))
+
+    def test_pref_is_last_row_like_map_cui_pref(self):
+        with open(self.bsv_path, "a", encoding="utf8") as f:
+            f.write("\nC0239134|T184|49727002|SNOMEDCT_US|Cough|Wet Cough\n")
+            f.write("C0239134|T184|49727003|ICD10CM|Cough|Productive cough\n")
+
+        concepts = self.open()
+        expected = filesystem.map_cui_pref(self.bsv_path)["C0239134"]
+        self.assertEqual("Productive cough", expected)
+        self.assertEqual(expected, concepts.pref("C0239134"))
+
+    def test_rebuild_leaves_no_temp_files(self):
+        self.open().rebuild()
+        self.assertEqual(["concepts.bsv", "concepts.bsv.sqlite"], sorted(os.listdir(os.path.dirname(self.bsv_path))))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,12 +1,30 @@
 """Tests for the filesystem module"""
 
 import os
+import pickle
+import shutil
+import tempfile
 import unittest
+from unittest import mock
 
 import ddt
 
 from ctakesclient import filesystem
-from tests.test_resources import PathResource
+from ctakesclient.exceptions import BSVError
+from ctakesclient.typesystem import CtakesJSON, Polarity
+from tests.test_resources import LoadResource, PathResource
+
+
+class LineConcept:
+    """A custom BSV class that parses the raw line itself, like user code written against from_bsv(str)"""
+
+    def __init__(self):
+        self.cui = None
+        self.pref = None
+
+    def from_bsv(self, source):
+        fields = source.split("|")
+        self.cui, self.pref = fields[0], fields[-1]
 
 
 @ddt.ddt
@@ -96,6 +114,27 @@ class TestCovidSymptomsBSV(unittest.TestCase):
             [x.as_json() for x in concepts],
         )
 
+    def test_rows_are_compact(self):
+        concepts = filesystem.covid_symptoms()
+        self.assertFalse(hasattr(concepts[0], "__dict__"))
+
+        # low-cardinality columns share one string object across rows
+        snomed = [bsv.vocab for bsv in concepts if bsv.vocab == "SNOMEDCT_US"]
+        self.assertLess(1, len(snomed))
+        self.assertTrue(all(vocab is snomed[0] for vocab in snomed))
+
+        groups = [bsv.group_id for bsv in filesystem.umls_semantic_groups() if bsv.group_id == "DISO"]
+        self.assertTrue(all(group is groups[0] for group in groups))
+
+    def test_rows_pickle(self):
+        concept = filesystem.list_bsv_concept(PathResource.CONCEPTS_BSV.value)[0]
+        semantic = filesystem.list_bsv_semantics(PathResource.SEMANTICS_BSV.value)[0]
+        for row in (concept, semantic):
+            copy = pickle.loads(pickle.dumps(row))
+            self.assertIsInstance(copy, type(row))
+            self.assertEqual(row.as_json(), copy.as_json())
+            self.assertEqual(row.to_bsv(), copy.to_bsv())
+
     def test_map_cui_pref_takes_filename(self):
         cui_map = filesystem.map_cui_pref(PathResource.CONCEPTS_BSV.value)
         self.assertEqual(
@@ -116,6 +155,198 @@ class TestCovidSymptomsBSV(unittest.TestCase):
             cui_map,
         )
 
+    @ddt.data(1, 2, 7, 1000)
+    def test_split_byte_ranges(self, count):
+        path = filesystem.covid_symptoms_path()
+        ranges = filesystem.split_byte_ranges(path, count)
+        self.assertLessEqual(len(ranges), count)
+        self.assertEqual(0, ranges[0][0])
+        self.assertEqual(os.path.getsize(path), ranges[-1][1])
+
+        with open(path, "rb") as f:
+            data = f.read()
+        for (_, end), (start, _) in zip(ranges, ranges[1:]):
+            self.assertEqual(end, start)  # contiguous
+            self.assertEqual(ord("\n"), data[start - 1])  # starts on a new line
+
+    def test_list_bsv_parallel(self):
+        for path, class_bsv in [
+            (filesystem.covid_symptoms_path(), filesystem.BsvConcept),
+            (filesystem.umls_semantic_groups_path(), filesystem.BsvSemanticType),
+        ]:
+            serial = filesystem.list_bsv(path, class_bsv)
+            parallel = filesystem.list_bsv_parallel(path, class_bsv, max_workers=2, chunks=7)
+            self.assertEqual([x.as_json() for x in serial], [x.as_json() for x in parallel])
+            self.assertIsInstance(parallel[0], class_bsv)
+
+    def test_custom_class_gets_the_line(self):
+        path = PathResource.CONCEPTS_BSV.value
+        expected = [("C0239134", "Cough"), ("C0015672", "Fatigue")]
+        for entries in (
+            filesystem.list_bsv(path, LineConcept),
+            list(filesystem.iter_bsv(path, LineConcept)),
+            filesystem.list_bsv_parallel(path, LineConcept, max_workers=1),
+        ):
+            self.assertEqual(expected, [(x.cui, x.pref) for x in entries])
+
+    def test_list_bsv_parallel_validates_rows(self):
+        with tempfile.NamedTemporaryFile("w", suffix=".bsv") as f:
+            f.write("C0239134|T033|28743005|SNOMEDCT_US|Productive Cough\n")
+            f.flush()
+            with self.assertRaises(BSVError):
+                filesystem.list_bsv_parallel(f.name, filesystem.BsvConcept, max_workers=1)
+
+    def test_resources_are_parsed_once(self):
+        filesystem.covid_symptoms()
+        filesystem.umls_semantic_groups()
+        filesystem.map_cui_pref(filesystem.covid_symptoms_path())
+        with mock.patch("ctakesclient.filesystem.list_bsv", side_effect=AssertionError("reparsed")):
+            first = filesystem.covid_symptoms()
+            first.clear()  # callers get their own list
+            self.assertEqual(filesystem.covid_symptoms()[0].as_json(), filesystem.covid_symptoms()[0].as_json())
+            self.assertEqual(127, len(filesystem.umls_semantic_groups()))
+            cui_map = filesystem.map_cui_pref(filesystem.covid_symptoms_path())
+            self.assertIsInstance(cui_map, dict)
+            cui_map["C0010200"] = "Changed"  # callers get their own dict
+            self.assertEqual("Cough", filesystem.map_cui_pref(filesystem.covid_symptoms_path())["C0010200"])
+
+    def test_cached_resource_rows_are_not_shared(self):
+        for load in (filesystem.covid_symptoms, filesystem.umls_semantic_groups):
+            first = load()[0]
+            expected = first.as_json()
+            first.tui = "T000"
+            self.assertEqual(expected, load()[0].as_json())
+
+    def test_map_cui_pref_notices_file_changes(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "concepts.bsv")
+            shutil.copy(PathResource.CONCEPTS_BSV.value, path)
+            self.assertEqual(2, len(filesystem.map_cui_pref(path)))
+            with open(path, "a", encoding="utf8") as f:
+                f.write("\nC0010200|T184|49727002|SNOMEDCT_US|Cough|Cough\n")
+            self.assertEqual(3, len(filesystem.map_cui_pref(path)))
+
+    def test_semantic_group_indexes(self):
+        ner = CtakesJSON(LoadResource.SYNTHETIC_JSON.value)
+        tui_group = filesystem.map_tui_semantic_group()
+        self.assertEqual(127, len(tui_group))
+        self.assertEqual("DISO", tui_group["T184"].group_id)
+        self.assertEqual("Sign or Symptom", tui_group["T184"].tui_label)
+        for bsv in tui_group.values():
+            bsv.group_id = "XXXX"  # callers get their own rows...
+        self.assertEqual("DISO", filesystem.map_tui_semantic_group()["T184"].group_id)
+        labels = {match.text: groups for match, groups in filesystem.list_match_semantic_groups(ner)}
+        self.assertEqual(("DISO",), labels["acute viral pharyngitis"])  # ...so shared lookups are unaffected
+
+        tui_group = filesystem.map_tui_semantic_group()
+        group_tuis = filesystem.map_semantic_group_tuis()
+        self.assertIn("T184", group_tuis["DISO"])
+        self.assertEqual(127, sum(len(tuis) for tuis in group_tuis.values()))
+        for group, tuis in group_tuis.items():
+            for tui in tuis:
+                self.assertEqual(group, tui_group[tui].group_id)
+
+    def test_list_match_semantic_groups(self):
+        ner = CtakesJSON(LoadResource.SYNTHETIC_JSON.value)
+        labeled = filesystem.list_match_semantic_groups(ner)
+        self.assertEqual(ner.list_match(), [match for match, _ in labeled])
+
+        labels = {match.text: groups for match, groups in labeled}
+        self.assertEqual(("DISO",), labels["acute viral pharyngitis"])
+        self.assertEqual(("CHEM",), labels["chewable tablet"])
+
+        positive = filesystem.list_match_semantic_groups(ner, polarity=Polarity.pos)
+        self.assertEqual(ner.list_match(polarity=Polarity.pos), [match for match, _ in positive])
+
+
+class TestBsvConceptIndex(unittest.TestCase):
+    """Test case for compiled, memory-mapped BSV indexes"""
+
+    def setUp(self):
+        super().setUp()
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.bsv_path = os.path.join(tmpdir, "concepts.bsv")
+        shutil.copy(PathResource.CONCEPTS_BSV.value, self.bsv_path)
+        with open(self.bsv_path, "a", encoding="utf8") as f:
+            f.write("\nC0010200|T184|49727002|SNOMEDCT_US|Cough|Cough\n")
+            f.write("C0239134|T033|R05|ICD10CM|Wet cough|Wet cough\n")
+
+    def test_lookup(self):
+        with filesystem.open_bsv_index(self.bsv_path) as index:
+            self.assertEqual(4, len(index))
+            self.assertEqual(
+                [
+                    "C0239134|T033|28743005|SNOMEDCT_US|Productive Cough|Cough",
+                    "C0239134|T033|R05|ICD10CM|Wet cough|Wet cough",
+                ],
+                [str(x) for x in index.by_cui("C0239134")],
+            )
+            self.assertEqual("Fatigue", index.pref("C0015672"))
+            self.assertIn("C0010200", index)
+            self.assertNotIn("C0000000", index)
+            self.assertEqual([], index.by_cui("C9999999"))
+            self.assertIsNone(index.pref("C9999999"))
+
+    def test_pref_is_last_row_like_map_cui_pref(self):
+        with filesystem.open_bsv_index(self.bsv_path) as index:
+            self.assertEqual("Wet cough", index.pref("C0239134"))
+            self.assertEqual(filesystem.map_cui_pref(self.bsv_path)["C0239134"], index.pref("C0239134"))
+
+    def test_matches_map_cui_pref(self):
+        path = filesystem.compile_bsv_index(filesystem.covid_symptoms_path(), f"{self.bsv_path}.covid.idx")
+        with filesystem.BsvConceptIndex(path) as index:
+            for cui, pref in filesystem.map_cui_pref(filesystem.covid_symptoms_path()).items():
+                self.assertEqual(pref, index.pref(cui))
+
+    def test_recompiles_when_stale(self):
+        filesystem.open_bsv_index(self.bsv_path).close()
+        with open(self.bsv_path, "a", encoding="utf8") as f:
+            f.write("C0000001|T184|1|SNOMEDCT_US|New|New\n")
+        os.utime(self.bsv_path, (os.path.getmtime(self.bsv_path) + 10,) * 2)
+
+        with filesystem.open_bsv_index(self.bsv_path) as index:
+            self.assertEqual("New", index.pref("C0000001"))
+
+    def test_recompiles_when_size_changes(self):
+        filesystem.open_bsv_index(self.bsv_path).close()
+        mtime_ns = os.stat(self.bsv_path).st_mtime_ns
+        with open(self.bsv_path, "a", encoding="utf8") as f:
+            f.write("C0000001|T184|1|SNOMEDCT_US|New|New\n")
+        os.utime(self.bsv_path, ns=(mtime_ns, mtime_ns))  # same mtime, so only the size gives it away
+
+        with filesystem.open_bsv_index(self.bsv_path) as index:
+            self.assertEqual("New", index.pref("C0000001"))
+
+    def test_recompiles_unreadable_index(self):
+        with open(f"{self.bsv_path}.idx", "wb") as f:
+            f.write(b"garbage")
+        with filesystem.open_bsv_index(self.bsv_path) as index:
+            self.assertEqual(4, len(index))
+
+    def test_compile_leaves_no_temp_files(self):
+        filesystem.compile_bsv_index(self.bsv_path)
+        with mock.patch("os.replace", side_effect=OSError("disk full")):
+            with self.assertRaises(OSError):
+                filesystem.compile_bsv_index(self.bsv_path)
+        self.assertEqual(["concepts.bsv", "concepts.bsv.idx"], sorted(os.listdir(os.path.dirname(self.bsv_path))))
+        with filesystem.BsvConceptIndex(f"{self.bsv_path}.idx") as index:
+            self.assertEqual(4, len(index))  # the old index is untouched
+
+    def test_rejects_other_files(self):
+        with self.assertRaises(BSVError):
+            filesystem.BsvConceptIndex(self.bsv_path)
+
+    def test_rejects_truncated_files(self):
+        path = filesystem.compile_bsv_index(self.bsv_path)
+        with open(path, "rb") as f:
+            data = f.read()
+        for size in (0, 4, 20, len(data) - 1):
+            with open(path, "wb") as f:
+                f.write(data[:size])
+            with self.assertRaises(BSVError, msg=size):
+                filesystem.BsvConceptIndex(path)
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,141 @@
+"""Tests for the invertedindex module"""
+
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from ctakesclient import invertedindex
+from ctakesclient.invertedindex import InvertedIndex
+from ctakesclient.store import ResultStore
+from ctakesclient.typesystem import CtakesJSON, Polarity, UmlsTypeMention
+from tests.test_resources import LoadResource
+
+
+class TestInvertedIndex(unittest.TestCase):
+    """Test case for the concept -> notes index"""
+
+    def setUp(self):
+        super().setUp()
+        tmpdir = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.addCleanup(tmpdir.cleanup)
+        self.dir = tmpdir.name
+
+        self.index = InvertedIndex()
+        self.index.add("synthetic", CtakesJSON(LoadResource.SYNTHETIC_JSON.value))
+        self.index.add_json("physician", LoadResource.PHYSICIAN_NOTE_JSON.value)
+        self.index.add("empty", CtakesJSON())
+
+    def assert_queries(self, index: InvertedIndex) -> None:
+        self.assertEqual(["physician"], index.query(all_of=[("cui", "C0010200", Polarity.pos)]))
+        self.assertEqual(["physician"], index.query(all_of=[("cui", "C0008031")]))
+        self.assertEqual([], index.query(all_of=[("cui", "C0008031", Polarity.pos)]))
+        self.assertEqual(["synthetic", "physician"], index.query(all_of=[("tui", "T184")]))
+        self.assertEqual(["physician"], index.query(all_of=[("tui", "T184"), ("tui", "T184", Polarity.neg)]))
+        self.assertEqual(["synthetic", "physician"], index.query(any_of=[("cui", "C0000970"), ("cui", "C0010200")]))
+        self.assertEqual(["physician", "empty"], index.query(none_of=[("type", UmlsTypeMention.Medication)]))
+        self.assertEqual(
+            ["synthetic"],
+            index.query(
+                all_of=[("type", "SignSymptomMention", Polarity.pos)],
+                any_of=[("tui", "T047"), ("cui", "nope")],
+                none_of=[("cui", "C0010200")],
+            ),
+        )
+        self.assertEqual(["synthetic", "physician", "empty"], index.query())
+        self.assertEqual(2, index.count(("tui", "T184")))
+
+    def test_queries(self):
+        self.assert_queries(self.index)
+        self.assertEqual(3, len(self.index))
+        self.assertIn("empty", self.index)
+
+    def test_object_and_json_input_agree(self):
+        from_json = InvertedIndex()
+        from_json.add_json("synthetic", LoadResource.SYNTHETIC_JSON.value)
+        from_json.add("physician", CtakesJSON(LoadResource.PHYSICIAN_NOTE_JSON.value))
+        from_json.add_json("empty", {})
+        self.assert_queries(from_json)
+
+    def test_save_load_and_update(self):
+        path = os.path.join(self.dir, "index.bin")
+        self.index.save(path)
+        loaded = InvertedIndex.load(path)
+        self.assert_queries(loaded)
+
+        # Keep adding after a reload, and re-save
+        self.assertTrue(loaded.add_json("again", LoadResource.PHYSICIAN_NOTE_JSON.value))
+        loaded.save(path)
+        self.assertEqual(["physician", "again"], InvertedIndex.load(path).query(all_of=[("cui", "C0010200")]))
+
+    def test_adding_again_replaces(self):
+        self.assertFalse(self.index.add_json("physician", LoadResource.SYNTHETIC_JSON.value))
+        self.assertEqual(3, len(self.index))
+        self.assertEqual([], self.index.query(all_of=[("cui", "C0010200")]))
+        self.assertEqual(["synthetic", "physician"], self.index.query(all_of=[("tui", "T047")]))
+        self.assertEqual(["synthetic", "empty", "physician"], self.index.query())
+        self.assertEqual(0, self.index.count(("cui", "C0008031")))
+
+        # Saving drops the replaced postings, and keeps the order
+        path = os.path.join(self.dir, "index.bin")
+        self.index.save(path)
+        loaded = InvertedIndex.load(path)
+        self.assertEqual(["synthetic", "empty", "physician"], loaded.query())
+        self.assertEqual(["synthetic", "physician"], loaded.query(all_of=[("tui", "T047")]))
+        self.assertEqual([], loaded.query(all_of=[("cui", "C0010200")]))
+
+    def test_from_store(self):
+        with ResultStore(os.path.join(self.dir, "results.ndjson")) as store:
+            store.append("synthetic", CtakesJSON(LoadResource.SYNTHETIC_JSON.value))
+            store.append("physician", CtakesJSON(LoadResource.PHYSICIAN_NOTE_JSON.value))
+            store.append("empty", CtakesJSON())
+            index = InvertedIndex.from_store(store)
+            self.assert_queries(index)
+
+            store.append("later", CtakesJSON(LoadResource.PHYSICIAN_NOTE_JSON.value))
+            self.assertEqual(1, index.add_store(store))
+            self.assertEqual(["physician", "later"], index.query(all_of=[("cui", "C0010200")]))
+            self.assertEqual(0, index.add_store(store))
+
+    def test_add_store_resumes_and_reindexes_updates(self):
+        for compress in (False, True):
+            path = os.path.join(self.dir, f"results-{compress}.ndjson")
+            with ResultStore(path, compress=compress, block_size=1) as store:
+                store.append("synthetic", CtakesJSON(LoadResource.SYNTHETIC_JSON.value))
+                store.append("physician", CtakesJSON(LoadResource.PHYSICIAN_NOTE_JSON.value))
+            index = InvertedIndex()
+            with ResultStore(path) as store:
+                self.assertEqual(2, index.add_store(store))
+            index_path = os.path.join(self.dir, "index.bin")
+            index.save(index_path)
+
+            # Re-extract a note in a later run: only the new record is read, and it replaces the old postings
+            index = InvertedIndex.load(index_path)
+            with ResultStore(path) as store:
+                store.append("physician", CtakesJSON())
+                with mock.patch.object(store, "iter_json", wraps=store.iter_json) as iter_json:
+                    self.assertEqual(1, index.add_store(store))
+                self.assertLess(0, iter_json.call_args.kwargs["start"])
+                self.assertEqual({}, store.get_json("physician"))
+            self.assertEqual([], index.query(all_of=[("cui", "C0010200")]), compress)
+            self.assertEqual(["synthetic", "physician"], index.query(), compress)
+
+    def test_bad_input(self):
+        with self.assertRaisesRegex(ValueError, "field unknown: code"):
+            self.index.query(all_of=[("code", "1234")])
+
+        path = os.path.join(self.dir, "index.bin")
+        with open(path, "wb") as f:
+            f.write(b"not an index")
+        with self.assertRaisesRegex(ValueError, "not an inverted index"):
+            InvertedIndex.load(path)
+
+    def test_postings_encoding(self):
+        doc_ids = [0, 1, 5, 127, 128, 300, 70000]
+        encoded = invertedindex.encode_postings(doc_ids)
+        self.assertEqual(doc_ids, list(invertedindex.decode_postings(encoded)))
+        self.assertEqual(b"\x00\x01\x04", invertedindex.encode_postings([0, 1, 5]))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,181 @@
+"""Tests for the metrics module"""
+
+import os
+import tempfile
+import unittest
+
+import httpx
+import respx
+
+from ctakesclient import client, metrics, text2fhir, transformer
+from ctakesclient.typesystem import CtakesJSON
+from tests.test_resources import LoadResource
+
+CTAKES_URL = "http://localhost:8080/ctakes-web-rest/service/analyze"
+NEGATION_URL = "http://localhost:8000/negation/process"
+
+
+class RecordingHook(metrics.Hook):
+    """Keeps everything it is told"""
+
+    def __init__(self):
+        self.requests = []
+        self.stages = []
+        self.retries = []
+
+    def request(self, timing: metrics.RequestTiming) -> None:
+        self.requests.append(timing)
+
+    def stage(self, name: str, seconds: float) -> None:
+        self.stages.append(name)
+
+    def retry(self, endpoint: str, error: Exception) -> None:
+        self.retries.append(endpoint)
+
+
+class BrokenHook(metrics.Hook):
+    """A hook that always fails"""
+
+    def request(self, timing: metrics.RequestTiming) -> None:
+        raise RuntimeError("oops")
+
+
+class FakeSpan:
+    """Just enough of an OpenTelemetry span"""
+
+    def __init__(self, name: str, kwargs: dict):
+        self.name = name
+        self.kwargs = kwargs
+        self.end_time = None
+
+    def set_status(self, status) -> None:
+        self.kwargs["status"] = status
+
+    def end(self, end_time: int = None) -> None:
+        self.end_time = end_time
+
+
+class FakeTracer:
+    """Just enough of an OpenTelemetry tracer"""
+
+    def __init__(self):
+        self.spans = []
+
+    def start_span(self, name: str, **kwargs) -> FakeSpan:
+        self.spans.append(FakeSpan(name, kwargs))
+        return self.spans[-1]
+
+
+class TestMetrics(unittest.IsolatedAsyncioTestCase):
+    """Test case for instrumentation hooks"""
+
+    def add_hook(self, hook: metrics.Hook) -> metrics.Hook:
+        metrics.add_hook(hook)
+        self.addCleanup(metrics.remove_hook, hook)
+        return hook
+
+    def test_disabled_by_default(self):
+        self.assertFalse(metrics.enabled())
+        self.assertIsNone(metrics.start())
+        metrics.stage("parse", None)  # no-op
+
+    @respx.mock
+    async def test_requests_and_stages(self):
+        hook = self.add_hook(RecordingHook())
+        respx.post(CTAKES_URL).respond(json=LoadResource.PHYSICIAN_NOTE_JSON.value)
+        respx.post(NEGATION_URL).respond(json={"statuses": [1, -1]})
+
+        ner = await client.extract("a note")
+        await transformer.list_polarity("a note", [(0, 1), (2, 6)])
+        text2fhir.nlp_fhir_json("patient", "visit", "doc", ner)
+
+        self.assertEqual(["ctakes", "negation"], [t.endpoint for t in hook.requests])
+        timing = hook.requests[0]
+        self.assertEqual((CTAKES_URL, 6, 6), (timing.url, timing.text_length, timing.sent_bytes))
+        self.assertEqual((200, None), (timing.status, timing.error))
+        self.assertEqual(len(respx.calls[0].response.content), timing.received_bytes)
+        self.assertIn("decode", timing.phases)
+        self.assertGreater(timing.seconds, 0)
+        self.assertEqual(["parse", "adjust_offsets", "fhir"], hook.stages)
+
+    @respx.mock
+    async def test_failed_requests(self):
+        hook = self.add_hook(RecordingHook())
+        respx.post(CTAKES_URL).side_effect = [httpx.Response(503), httpx.ConnectError("down")]
+
+        with self.assertRaises(httpx.HTTPStatusError):
+            await client.post("a note")
+        with self.assertRaises(httpx.ConnectError):
+            await client.post("a note")
+
+        self.assertEqual([503, None], [t.status for t in hook.requests])
+        self.assertEqual(["HTTPStatusError", "ConnectError"], [t.error for t in hook.requests])
+
+    async def test_phase_tracer(self):
+        tracer = metrics._PhaseTracer()  # pylint: disable=protected-access
+        for event in ["connection.connect_tcp", "http11.send_request_headers", "http11.send_request_body"]:
+            await tracer(f"{event}.started", {})
+            await tracer(f"{event}.complete", {})
+        await tracer("http11.receive_response_headers.started", {})
+        await tracer("http11.receive_response_headers.failed", {})
+        await tracer("http11.response_closed.started", {})
+        self.assertEqual({"connect", "upload", "server"}, set(tracer.phases))
+
+    @respx.mock
+    async def test_broken_hook_is_only_logged(self):
+        self.add_hook(BrokenHook())
+        respx.post(CTAKES_URL).respond(json={})
+        with self.assertLogs(level="ERROR"):
+            self.assertEqual({}, await client.post("a note"))
+
+    def test_prometheus(self):
+        collector = metrics.MetricsCollector()
+        collector.request(metrics.RequestTiming("ctakes", CTAKES_URL, 5000, 0.3, 5000, 20, 200, phases={"server": 0.2}))
+        collector.request(metrics.RequestTiming("ctakes", CTAKES_URL, 100, 0.02, 100, 0, 500, "HTTPStatusError"))
+        collector.retry("ctakes", ValueError())
+        collector.stage("parse", 0.0003)
+
+        text = collector.to_prometheus()
+        for line in [
+            "# TYPE ctakesclient_request_duration_seconds histogram",
+            'ctakesclient_request_duration_seconds_bucket{endpoint="ctakes",size="<=16000",le="0.25"} 0',
+            'ctakesclient_request_duration_seconds_bucket{endpoint="ctakes",size="<=16000",le="0.5"} 1',
+            'ctakesclient_request_duration_seconds_count{endpoint="ctakes",size="<=1000"} 1',
+            'ctakesclient_requests_total{endpoint="ctakes",status="500"} 1',
+            'ctakesclient_request_phase_seconds_total{endpoint="ctakes",phase="server"} 0.2',
+            'ctakesclient_sent_bytes_total{endpoint="ctakes"} 5100',
+            'ctakesclient_retries_total{endpoint="ctakes"} 1',
+            'ctakesclient_stage_duration_seconds_bucket{stage="parse",le="0.0005"} 1',
+        ]:
+            self.assertIn(f"{line}\n", text)
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "ctakesclient.prom")
+            collector.write_prometheus(path)
+            with open(path, encoding="utf8") as f:
+                self.assertEqual(text, f.read())
+            self.assertEqual(["ctakesclient.prom"], os.listdir(tmpdir))
+
+        self.assertEqual("", metrics.MetricsCollector().to_prometheus())
+        self.assertEqual(">64000", metrics.note_size_label(64001))
+
+    def test_opentelemetry(self):
+        tracer = FakeTracer()
+        hook = metrics.OpenTelemetryHook(tracer)
+        hook.request(metrics.RequestTiming("ctakes", CTAKES_URL, 10, 0.5, 10, 0, None, "ConnectError"))
+        hook.stage("parse", 0.001)
+
+        request_span, stage_span = tracer.spans[0], tracer.spans[1]
+        self.assertEqual("POST ctakes", request_span.name)
+        self.assertEqual("ConnectError", request_span.kwargs["attributes"]["error.type"])
+        self.assertEqual(500000000, request_span.end_time - request_span.kwargs["start_time"])
+        self.assertEqual("ctakesclient.parse", stage_span.name)
+
+    def test_converter_stage(self):
+        hook = self.add_hook(RecordingHook())
+        text2fhir.NlpFhirConverter().convert("patient", "visit", "doc", CtakesJSON())
+        self.assertEqual(["fhir"], hook.stages)
+
+
+if __name__ == "__main__":
+    unittest.main()
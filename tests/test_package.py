@@ -0,0 +1,27 @@
+"""Tests for the package itself (ctakesclient/__init__.py)"""
+
+import subprocess  # nosec
+import sys
+import unittest
+
+import ctakesclient
+
+
+class TestLazyImports(unittest.TestCase):
+    """Test case for importing submodules on first use"""
+
+    def test_import_is_light(self):
+        code = "import sys, ctakesclient; print(sorted(m for m in sys.modules if m.split('.')[0] in %r))"
+        heavy = ("ctakesclient", "fhirclient", "httpx")
+        output = subprocess.check_output([sys.executable, "-c", code % (heavy,)], text=True)  # nosec
+        self.assertEqual("['ctakesclient']", output.strip())
+
+    def test_submodules_load_on_access(self):
+        self.assertEqual("ctakesclient.text2fhir", ctakesclient.text2fhir.__name__)
+        self.assertIn("typesystem", dir(ctakesclient))
+        with self.assertRaisesRegex(AttributeError, "has no attribute 'nope'"):
+            ctakesclient.nope  # pylint: disable=pointless-statement
+
+
+if __name__ == "__main__":
+    unittest.main()
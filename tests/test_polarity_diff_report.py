@@ -0,0 +1,414 @@
+"""Tests for the polarity-diff-report script"""
+
+import argparse
+import asyncio
+import contextlib
+import csv
+import importlib.util
+import io
+import json
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+import httpx
+
+import ctakesclient
+
+_SCRIPT = os.path.join(os.path.dirname(__file__), os.pardir, "scripts", "polarity-diff-report.py")
+_spec = importlib.util.spec_from_file_location("polarity_diff_report", _SCRIPT)
+pdr = importlib.util.module_from_spec(_spec)
+sys.modules[_spec.name] = pdr  # so that worker processes can find its functions (for summary --processes)
+_spec.loader.exec_module(pdr)
+
+
+class TestCsvRows(unittest.TestCase):
+    """Test case for reading the notes CSV with byte offsets"""
+
+    def setUp(self):
+        super().setUp()
+        tmpdir = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.addCleanup(tmpdir.cleanup)
+        self.path = os.path.join(tmpdir.name, "notes.csv")
+
+    def write_csv(self, text: str) -> None:
+        with open(self.path, "w", encoding="utf8", newline="") as f:
+            f.write(text)
+
+    def dict_reader_rows(self) -> list:
+        with open(self.path, encoding="utf8", newline="") as f:
+            return list(csv.DictReader(f))
+
+    def test_matches_dict_reader(self):
+        self.write_csv(
+            "INSTANCE_NUM,OBSERVATION_BLOB\n"
+            '1,"Cough,\nno fever"\n'
+            "\n"
+            "2\n"
+            "3,Fatigue,extra,values\n"
+            "4,Chills\n"
+            "\n"
+        )
+        with pdr.CsvRows(self.path) as rows:
+            found = [row for row, _ in rows]
+
+        self.assertEqual(self.dict_reader_rows(), found)
+        self.assertEqual(["1", "2", "3", "4"], [row["INSTANCE_NUM"] for row in found])
+        self.assertIsNone(found[1]["OBSERVATION_BLOB"])
+        self.assertEqual(["extra", "values"], found[2][None])
+
+    def test_trailing_blank_line(self):
+        self.write_csv("INSTANCE_NUM,OBSERVATION_BLOB\n1,Cough\n2,Fever\n\n")
+        with pdr.CsvRows(self.path) as rows:
+            self.assertEqual(["1", "2"], [row["INSTANCE_NUM"] for row, _ in rows])
+
+    def test_resume_from_offset(self):
+        self.write_csv('INSTANCE_NUM,OBSERVATION_BLOB\n1,"Cough,\nno fever"\n\n2,Fever\n3,Chills\n')
+        with pdr.CsvRows(self.path) as rows:
+            offsets = [offset for _, offset in rows]
+        self.assertEqual(os.path.getsize(self.path), offsets[-1])
+
+        with pdr.CsvRows(self.path, start=offsets[0]) as rows:
+            self.assertEqual(["2", "3"], [row["INSTANCE_NUM"] for row, _ in rows])
+
+
+class FakeClient:
+    """
+    Stands in for the httpx client, answering like empty cTAKES and cNLP servers
+
+    Notes named "note N" take longer the smaller N is, so concurrent notes finish in reverse order.
+    Notes named "down" or "crash" fail with a connection error or an unexpected error.
+    """
+
+    def __init__(self, **kwargs):
+        del kwargs
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        pass
+
+    async def post(self, url: str, content: bytes = None, **kwargs) -> httpx.Response:
+        if content is None:  # cNLP
+            body = {"statuses": [-1] * len(kwargs["json"]["entities"])}
+        else:  # cTAKES
+            text = content.decode("utf8")
+            if text == "down":
+                raise httpx.ConnectError("connection refused")
+            if text == "crash":
+                raise RuntimeError("boom")
+            await asyncio.sleep(0.01 * (10 - int(text.split()[-1])))
+            body = {}
+        return httpx.Response(200, json=body, request=httpx.Request("POST", url))
+
+
+class ReportTestCase(unittest.IsolatedAsyncioTestCase):
+    """Base test case for writing reports, by running notes through the (fake) servers"""
+
+    def setUp(self):
+        super().setUp()
+        tmpdir = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.addCleanup(tmpdir.cleanup)
+        self.notes_path = os.path.join(tmpdir.name, "notes.csv")
+        self.pdr_path = pdr.report_path_for(self.notes_path)
+
+    def write_notes(self, texts: list, first_instance: int = 1) -> None:
+        with open(self.notes_path, "w", encoding="utf8", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["INSTANCE_NUM", "OBSERVATION_BLOB"])
+            writer.writerows(enumerate(texts, start=first_instance))
+
+    async def calculate(self, concurrency: int = 3, resume: bool = False) -> None:
+        args = argparse.Namespace(
+            notes_path=self.notes_path, concurrency=concurrency, shards=None, shard_index=None, resume=resume
+        )
+        with mock.patch.object(pdr.httpx, "AsyncClient", FakeClient), contextlib.redirect_stdout(io.StringIO()):
+            await pdr.calculate(None, args)
+
+    def report(self) -> list:
+        with open(self.pdr_path, encoding="utf8") as f:
+            return [json.loads(line) for line in f]
+
+
+class TestCalculate(ReportTestCase):
+    """Test case for running notes through the (fake) servers concurrently"""
+
+    async def test_output_stays_in_input_order(self):
+        self.write_notes([f"note {i}" for i in range(1, 7)])
+        await self.calculate()
+        self.assertEqual(["1", "2", "3", "4", "5", "6"], [note["instance_num"] for note in self.report()])
+        self.assertEqual([1, 2, 3, 4, 5, 6], [record[1] for record in pdr.iter_index_records(f"{self.pdr_path}.idx")])
+
+    async def test_http_errors_are_recorded_per_note(self):
+        self.write_notes(["note 1", "down", "note 3"])
+        await self.calculate()
+        self.assertEqual([None, "connection refused", None], [note["error"] for note in self.report()])
+
+    async def test_other_errors_stop_the_run_cleanly(self):
+        self.write_notes(["crash", "note 2", "note 3"])
+        with self.assertRaisesRegex(RuntimeError, "boom"):
+            await self.calculate()
+        self.assertEqual({asyncio.current_task()}, asyncio.all_tasks())  # nothing left running
+
+
+class TestReportIndex(ReportTestCase):
+    """Test case for the report index, used to resume and to look up notes"""
+
+    async def asyncSetUp(self):
+        await super().asyncSetUp()
+        # Instance ids that differ from the row numbers, so that looking up one can't find the other
+        self.write_notes([f"note {i}" for i in range(1, 6)], first_instance=101)
+        await self.calculate()
+        with open(self.pdr_path, "rb") as f:
+            self.original_report = f.read()
+        with open(pdr.index_path_for(self.pdr_path), "rb") as f:
+            self.original_index = f.read()
+
+    def truncate(self, path: str, size: int) -> None:
+        with open(path, "r+b") as f:
+            f.truncate(size)
+
+    def test_records_point_at_report_lines(self):
+        records = list(pdr.iter_index_records(pdr.index_path_for(self.pdr_path)))
+        self.assertEqual([101, 102, 103, 104, 105], [record[0] for record in records])
+        self.assertEqual([1, 2, 3, 4, 5], [record[1] for record in records])
+        with open(self.notes_path, "rb") as f:
+            notes = f.read()
+        for instance, _, csv_offset, report_offset, length in records:
+            report_end = report_offset + length
+            line = self.original_report[report_offset:report_end]
+            self.assertEqual(str(instance), json.loads(line)["instance_num"])
+            self.assertTrue(notes[:csv_offset].endswith(f"{instance},note {instance - 100}\r\n".encode("utf8")))
+
+    def test_rebuilds_missing_index(self):
+        os.remove(pdr.index_path_for(self.pdr_path))
+        with contextlib.redirect_stdout(io.StringIO()):
+            last = pdr.load_checkpoint(self.pdr_path, self.notes_path)
+        self.assertEqual(105, last[0])
+        with open(pdr.index_path_for(self.pdr_path), "rb") as f:
+            self.assertEqual(self.original_index, f.read())
+
+    def test_rebuilds_stale_index(self):
+        lines = self.original_report.splitlines(keepends=True)
+        self.truncate(self.pdr_path, len(lines[0]) + len(lines[1]))  # like an older copy of the report
+        with contextlib.redirect_stdout(io.StringIO()):
+            last = pdr.load_checkpoint(self.pdr_path, self.notes_path)
+        self.assertEqual((102, 2), last[:2])
+        self.assertEqual(2, pdr.count_index_records(pdr.index_path_for(self.pdr_path)))
+
+    def test_drops_torn_last_record(self):
+        # pylint: disable=protected-access
+        # Killed while writing the last index record, after the report line (and part of the next one) was written
+        index_path = pdr.index_path_for(self.pdr_path)
+        self.truncate(index_path, len(self.original_index) - 3)
+        with open(self.pdr_path, "ab") as f:
+            f.write(b'{"instance_num": "10')
+
+        last = pdr.load_checkpoint(self.pdr_path, self.notes_path)
+        self.assertEqual((104, 4), last[:2])
+        self.assertEqual(len(self.original_index) - pdr._INDEX_RECORD.size, os.path.getsize(index_path))
+        self.assertEqual(last[3] + last[4], os.path.getsize(self.pdr_path))
+
+    async def test_resume_from_checkpoint(self):
+        # pylint: disable=protected-access
+        records = list(pdr.iter_index_records(pdr.index_path_for(self.pdr_path)))
+        self.truncate(pdr.index_path_for(self.pdr_path), len(pdr._INDEX_MAGIC) + 2 * pdr._INDEX_RECORD.size)
+        self.truncate(self.pdr_path, records[2][3] + 5)  # the third line was cut short
+
+        await self.calculate(resume=True)
+        with open(self.pdr_path, "rb") as f:
+            self.assertEqual(self.original_report, f.read())
+        with open(pdr.index_path_for(self.pdr_path), "rb") as f:
+            self.assertEqual(self.original_index, f.read())
+
+    def test_find_note(self):
+        for index in (True, False):
+            if not index:
+                os.remove(pdr.index_path_for(self.pdr_path))
+            with self.subTest(index=index):
+                self.assertEqual("103", pdr.find_note(self.pdr_path, 3, None)["instance_num"])
+                self.assertEqual("104", pdr.find_note(self.pdr_path, None, 104)["instance_num"])
+                self.assertIsNone(pdr.find_note(self.pdr_path, 6, None))
+                self.assertIsNone(pdr.find_note(self.pdr_path, None, 3))  # a row number, not an instance id
+
+    async def test_show(self):
+        for note, instance in ((2, None), (None, 102)):
+            args = argparse.Namespace(
+                pdr_path=self.pdr_path, note=note, instance=instance, diff=None, show_full=True, mention=[]
+            )
+            with contextlib.redirect_stdout(io.StringIO()) as stdout:
+                await pdr.report(None, args)
+            self.assertTrue(stdout.getvalue().startswith("note 2\n"), stdout.getvalue())
+
+
+class TestShards(unittest.TestCase):
+    """Test case for merging shard reports"""
+
+    def setUp(self):
+        super().setUp()
+        tmpdir = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.addCleanup(tmpdir.cleanup)
+        self.notes_path = os.path.join(tmpdir.name, "notes.csv")
+
+    def write_shard(self, shards: int, shard_index: int, rows: list) -> None:
+        """Writes a shard report (and index) holding the given CSV rows"""
+        # pylint: disable=protected-access
+        path = pdr.report_path_for(self.notes_path, shards, shard_index)
+        with open(path, "wb") as report, open(pdr.index_path_for(path), "wb") as index:
+            index.write(pdr._INDEX_MAGIC)
+            for row in rows:
+                line = json.dumps({"instance_num": str(row)}).encode("utf8") + b"\n"
+                index.write(pdr._INDEX_RECORD.pack(row, row, 0, report.tell(), len(line)))
+                report.write(line)
+
+    def merge(self, replace: bool = False) -> list:
+        with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+            pdr.merge_reports(self.notes_path, 2, replace=replace)
+        with open(pdr.report_path_for(self.notes_path), encoding="utf8") as f:
+            return [json.loads(line)["instance_num"] for line in f]
+
+    def test_merge_again_is_a_no_op(self):
+        self.write_shard(2, 0, [1, 3])
+        self.write_shard(2, 1, [2, 4])
+        self.assertEqual(["1", "2", "3", "4"], self.merge())
+        self.assertEqual(["1", "2", "3", "4"], self.merge())  # already merged, so nothing to do
+
+    def test_incomplete_merge(self):
+        self.write_shard(2, 0, [1, 3])
+        self.write_shard(2, 1, [])
+        self.assertEqual(["1"], self.merge())  # stops at the first missing row
+
+        self.write_shard(2, 1, [2, 4])
+        with self.assertRaises(SystemExit):
+            self.merge()  # won't overwrite a report unless asked to
+        self.assertEqual(["1", "2", "3", "4"], self.merge(replace=True))
+
+    def test_shards_must_be_positive(self):
+        self.assertEqual(3, pdr.positive_int("3"))
+        for value in ("0", "-2"):
+            with self.assertRaises(argparse.ArgumentTypeError):
+                pdr.positive_int(value)
+
+
+def report_line(instance: int, differences: list, polarity_pairs: list = None, error: str = None) -> dict:
+    """Returns a report line, listing a difference as (type, text, CUI, cTAKES polarity, cNLP polarity)"""
+    line = {
+        "instance_num": str(instance),
+        "note": "...",
+        "error": error,
+        "differences": [
+            {
+                "cnlp_polarity": cnlp,
+                "match": {"type": mention, "text": text, "polarity": ctakes, "conceptAttributes": [{"cui": cui}]},
+            }
+            for mention, text, cui, ctakes, cnlp in differences
+        ],
+    }
+    if polarity_pairs is not None:
+        line["polarity_pairs"] = polarity_pairs
+    return line
+
+
+class TestSummary(unittest.IsolatedAsyncioTestCase):
+    """Test case for summarizing a whole report"""
+
+    def setUp(self):
+        super().setUp()
+        tmpdir = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.addCleanup(tmpdir.cleanup)
+        self.pdr_path = os.path.join(tmpdir.name, "notes.pdr.ndjson")
+
+    def write_report(self, lines: list) -> None:
+        with open(self.pdr_path, "w", encoding="utf8") as f:
+            f.writelines(json.dumps(line) + "\n" for line in lines)
+
+    async def summary(self, processes: int, as_json: bool = True) -> str:
+        args = argparse.Namespace(pdr_path=self.pdr_path, json=as_json, top=2, processes=processes)
+        with contextlib.redirect_stdout(io.StringIO()) as stdout:
+            await pdr.summary(None, args)
+        return stdout.getvalue()
+
+    async def test_summary(self):
+        sign, disease = "SignSymptomMention", "DiseaseDisorderMention"
+        self.write_report(
+            [
+                report_line(1, [], [[sign, 0, 0, 3]]),
+                report_line(2, [(sign, "Cough", "C0010200", 0, -1)], [[sign, 0, -1, 1], [sign, 0, 0, 1]]),
+                report_line(3, [], [], error="connection refused"),
+                report_line(
+                    4,
+                    [(sign, "cough", "C0010200", -1, 0), (disease, "Fever", "C0015967", -1, 0)],
+                    [[disease, -1, 0, 1], [disease, -1, -1, 2], [sign, -1, 0, 1]],
+                ),
+            ]
+        )
+
+        serial = json.loads(await self.summary(processes=1))
+        self.assertEqual(serial, json.loads(await self.summary(processes=2)))
+        self.assertEqual(
+            {
+                "notes": 4,
+                "notes_with_errors": {"count": 1, "rate": 0.25},
+                "notes_with_differences": 2,
+                "complete": True,
+                "mentions": {
+                    "ctakes_pos_cnlp_pos": 4,
+                    "ctakes_pos_cnlp_neg": 1,
+                    "ctakes_neg_cnlp_pos": 2,
+                    "ctakes_neg_cnlp_neg": 2,
+                    "disagreements": 3,
+                    "disagreement_rate": 3 / 9,
+                },
+                "by_type": {
+                    disease: {
+                        "ctakes_pos_cnlp_pos": 0,
+                        "ctakes_pos_cnlp_neg": 0,
+                        "ctakes_neg_cnlp_pos": 1,
+                        "ctakes_neg_cnlp_neg": 2,
+                        "disagreements": 1,
+                        "disagreement_rate": 1 / 3,
+                    },
+                    sign: {
+                        "ctakes_pos_cnlp_pos": 4,
+                        "ctakes_pos_cnlp_neg": 1,
+                        "ctakes_neg_cnlp_pos": 1,
+                        "ctakes_neg_cnlp_neg": 0,
+                        "disagreements": 2,
+                        "disagreement_rate": 2 / 6,
+                    },
+                },
+                "top_cuis": [["C0010200", 2], ["C0015967", 1]],
+                "top_texts": [["cough", 2], ["fever", 1]],
+            },
+            serial,
+        )
+
+        table = await self.summary(processes=2, as_json=False)
+        self.assertIn("with errors: 1 = 25.0%", table)
+        self.assertIn(f"{'TOTAL':<24} {4:>9} {1:>9} {2:>9} {2:>9} {'33.3%':>9}", table)
+        self.assertNotIn("predates", table)
+
+    async def test_report_without_agreement_counts(self):
+        self.write_report([report_line(1, [("SignSymptomMention", "Cough", "C0010200", 0, -1)])])
+        result = json.loads(await self.summary(processes=1))
+        self.assertFalse(result["complete"])
+        self.assertIsNone(result["mentions"]["ctakes_pos_cnlp_pos"])
+        self.assertEqual(1, result["mentions"]["ctakes_pos_cnlp_neg"])
+        self.assertIsNone(result["mentions"]["disagreement_rate"])
+        self.assertIn("predates", await self.summary(processes=1, as_json=False))
+
+    def test_ranges_add_up(self):
+        self.write_report([report_line(i, [], [["SignSymptomMention", 0, 0, i]]) for i in range(1, 8)])
+        whole = pdr.summarize_range(self.pdr_path, 0, os.path.getsize(self.pdr_path))
+        merged = pdr.Summary()
+        for start, end in ctakesclient.filesystem.split_byte_ranges(self.pdr_path, 3):
+            merged.merge(pdr.summarize_range(self.pdr_path, start, end))
+        self.assertEqual(whole.as_json(top=5), merged.as_json(top=5))
+        self.assertEqual(28, whole.as_json(top=5)["mentions"]["ctakes_pos_cnlp_pos"])
+
+
+if __name__ == "__main__":
+    unittest.main()
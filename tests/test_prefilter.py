@@ -0,0 +1,78 @@
+"""Tests for the prefilter module"""
+
+import unittest
+
+import ddt
+
+from ctakesclient import filesystem, prefilter
+from tests.test_resources import LoadResource
+
+
+@ddt.ddt
+class TestTermMatcher(unittest.TestCase):
+    """Test case for the Aho-Corasick dictionary matcher"""
+
+    def test_normalize(self):
+        self.assertEqual(" shortness of breath ", prefilter.normalize("\tShortness   OF\nbreath "))
+
+    def test_find_overlapping_terms(self):
+        matcher = prefilter.TermMatcher(["he", "she", "his", "hers", "", "  "])
+        self.assertEqual(["she", "he", "hers"], matcher.find("she hers"))
+        self.assertEqual([], matcher.find("ushers"))  # matches must start on a word boundary
+        self.assertEqual(["he", "he", "hers", "his"], matcher.find("He hers HIS"))
+
+    def test_find_spans(self):
+        matcher = prefilter.TermMatcher(["shortness of breath", "cough", "i"])
+        text = "Pt has SHORTNESS  of\n breath, 😀 coughing, İ"
+        self.assertEqual(
+            ["SHORTNESS  of\n breath", "cough", "İ"],
+            [text[begin:end] for begin, end in matcher.find_spans(text)],
+        )
+
+    @ddt.data(
+        ("Patient c/o productive cough", True),
+        ("Patient reports   SHORTNESS\nof breath", True),
+        ("Patient was coughing all night", True),  # word endings are allowed to differ
+        ("Patient had a headache", False),  # but word beginnings are not
+        ("Patient is here for a routine physical", False),
+        ("", False),
+    )
+    @ddt.unpack
+    def test_contains_any(self, text, expected):
+        matcher = prefilter.TermMatcher(["cough", "shortness of breath", "ache"])
+        self.assertEqual(expected, matcher.contains_any(text))
+
+    def test_matches_brute_force(self):
+        concepts = filesystem.covid_symptoms()
+        matcher = prefilter.TermMatcher.from_concepts(concepts)
+        terms = {prefilter.normalize(x).strip() for c in concepts for x in (c.text, c.pref)}
+
+        text = prefilter.normalize(LoadResource.PHYSICIAN_NOTE_TEXT.value)
+        expected = sorted(
+            (i + len(term), term)
+            for term in terms
+            for i in range(len(text))
+            if text.startswith(term, i) and (i == 0 or not text[i - 1].isalnum())
+        )
+        self.assertEqual([term for _, term in expected], matcher.find(text))
+        self.assertIn("cough", matcher.find(text))
+
+    def test_split_paragraphs(self):
+        text = "First para\nstill first.\n\n  \nSecond para.\n\nThird\n"
+        self.assertEqual(
+            ["First para\nstill first.", "Second para.", "Third\n"],
+            [text[begin:end] for begin, end in prefilter.split_paragraphs(text)],
+        )
+        self.assertEqual([], prefilter.split_paragraphs("\n\n"))
+
+    def test_select_paragraphs(self):
+        matcher = prefilter.TermMatcher(["fever"])
+        text = "No complaints.\n\nPatient has a fever.\n\nFollow up in a week.\n\nFEVER resolved."
+        self.assertEqual(
+            ["Patient has a fever.", "FEVER resolved."],
+            [text[begin:end] for begin, end in matcher.select_paragraphs(text)],
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,148 @@
+"""Tests for the store module"""
+
+import gzip
+import json
+import os
+import tempfile
+import unittest
+
+import ddt
+
+from ctakesclient.store import ResultStore
+from ctakesclient.typesystem import CtakesJSON
+from tests.test_resources import LoadResource
+
+
+@ddt.ddt
+class TestResultStore(unittest.TestCase):
+    """Test case for the NDJSON result store"""
+
+    def setUp(self):
+        super().setUp()
+        tmpdir = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.addCleanup(tmpdir.cleanup)
+        self.dir = tmpdir.name
+        self.path = os.path.join(self.dir, "results.ndjson")
+        self.synthetic = CtakesJSON(LoadResource.SYNTHETIC_JSON.value)
+        self.physician = CtakesJSON(LoadResource.PHYSICIAN_NOTE_JSON.value)
+
+    def fill(self, path: str, note_ids: list, compress: bool = False, block_size: int = 1) -> None:
+        with ResultStore(path, compress=compress, block_size=block_size) as store:
+            for i, note_id in enumerate(note_ids):
+                store.append(note_id, self.synthetic if i % 2 else self.physician)
+
+    @ddt.data(False, True)
+    def test_round_trip(self, compress):
+        self.fill(self.path, ["a", "b", "c"], compress=compress, block_size=10_000)
+
+        with ResultStore(self.path) as store:
+            self.assertEqual(compress, store.compress)
+            self.assertEqual(3, len(store))
+            self.assertIn("b", store)
+            self.assertNotIn("z", store)
+            self.assertIsNone(store.get("z"))
+            self.assertEqual(self.synthetic.as_json(), store.get("b").as_json())
+            self.assertEqual(self.physician.as_json(), store.get_json("c"))
+            self.assertEqual(["a", "b", "c"], [note_id for note_id, _ in store])
+
+        # Still plain NDJSON (or gzipped NDJSON) underneath
+        opener = gzip.open if compress else open
+        with opener(self.path, "rt", encoding="utf8") as f:
+            self.assertEqual(["a", "b", "c"], [json.loads(line)["note_id"] for line in f])
+
+    def test_pending_records_are_visible(self):
+        with ResultStore(self.path, block_size=1_000_000) as store:
+            store.append("a", self.synthetic)
+            self.assertEqual(0, os.path.getsize(self.path))
+            self.assertEqual(self.synthetic.as_json(), store.get_json("a"))
+            self.assertEqual(["a"], store.note_ids())
+
+    def test_latest_record_wins(self):
+        with ResultStore(self.path) as store:
+            store.append("a", self.synthetic)
+            store.flush()
+            store.append("a", self.physician)
+        with ResultStore(self.path) as store:
+            self.assertEqual(1, len(store))
+            self.assertEqual(self.physician.as_json(), store.get_json("a"))
+            self.assertEqual(["a", "a"], [note_id for note_id, _ in store.iter_json()])
+
+    @ddt.data(False, True)
+    def test_iter_json_from_offset(self, compress):
+        self.fill(self.path, ["a", "b"], compress=compress)
+        with ResultStore(self.path) as store:
+            start = store.data_end
+            store.append("c", self.synthetic)
+            store.append("d", self.physician)
+            self.assertEqual(["c", "d"], [note_id for note_id, _ in store.iter_json(start=start)])
+            self.assertEqual(os.path.getsize(self.path), store.data_end)
+            self.assertEqual([], list(store.iter_json(start=store.data_end)))
+
+    def test_compress_mismatch(self):
+        self.fill(self.path, ["a"], compress=True)
+        with self.assertRaisesRegex(ValueError, "compress=True"):
+            ResultStore(self.path, compress=False)
+
+    @ddt.data(False, True)
+    def test_recovers_from_interrupted_write(self, compress):
+        self.fill(self.path, ["a", "b"], compress=compress)
+        size = os.path.getsize(self.path)
+        with open(self.path, "ab") as f:
+            f.write(b"\x1f\x8b\x08 half a block" if compress else b'{"note_id": "c", "cta')
+
+        with ResultStore(self.path) as store:
+            self.assertEqual(size, os.path.getsize(self.path))
+            store.append("c", self.synthetic)
+        with ResultStore(self.path) as store:
+            self.assertEqual(self.synthetic.as_json(), store.get_json("c"))
+
+    @ddt.data((False, 1, 5), (True, 1, 5), (True, 1_000_000, 5), (False, 1, 1), (True, 1_000_000, 1))
+    @ddt.unpack
+    def test_recovers_from_torn_index(self, compress, block_size, cut):
+        self.fill(self.path, ["a", "b", "c", "d"], compress=compress, block_size=block_size)
+        with open(f"{self.path}.idx", "rb") as f:
+            original = f.read()
+        with open(f"{self.path}.idx", "wb") as f:
+            f.write(original[:-cut])  # the last entry was being written when the process died
+
+        with ResultStore(self.path) as store:
+            self.assertEqual(["a", "b", "c", "d"], store.note_ids())
+            self.assertEqual(self.synthetic.as_json(), store.get_json("d"))
+            store.append("e", self.physician)
+        with ResultStore(self.path) as store:
+            self.assertEqual(["a", "b", "c", "d", "e"], [note_id for note_id, _ in store.iter_json()])
+        with open(f"{self.path}.idx", "rb") as f:
+            self.assertTrue(f.read().startswith(original))  # the same entries as before, then "e"
+
+    @ddt.data(False, True)
+    def test_reindex(self, compress):
+        self.fill(self.path, ["a", "b", "c"], compress=compress, block_size=2000)
+        with open(f"{self.path}.idx", "rb") as f:
+            original = f.read()
+        os.remove(f"{self.path}.idx")
+
+        with ResultStore(self.path, compress=compress) as store:
+            self.assertEqual(self.physician.as_json(), store.get_json("c"))
+        with open(f"{self.path}.idx", "rb") as f:
+            self.assertEqual(original, f.read())
+
+    @ddt.data((False, False), (True, True), (False, True))
+    @ddt.unpack
+    def test_merge(self, shard_compress, merged_compress):
+        shard1 = os.path.join(self.dir, "shard1.ndjson")
+        shard2 = os.path.join(self.dir, "shard2.ndjson")
+        self.fill(shard1, ["a", "b"], compress=shard_compress)
+        self.fill(shard2, ["c", "d"], compress=shard_compress)
+
+        with ResultStore.merge_files(self.path, [shard1, shard2], compress=merged_compress) as merged:
+            self.assertEqual(["a", "b", "c", "d"], merged.note_ids())
+            self.assertEqual(self.physician.as_json(), merged.get_json("c"))
+            self.assertEqual(self.synthetic.as_json(), merged.get_json("d"))
+
+        with ResultStore(self.path) as merged:
+            self.assertEqual(["a", "b", "c", "d"], [note_id for note_id, _ in merged.iter_json()])
+            self.assertEqual(self.synthetic.as_json(), merged.get_json("b"))
+
+
+if __name__ == "__main__":
+    unittest.main()
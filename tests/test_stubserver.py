@@ -0,0 +1,100 @@
+"""Tests for the stubserver module"""
+
+import asyncio
+import unittest
+
+import httpx
+
+from ctakesclient import client, filesystem, stubserver, transformer
+from ctakesclient.filesystem import BsvConcept
+from ctakesclient.stubserver import StubServer
+from ctakesclient.typesystem import Polarity, UmlsTypeMention
+from tests.test_resources import LoadResource
+
+
+class TestStubServer(unittest.IsolatedAsyncioTestCase):
+    """Test case for the cTAKES & cNLP stand-in"""
+
+    async def start(self, **kwargs) -> StubServer:
+        server = StubServer(**kwargs)
+        await server.start()
+        self.addAsyncCleanup(server.stop)
+        return server
+
+    async def test_dictionary_answers(self):
+        server = await self.start()
+        text = "🩺 Patient denies fever.\nHas a bad COUGH and shortness\nof  breath."
+
+        ner = await client.extract(text, url=server.ctakes_url)
+
+        found = {}
+        for match in ner.list_match():
+            begin, end = match.begin, match.end
+            found[text[begin:end]] = match  # spans come back as python offsets
+        self.assertEqual({"fever", "COUGH", "shortness\nof  breath"}, set(found))
+        self.assertEqual(Polarity.neg, found["fever"].polarity)
+        self.assertEqual(Polarity.pos, found["COUGH"].polarity)
+        self.assertEqual(UmlsTypeMention.SignSymptom, found["COUGH"].type)
+        self.assertIn("C0010200", {c.cui for c in found["COUGH"].conceptAttributes})
+
+        # cTAKES-style utf16 offsets on the wire
+        raw = await client.post(text, url=server.ctakes_url)
+        self.assertEqual(found["fever"].begin + 1, raw["SignSymptomMention"][0]["begin"])
+
+    async def test_polarity_endpoints(self):
+        server = await self.start()
+        text = "No fever, but a cough."
+        spans = [(3, 8), (16, 21)]
+        for url, model in [
+            (server.negation_url, transformer.TransformerModel.NEGATION),
+            (server.term_exists_url, transformer.TransformerModel.TERM_EXISTS),
+        ]:
+            polarities = await transformer.list_polarity(text, spans, url=url, model=model)
+            self.assertEqual([Polarity.neg, Polarity.pos], polarities)
+        self.assertEqual({"negation": 1, "termexists": 1}, server.requests)
+
+    async def test_fixture_and_custom_dictionary(self):
+        server = await self.start(fixture=LoadResource.PHYSICIAN_NOTE_JSON.value)
+        self.assertEqual(LoadResource.PHYSICIAN_NOTE_JSON.value, await client.post("anything", url=server.ctakes_url))
+
+        aspirin = BsvConcept("C0004057", "T109", "387458008", "SNOMEDCT_US", "aspirin", "Aspirin")
+        server = await self.start(concepts=[aspirin, *filesystem.covid_symptoms()])
+        ner = await client.extract("Took aspirin for the headache.", url=server.ctakes_url)
+        self.assertEqual(["aspirin"], [m.text for m in ner.list_medication()])
+        self.assertEqual(["headache"], [m.text for m in ner.list_sign_symptom()])
+
+    async def test_errors(self):
+        server = await self.start(error_rate=1, error_status=429)
+        with self.assertRaises(httpx.HTTPStatusError) as cm:
+            await client.post("cough", url=server.ctakes_url)
+        self.assertEqual(429, cm.exception.response.status_code)
+        self.assertEqual(1, server.errors)
+
+        async with httpx.AsyncClient() as http:
+            self.assertEqual(404, (await http.post(server.base_url + "/nope")).status_code)
+            self.assertEqual(405, (await http.get(server.ctakes_url)).status_code)
+            self.assertEqual(400, (await http.post(server.negation_url, content=b"{")).status_code)
+
+    async def test_latency_and_concurrency_limit(self):
+        server = await self.start(latency=0.02, max_concurrency=2)
+        async with httpx.AsyncClient() as http:
+            await asyncio.gather(*[client.extract("cough", url=server.ctakes_url, client=http) for _ in range(6)])
+        self.assertEqual(2, server.max_active)
+        self.assertEqual(6, server.requests["ctakes"])
+
+    async def test_no_concurrency_limit_by_default(self):
+        server = await self.start(latency=0.02)
+        async with httpx.AsyncClient() as http:
+            await asyncio.gather(*[client.extract("cough", url=server.ctakes_url, client=http) for _ in range(6)])
+        self.assertEqual(6, server.max_active)
+        self.assertEqual(6, server.requests["ctakes"])
+
+    def test_lognormal_latency(self):
+        latency = stubserver.lognormal_latency(0.1, sigma=0, per_1k_chars=0.05)
+        self.assertAlmostEqual(0.2, latency(2000))
+        first, second = stubserver.lognormal_latency(0.1, seed=3), stubserver.lognormal_latency(0.1, seed=3)
+        self.assertEqual([first(0) for _ in range(3)], [second(0) for _ in range(3)])
+
+
+if __name__ == "__main__":
+    unittest.main()
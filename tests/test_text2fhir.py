@@ -1,12 +1,20 @@
 """Tests for text2fhir.py"""
 
+import concurrent.futures
+import json
+import os
+import subprocess  # nosec
+import sys
 import unittest
+from unittest import mock
+
+import ddt
 
 import ctakesclient
 from ctakesclient import text2fhir
 from ctakesclient.typesystem import CtakesJSON, MatchText, Polarity
 
-from tests.test_resources import LoadResource
+from tests.test_resources import LoadResource, PathResource
 
 
 def expected_nlp_source() -> dict:
@@ -373,3 +381,223 @@ class TestText2Fhir(unittest.TestCase):
             },
             {type(x).__name__ for x in fhir},
         )
+
+
+@ddt.ddt
+class TestText2FhirJson(unittest.TestCase):
+    """
+    Test that the fast plain-dict conversion path matches the fhirclient model path byte for byte.
+    """
+
+    def setUp(self):
+        super().setUp()
+        # Make ids predictable, so that both paths produce the same ids
+        patcher = mock.patch("ctakesclient.text2fhir._random_id", return_value="resource-id")
+        self.addCleanup(patcher.stop)
+        patcher.start()
+
+    def assertSameJson(self, expected: dict, actual: dict):
+        self.assertEqual(json.dumps(expected), json.dumps(actual))
+
+    @ddt.data(LoadResource.SYNTHETIC_JSON, LoadResource.PHYSICIAN_NOTE_JSON)
+    def test_individual_resources(self, resource):
+        ctakes = CtakesJSON(resource.value)
+        pairs = [
+            (text2fhir.nlp_observation, text2fhir.nlp_observation_json),
+            (text2fhir.nlp_medication, text2fhir.nlp_medication_json),
+            (text2fhir.nlp_condition, text2fhir.nlp_condition_json),
+            (text2fhir.nlp_procedure, text2fhir.nlp_procedure_json),
+        ]
+        for match in ctakes.list_match():
+            self.assertSameJson(text2fhir.nlp_concept(match).as_json(), text2fhir.nlp_concept_json(match))
+            for slow, fast in pairs:
+                self.assertSameJson(slow("1234", "5678", "ABCD", match).as_json(), fast("1234", "5678", "ABCD", match))
+
+    @ddt.data(Polarity.pos, Polarity.neg)
+    def test_nlp_fhir(self, polarity):
+        ctakes = CtakesJSON(LoadResource.SYNTHETIC_JSON.value)
+        slow = [x.as_json() for x in text2fhir.nlp_fhir("1234", "5678", "ABCD", ctakes, polarity=polarity)]
+        fast = text2fhir.nlp_fhir_json("1234", "5678", "ABCD", ctakes, polarity=polarity)
+        self.assertLess(0, len(fast))
+        self.assertEqual(json.dumps(slow), json.dumps(fast))
+
+    def test_custom_source(self):
+        ctakes = CtakesJSON(LoadResource.SYNTHETIC_JSON.value)
+        source = text2fhir._nlp_source("my-nlp", "v1")  # pylint: disable=protected-access
+        slow = [x.as_json() for x in text2fhir.nlp_fhir("1234", "5678", "ABCD", ctakes, source=source)]
+        self.assertEqual(json.dumps(slow), json.dumps(text2fhir.nlp_fhir_json("1234", "5678", "ABCD", ctakes, source)))
+        self.assertEqual(
+            json.dumps(slow), json.dumps(text2fhir.nlp_fhir_json("1234", "5678", "ABCD", ctakes, source.as_json()))
+        )
+
+    def test_edge_cases(self):
+        match = MatchText(
+            {
+                "begin": 0,
+                "end": 0,
+                "conceptAttributes": [{"code": "foobar", "codingScheme": "custom", "cui": "C0043262"}],
+                "polarity": -1,
+                "type": "SignSymptomMention",
+            }
+        )
+        self.assertSameJson(
+            text2fhir.nlp_observation("1234", "5678", "ABCD", match).as_json(),
+            text2fhir.nlp_observation_json("1234", "5678", "ABCD", match),
+        )
+
+    def test_missing_ids(self):
+        match = CtakesJSON(LoadResource.SYNTHETIC_JSON.value).list_match()[0]
+        with self.assertRaises(ValueError):
+            text2fhir.nlp_observation_json("", "5678", "ABCD", match)
+        with self.assertRaises(ValueError):
+            text2fhir.nlp_observation_json("1234", "5678", None, match)
+
+    @ddt.data(Polarity.pos, Polarity.neg, None)
+    def test_nlp_fhir_batch(self, polarity):
+        documents = [
+            ("p1", "e1", "d1", CtakesJSON(LoadResource.SYNTHETIC_JSON.value)),
+            ("p2", "e2", "d2", CtakesJSON(LoadResource.PHYSICIAN_NOTE_JSON.value)),
+            ("p3", "e3", "d3", CtakesJSON()),
+            ("p1", "e1", "d4", CtakesJSON(LoadResource.SYNTHETIC_JSON.value)),
+        ]
+        expected = [text2fhir.nlp_fhir_json(*doc, polarity=polarity) for doc in documents]
+        if polarity is not None:  # nlp_fhir doesn't accept None as a filter
+            expected_slow = [[x.as_json() for x in text2fhir.nlp_fhir(*doc, polarity=polarity)] for doc in documents]
+            self.assertEqual(json.dumps(expected_slow), json.dumps(expected))
+
+        actual = list(text2fhir.nlp_fhir_batch(documents, polarity=polarity))
+        self.assertEqual(json.dumps(expected), json.dumps(actual))
+
+    def test_nlp_fhir_batch_shares_fragments(self):
+        ctakes = CtakesJSON(LoadResource.SYNTHETIC_JSON.value)
+        first, second = text2fhir.nlp_fhir_batch([("p1", "e1", "d1", ctakes), ("p2", "e2", "d2", ctakes)])
+
+        self.assertIs(first[0]["modifierExtension"], second[0]["modifierExtension"])
+        self.assertIs(first[0]["code"], second[0]["code"])  # same concept set
+        self.assertIs(first[0]["subject"], first[1]["subject"])  # same document
+        self.assertIsNot(first[0]["subject"], second[0]["subject"])
+
+    def test_nlp_fhir_batch_custom_source(self):
+        ctakes = CtakesJSON(LoadResource.SYNTHETIC_JSON.value)
+        source = text2fhir._nlp_source("my-nlp", "v1")  # pylint: disable=protected-access
+        expected = text2fhir.nlp_fhir_json("1234", "5678", "ABCD", ctakes, source)
+        actual = text2fhir.NlpFhirConverter(source=source).convert("1234", "5678", "ABCD", ctakes)
+        self.assertEqual(json.dumps(expected), json.dumps(actual))
+
+
+class TestDeterministicIds(unittest.TestCase):
+    """Test stable resource ids and content hashes for incremental regeneration"""
+
+    def setUp(self):
+        super().setUp()
+        self.maxDiff = None  # For debugging. pylint: disable=invalid-name
+
+    def ids(self, resources) -> list:
+        return [x["id"] for x in resources]
+
+    def test_ids_are_repeatable(self):
+        first = text2fhir.nlp_fhir_json(
+            "1234", "5678", "ABCD", CtakesJSON(LoadResource.SYNTHETIC_JSON.value), deterministic_id=True
+        )
+        second = text2fhir.nlp_fhir_json(
+            "1234", "5678", "ABCD", CtakesJSON(LoadResource.SYNTHETIC_JSON.value), deterministic_id=True
+        )
+        self.assertEqual(self.ids(first), self.ids(second))
+        self.assertEqual(len(first), len(set(self.ids(first))))  # but unique per mention
+        self.assertEqual([text2fhir.resource_hash(x) for x in first], [text2fhir.resource_hash(x) for x in second])
+
+    def test_ids_are_random_by_default(self):
+        ctakes = CtakesJSON(LoadResource.SYNTHETIC_JSON.value)
+        first = text2fhir.nlp_fhir_json("1234", "5678", "ABCD", ctakes)
+        second = text2fhir.nlp_fhir_json("1234", "5678", "ABCD", ctakes)
+        self.assertFalse(set(self.ids(first)) & set(self.ids(second)))
+
+    def test_all_paths_agree(self):
+        ctakes = CtakesJSON(LoadResource.SYNTHETIC_JSON.value)
+        slow = [x.as_json() for x in text2fhir.nlp_fhir("1234", "5678", "ABCD", ctakes, deterministic_id=True)]
+        fast = text2fhir.nlp_fhir_json("1234", "5678", "ABCD", ctakes, deterministic_id=True)
+        (batch,) = text2fhir.nlp_fhir_batch([("1234", "5678", "ABCD", ctakes)], deterministic_id=True)
+        self.assertEqual(json.dumps(slow), json.dumps(fast))
+        self.assertEqual(json.dumps(slow), json.dumps(batch))
+
+    def test_id_inputs(self):
+        match = CtakesJSON(LoadResource.SYNTHETIC_JSON.value).list_match()[0]
+        stable = text2fhir.stable_id("Observation", "ABCD", match)
+        self.assertEqual(stable, text2fhir.stable_id("Observation", "ABCD", match))
+        self.assertNotEqual(stable, text2fhir.stable_id("Condition", "ABCD", match))
+        self.assertNotEqual(stable, text2fhir.stable_id("Observation", "EFGH", match))
+
+        match.conceptAttributes.reverse()  # concept order does not matter
+        self.assertEqual(stable, text2fhir.stable_id("Observation", "ABCD", match))
+
+        match.end += 1
+        self.assertNotEqual(stable, text2fhir.stable_id("Observation", "ABCD", match))
+
+    def test_hashes_do_not_depend_on_hash_seed(self):
+        code = "\n".join(
+            [
+                "import sys",
+                "from ctakesclient import filesystem, text2fhir",
+                "from ctakesclient.typesystem import CtakesJSON",
+                "ner = CtakesJSON(filesystem.read_json(sys.argv[1]))",
+                "slow = [text2fhir.nlp_concept(match).as_json() for match in ner.list_match()]",
+                "fast = [text2fhir.nlp_concept_json(match) for match in ner.list_match()]",
+                "print([text2fhir.resource_hash(x) for x in slow + fast])",
+            ]
+        )
+        outputs = set()
+        for seed in ("1", "2"):
+            env = dict(os.environ, PYTHONHASHSEED=seed)
+            args = [sys.executable, "-c", code, PathResource.SYNTHETIC_JSON.value]
+            outputs.add(subprocess.check_output(args, env=env, text=True))  # nosec
+        self.assertEqual(1, len(outputs), "UMLS codings must not come out in set order")
+
+    def test_resource_hash(self):
+        self.assertEqual(text2fhir.resource_hash({"a": 1, "b": [2]}), text2fhir.resource_hash({"b": [2], "a": 1}))
+        self.assertNotEqual(text2fhir.resource_hash({"a": 1}), text2fhir.resource_hash({"a": 2}))
+
+
+class TestPooledConversion(unittest.IsolatedAsyncioTestCase):
+    """Test conversion in worker processes"""
+
+    def documents(self, count: int) -> list:
+        ctakes = CtakesJSON(LoadResource.SYNTHETIC_JSON.value)
+        return [(f"subject-{i}", f"encounter-{i}", f"docref-{i}", ctakes) for i in range(count)]
+
+    async def test_matches_batch_in_order(self):
+        documents = self.documents(7)
+        expected = list(text2fhir.nlp_fhir_batch(documents, deterministic_id=True))
+
+        with concurrent.futures.ProcessPoolExecutor(max_workers=2) as executor:
+            pooled = [
+                x
+                async for x in text2fhir.nlp_fhir_pooled(
+                    documents, executor=executor, chunk_size=2, max_pending=2, deterministic_id=True
+                )
+            ]
+
+        self.assertEqual(json.dumps(expected), json.dumps(pooled))
+
+    async def test_async_input_and_options(self):
+        documents = self.documents(3)
+        source = text2fhir._nlp_source(version="1.2.3")  # pylint: disable=protected-access
+        expected = list(text2fhir.nlp_fhir_batch(documents, source=source, polarity=None, deterministic_id=True))
+
+        async def agen():
+            for document in documents:
+                yield document
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+            pooled = [
+                x
+                async for x in text2fhir.nlp_fhir_pooled(
+                    agen(), executor=executor, source=source, polarity=None, deterministic_id=True
+                )
+            ]
+
+        self.assertEqual(json.dumps(expected), json.dumps(pooled))
+
+    async def test_own_executor(self):
+        pooled = [x async for x in text2fhir.nlp_fhir_pooled(self.documents(2), deterministic_id=True)]
+        self.assertEqual(2, len(pooled))
+        self.assertEqual("Patient/subject-1", pooled[1][0]["subject"]["reference"])
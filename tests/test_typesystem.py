@@ -1,8 +1,12 @@
 """Tests for the typesystem module"""
 
+import json
+import pickle
 import unittest
 
-from ctakesclient.typesystem import CtakesJSON, Polarity, UmlsConcept, MatchText
+import ddt
+
+from ctakesclient.typesystem import CtakesJSON, Polarity, UmlsConcept, MatchText, read_varint, write_varint
 from tests.test_resources import LoadResource
 
 
@@ -55,5 +59,85 @@ class TestCtakesJSON(unittest.TestCase):
         self.assertEqual(MatchText.sort_concepts(concept_attributes1), MatchText.sort_concepts(concept_attributes4))
 
 
+class _LabeledCtakesJSON(CtakesJSON):
+    """A subclass, to check that pickling keeps it"""
+
+    label = None
+
+
+@ddt.ddt
+class TestCtakesJSONBinary(unittest.TestCase):
+    """Test case for the compact binary encoding"""
+
+    @ddt.data(LoadResource.PHYSICIAN_NOTE_JSON, LoadResource.SYNTHETIC_JSON)
+    def test_round_trip(self, resource):
+        original = CtakesJSON(resource.value)
+        encoded = original.to_bytes()
+
+        self.assertEqual(original.as_json(), CtakesJSON.from_bytes(encoded).as_json())
+        self.assertEqual(original.as_json(), pickle.loads(pickle.dumps(original)).as_json())
+        self.assertLess(len(encoded), len(json.dumps(original.as_json())) / 2)
+
+    def test_edge_values(self):
+        match = MatchText()
+        match.begin, match.end, match.text = None, -3, "ümlaut 🙂"
+        match.polarity = Polarity.neg
+        match.type = MatchText.parse_mention("IdentifiedAnnotation")
+        match.conceptAttributes = [UmlsConcept({"cui": "C1"}), UmlsConcept()]  # unsorted on purpose
+        original = CtakesJSON()
+        original.mentions[match.type] = [match]
+
+        decoded = CtakesJSON.from_bytes(original.to_bytes())
+        self.assertEqual(original.as_json(), decoded.as_json())
+        self.assertEqual(b"CTKJ\x02\x00\x00\x00\x00", CtakesJSON().to_bytes())
+
+    def test_varints(self):
+        out = bytearray(b"x")
+        values = [0, 1, 0x7F, 0x80, 300, 2**63]
+        for value in values:
+            write_varint(out, value)
+        self.assertEqual(b"x\x00\x01\x7f\x80\x01\xac\x02", out[:8])
+
+        decoded = []
+        pos = 1
+        while pos < len(out):
+            value, pos = read_varint(out, pos)
+            decoded.append(value)
+        self.assertEqual(values, decoded)
+
+    def test_polarity_none_round_trips(self):
+        original = CtakesJSON(LoadResource.SYNTHETIC_JSON.value)
+        matches = original.list_match()
+        matches[0].polarity = None
+        matches[1].polarity = Polarity.neg
+
+        decoded = CtakesJSON.from_bytes(original.to_bytes()).list_match()
+        self.assertEqual([m.polarity for m in matches], [m.polarity for m in decoded])
+        self.assertIsNone(decoded[0].polarity)
+
+    def test_reads_version_1(self):
+        self.assertEqual({}, CtakesJSON.from_bytes(b"CTKJ\x01\x00\x00\x00\x00").mentions)
+
+    def test_pickle_keeps_subclass(self):
+        original = _LabeledCtakesJSON(LoadResource.SYNTHETIC_JSON.value)
+        original.label = "note-1"
+        copy = pickle.loads(pickle.dumps(original))
+        self.assertIsInstance(copy, _LabeledCtakesJSON)
+        self.assertEqual("note-1", copy.label)
+        self.assertEqual(original.as_json(), copy.as_json())
+
+    def test_concepts_are_not_shared(self):
+        decoded = CtakesJSON.from_bytes(CtakesJSON(LoadResource.SYNTHETIC_JSON.value).to_bytes())
+        first, second = [m for m in decoded.list_match() if m.conceptAttributes][:2]
+        first.conceptAttributes[0].cui = "edited"
+        self.assertNotIn("edited", [c.cui for c in second.conceptAttributes])
+
+    def test_bad_input(self):
+        with self.assertRaisesRegex(ValueError, "not a binary"):
+            CtakesJSON.from_bytes(b'{"json": true}')
+        with self.assertRaisesRegex(ValueError, "version unknown: 9"):
+            CtakesJSON.from_bytes(b"CTKJ\x09")
+
+
 if __name__ == "__main__":
     unittest.main()